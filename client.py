@@ -0,0 +1,40 @@
+#!/usr/bin/env python3.11
+"""
+Thin client of the compile server (`./main.py --serve`): takes the arguments of main.py, prints the output of the
+compilation and exits with its status. `./client.py --stats` prints the statistics of the server.
+"""
+import json
+import os
+import socket
+import sys
+
+
+def server_address() -> str:
+    return os.environ.get('AW_SERVER', os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), f"assemblyWrapper-{os.getuid()}.sock"))
+
+
+def main():
+    if sys.argv[1:] == ['--stats']:
+        request = dict(stats=True)
+    else:
+        request = dict(arguments=sys.argv[1:], directory=os.getcwd(), environment=dict(os.environ))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(server_address())
+        except OSError as error:
+            print(f"ERROR: cannot connect to the compile server on {server_address()}: {error}", file=sys.stderr)
+            exit(1)
+        with connection.makefile("rwb") as stream:
+            stream.write(json.dumps(request).encode() + b"\n")
+            stream.flush()
+            response = json.loads(stream.readline())
+    if 'status' not in response:
+        print(json.dumps(response, indent=4))
+        return
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    exit(response['status'])
+
+
+if __name__ == '__main__':
+    main()
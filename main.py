@@ -1,36 +1,82 @@
 #!/usr/bin/env python3.11
-from abc import abstractmethod
+from abc import ABC, abstractmethod
 from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
 import copy
+import ctypes
+import hashlib
+import io
 import json
+import math
+import mmap
 import os.path
+import pickle
+import re
+import select
+import shutil
+import signal
+import socket
+import struct
 import subprocess
 import time
-from typing import List, Tuple, Dict, final
+import traceback
+from typing import List, Tuple, Dict, Optional, final
 import sys
 
-STATIC_MEMORY_SIZE = 1024 * 1024 * 8
-MAX_ARGS = 5
-
-strings = list()
-string_length = 0
-
-debug = False
-if 'DEBUG' in os.environ:
-    debug = True
-
-
-info_cmd = True
-if 'NO_CMD_INFO' in os.environ:
-    info_cmd = False
-
-info = True
-if 'NOINFO' in os.environ:
-    info = False
-
-fasm_loc = 'fasm'
-if 'FASM_LOC' in os.environ:
-    fasm_loc = os.environ['FASM_LOC']
+PUTC_BUFFER_SIZE = 4096
+BUILD_CACHE_SIZE = 1024 * 1024 * 256
+SERVER_BUILDS_SIZE = 1024 * 1024 * 64  # executables kept in memory by the compile server
+SERVER_MODULES_SIZE = 1024 * 1024 * 64  # pickled modules kept in memory by the compile server
+SERVER_LATENCIES = 1000  # compilations in the latency percentiles
+WATCH_POLL_INTERVAL = 0.25  # seconds between two looks at the sources when inotify is not available
+WATCH_SETTLE_TIME = 0.05  # seconds to wait after a change, editors may write a file in several steps
+LOOP_UNROLL_FACTOR = 4
+INLINE_SIZE = 40  # nodes in the body of a function inlined at every call
+PROFILE_HEADER = "[PROFILE] count cycles location\n"
+PROFILE_NUMBER_SIZE = 24  # a 64 bits number in decimal and a space
+
+def configure(environment) -> None:
+    """
+    Sets the options to their defaults, then reads the environment variables. Called at startup, and by the
+    compile server before every request with the environment of its client.
+    """
+    global strings, string_length, debug, info_cmd, info, unbuffered, fasm_loc
+    global optimization_level, use_ir, ir_ssa, emit_ir, loop_unroll_factor, inline, no_inline, profile
+    global builtin_assembler, run_in_memory, watch, build_cache, build_cache_dir
+    strings = list()
+    string_length = 0
+
+    debug = 'DEBUG' in environment
+    info_cmd = 'NO_CMD_INFO' not in environment
+    info = 'NOINFO' not in environment
+    unbuffered = 'UNBUFFERED' in environment
+    fasm_loc = environment.get('FASM_LOC', 'fasm')
+
+    optimization_level = 0
+    use_ir = False
+    ir_ssa = False
+    emit_ir = False
+    loop_unroll_factor = LOOP_UNROLL_FACTOR
+    inline = True
+    no_inline = set()
+    profile = False
+
+    builtin_assembler = False
+    run_in_memory = False
+    watch = False
+
+    build_cache = True
+    build_cache_dir = os.path.join(environment.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'assemblyWrapper')
+    build_cache_dir = environment.get('BUILD_CACHE_DIR', build_cache_dir)
+
+
+configure(os.environ)
+
+# the compile server keeps the executables and the parsed modules in memory, in front of the caches on disk
+memory_builds: Optional['LRUCache'] = None
+memory_modules: Optional['LRUCache'] = None
 
 
 def shift_args(args: List) -> Tuple[str, List]:
@@ -38,11 +84,23 @@ def shift_args(args: List) -> Tuple[str, List]:
 
 
 def usage(program_name: str) -> None:
-    print(f"{program_name} <input file> <output file>")
-
-
-def todo():
-    assert False, "Not implemented yet"
+    print(f"{program_name} [-O<level>] [--unroll=<n>] [--no-inline[=<functions>]] [--ir] [--ssa] [--emit-ir] [--builtin-assembler] [--profile] [--no-cache] <input file> <output file>")
+    print(f"{program_name} [options] --run <input file>")
+    print(f"{program_name} [options] --batch <manifest | input file output file...>  compile several programs")
+    print(f"{program_name} [options] --watch <input file> <output file>  compile again when a source changes")
+    print(f"{program_name} --serve [socket]  compile the requests of ./client.py (default socket: {server_address()})")
+    print(f"    -O<level>     optimization level, -O is -O1 (default: -O0)")
+    print(f"                  -O1: constant folding and propagation, peephole optimization, dead function and table removal")
+    print(f"                  -O2: function inlining, loop rotation, invariant code motion and unrolling")
+    print(f"    --unroll=<n>  unroll factor of the loops with a known trip count (default: {LOOP_UNROLL_FACTOR})")
+    print(f"    --no-inline   do not inline functions, --no-inline=f,g only keeps the calls of f and g")
+    print(f"    --ir          generate the code from the intermediate representation")
+    print(f"    --ssa         put the intermediate representation in SSA form, implies --ir")
+    print(f"    --emit-ir     write the intermediate representation in <output file>.ir, implies --ir")
+    print(f"    --builtin-assembler  encode the instructions and write the executable in process, without fasm")
+    print(f"    --profile     count the calls and the loop iterations and their cycles, printed on stderr at exit")
+    print(f"    --run         run the program from memory instead of writing an executable, with the built-in assembler")
+    print(f"    --no-cache    always generate and assemble, without the build cache")
 
 
 auto_ = 0
@@ -91,14 +149,32 @@ class TokenType(int):
     IMPORT = auto()
     COMMENTS = auto()
     SYSCALL = auto()
+    FLUSH = auto()
     TokenType_NUMBERS = auto()
 
 
+file_table: List[str] = list()
+file_ids: Dict[str, int] = dict()
+
+
+def file_id(file: str) -> int:
+    if file not in file_ids:
+        file_ids[file] = len(file_table)
+        file_table.append(file)
+    return file_ids[file]
+
+
 class Location:
+    __slots__ = ('line', 'col', 'file_id')
+
     def __init__(self, line, col, file):
         self.line = line
         self.col = col
-        self.file = file
+        self.file_id = file_id(file)
+
+    @property
+    def file(self):
+        return file_table[self.file_id]
 
     def __str__(self):
         return f"{self.file}:{self.line}:{self.col}"
@@ -113,8 +189,17 @@ class Location:
             file=self.file,
         )
 
+    def __getstate__(self):
+        return (self.line, self.col, self.file)
+
+    def __setstate__(self, state):
+        self.line, self.col, file = state
+        self.file_id = file_id(file)
+
 
 class Token:
+    __slots__ = ('literal', 'type', 'location')
+
     def __init__(self, literal, type_, location):
         self.literal = literal
         self.type = type_
@@ -135,190 +220,309 @@ class Token:
         )
 
 
+class TokenView:
+    """A token of a TokenStream, its literal and location are only built when asked."""
+    __slots__ = ('tokens', 'index', 'literal_')
+
+    def __init__(self, tokens, index: int, literal=None):
+        self.tokens = tokens
+        self.index = index
+        self.literal_ = literal
+
+    def __reduce__(self):
+        # only a literal that was changed after parsing needs to be stored
+        literal = self.literal_
+        if literal is not None and literal == self.tokens.literal(self.index):
+            literal = None
+        if literal is None:
+            return (TokenView, (self.tokens, self.index))
+        return (TokenView, (self.tokens, self.index, literal))
+
+    @property
+    def literal(self):
+        if self.literal_ is None:
+            self.literal_ = self.tokens.literal(self.index)
+        return self.literal_
+
+    @literal.setter
+    def literal(self, literal):
+        self.literal_ = literal
+
+    @property
+    def type(self):
+        return self.tokens.types[self.index]
+
+    @property
+    def location(self) -> Location:
+        return self.tokens.location(self.index)
+
+    __str__ = Token.__str__
+    __repr__ = Token.__repr__
+    to_dict = Token.to_dict
+
+
+class TokenStream:
+    """Tokens of one file stored as parallel arrays indexed by token number."""
+    def __init__(self, input_file: str, program_string: str):
+        self.program_string = program_string
+        self.file_id = file_id(input_file)
+        self.types = array('B')
+        self.starts = array('I')
+        self.ends = array('I')
+        self.lines = array('I')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['file_id'] = file_table[self.file_id]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.file_id = file_id(state['file_id'])
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, index: int) -> TokenView:
+        if index >= len(self.types):
+            raise IndexError
+        return TokenView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self.types)):
+            yield TokenView(self, index)
+
+    def append(self, type_: int, start: int, end: int, line: int):
+        self.types.append(type_)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.lines.append(line)
+
+    def type(self, index: int) -> int:
+        return self.types[index]
+
+    def literal(self, index: int):
+        start = self.starts[index]
+        end = self.ends[index]
+        type_ = self.types[index]
+        if type_ == TokenType.STRING:
+            return unescape(self.program_string[start + 1:end - 1])
+        if type_ == TokenType.INT and self.program_string[start] == "'":
+            return ord(unescape(self.program_string[start + 1:end - 1]))
+        return self.program_string[start:end]
+
+    def location(self, index: int) -> Location:
+        start = self.starts[index]
+        line_start = self.program_string.rfind('\n', 0, start) + 1
+        return Location(self.lines[index], start - line_start + 1, file_table[self.file_id])
+
+
+KEYWORDS = {
+    'putc': TokenType.PUTC,
+    'if': TokenType.IF,
+    'while': TokenType.WHILE,
+    'return': TokenType.RETURN,
+    'fun': TokenType.FUNCTION,
+    'let': TokenType.LET,
+    'const': TokenType.CONST,
+    'import': TokenType.IMPORT,
+    'syscall': TokenType.SYSCALL,
+    'flush': TokenType.FLUSH,
+}
+
+SYMBOLS = {
+    '<<': TokenType.LEFT_SHIFT,
+    '>>': TokenType.RIGHT_SHIFT,
+    '==': TokenType.EQ,
+    '!=': TokenType.NEQ,
+    '=': TokenType.ASSIGN,
+    '-': TokenType.MINUS,
+    '+': TokenType.ADD,
+    '/': TokenType.DIV,
+    '%': TokenType.MOD,
+    '|': TokenType.BIT_OR,
+    '&': TokenType.BIT_AND,
+    ';': TokenType.SEMICOLON,
+    '(': TokenType.OPEN_PAREN,
+    ')': TokenType.CLOSE_PAREN,
+    '*': TokenType.MULT,
+    '{': TokenType.OPEN_CURLY_BRACKET,
+    '}': TokenType.CLOSE_CURLY_BRACKET,
+    '[': TokenType.OPEN_BRACKET,
+    ']': TokenType.CLOSE_BRACKET,
+    ',': TokenType.COMMA,
+}
+
+ESCAPES = {
+    'n': '\n',
+    't': '\t',
+    '0': '\0',
+    '\\': '\\',
+    '"': '"',
+    "'": "'",
+}
+
+# Whitespace and comments are skipped in the same match as the token that follows them.
+# Longest symbols first so that `<<` wins over `<`.
+TOKEN_REGEX = re.compile(
+    r'(?P<SKIP>(?:\s+|//[^\n]*)*)'
+    r'(?:(?P<STRING>"(?:[^"\\]|\\.)*")'
+    r"|(?P<CHAR>'(?:\\.|[^\\])')"
+    r'|(?P<IDENTIFIER>[A-Za-z_][A-Za-z0-9_]*)'
+    r'|(?P<INT>[0-9][A-Za-z0-9_]*)'
+    r'|(?P<SYMBOL>' + '|'.join(re.escape(symbol) for symbol in sorted(SYMBOLS, key=len, reverse=True)) + r')'
+    r'|(?P<END>\Z)'
+    r'|(?P<ERROR>.))',
+    re.DOTALL)
+
+
+ESCAPE_REGEX = re.compile(r'\\(.)', re.DOTALL)
+
+
+def unescape(literal: str) -> str:
+    if '\\' not in literal:
+        return literal
+    return ESCAPE_REGEX.sub(lambda match: ESCAPES.get(match.group(1), match.group(1)), literal)
+
+
 class Lexer:
     def __init__(self, input_file: str, program_string: str):
         self.program_string = program_string
         self.cursor = 0
         self.line = 1
-        self.cursor_on_line = 1
+        self.line_start = 0  # offset of the first character of the current line
         self.input_file = input_file
 
-    def chop_char(self) -> str:
-        char = self.program_string[self.cursor]
-        self.cursor += 1
-        self.cursor_on_line += 1
-        return char
-
-    def __iter__(self):
-        return self
-
-    def trim_left(self):
-        while self.program_string[self.cursor].isspace():
-            char = self.chop_char()
-            if self.cursor >= len(self.program_string):
-                raise StopIteration
-            if char == '\n':
-                self.line += 1
-                self.cursor_on_line = 1
-
-    def drop_line(self):
-        while self.chop_char() != '\n':
-            if self.cursor >= len(self.program_string):
-                raise StopIteration
-
-    def __next__(self):
-        global debug
-        assert TokenType.TokenType_NUMBERS == 33
-        if debug:
-            print(Location(self.line, self.cursor_on_line, self.input_file))
-        if self.cursor >= len(self.program_string):
-            raise StopIteration
-        self.trim_left()
-
-        if self.program_string[self.cursor] == '/' and self.program_string[self.cursor +1] == '/':
-            self.drop_line()
-        cursor = self.cursor
-        location = Location(self.line, self.cursor_on_line, self.input_file)
-        if self.program_string[cursor] == '"':
-            literal = ""
-            self.chop_char()
-            while self.program_string[self.cursor] != '"':
-                char = self.chop_char()
-                if char == '\\':
-                    escape = self.chop_char()
-                    if escape == 'n':
-                        char = '\n'
-                literal += char
-            self.chop_char()
-            type_ = TokenType.STRING
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == "'":
-            self.chop_char()
-            literal = ord(self.chop_char())
-            self.chop_char()
-            type_ = TokenType.INT
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor].isalpha() or self.program_string[self.cursor] == '_':
-            while self.program_string[self.cursor].isalnum() or self.program_string[self.cursor] == '_':
-                self.chop_char()
-            literal = self.program_string[cursor:self.cursor]
-            type_ = TokenType.IDENTIFIER
-            if literal == 'putc':
-                type_ = TokenType.PUTC
-            elif literal == 'if':
-                type_ = TokenType.IF
-            elif literal == 'while':
-                type_ = TokenType.WHILE
-            elif literal == 'return':
-                type_ = TokenType.RETURN
-            elif literal == 'fun':
-                type_ = TokenType.FUNCTION
-            elif literal == 'let':
-                type_ = TokenType.LET
-            elif literal == 'const':
-                type_ = TokenType.CONST
-            elif literal == 'import':
-                type_ = TokenType.IMPORT
-            elif literal == 'syscall':
-                type_ = TokenType.SYSCALL
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor].isnumeric():
-            while self.program_string[self.cursor].isalnum() or self.program_string[self.cursor] == '_':
-                self.chop_char()
-            literal = self.program_string[cursor:self.cursor]
-            type_ = TokenType.INT
-            return Token(literal, type_, location)
-
-        elif self.program_string[self.cursor] == '!':
-            self.chop_char()
-            if self.program_string[self.cursor] == '=':
-                literal = "!" + self.chop_char()
-                type_ = TokenType.NEQ
-                return Token(literal, type_, location)
-            print(f"{location}:ERROR: `!{self.chop_char()}` is not a valid symbol")
-        elif self.program_string[self.cursor] == '=':
-            if self.cursor + 1 < len(self.program_string) and self.program_string[self.cursor + 1] == '=':
-                literal = self.chop_char() + self.chop_char()
-                type_ = TokenType.EQ
+    def location(self, offset: int) -> Location:
+        return Location(self.line, offset - self.line_start + 1, self.input_file)
+
+    def skip_lines(self, start: int, end: int):
+        newlines = self.program_string.count('\n', start, end)
+        if newlines > 0:
+            self.line += newlines
+            self.line_start = self.program_string.rfind('\n', start, end) + 1
+
+    def tokenize(self) -> TokenStream:
+        assert TokenType.TokenType_NUMBERS == 34
+        tokens = TokenStream(self.input_file, self.program_string)
+        match_token = TOKEN_REGEX.match
+        program_string = self.program_string
+        while True:
+            match = match_token(program_string, self.cursor)
+            kind = match.lastgroup
+            start = match.end('SKIP')
+            if start != self.cursor:
+                self.skip_lines(self.cursor, start)
+            self.cursor = match.end()
+            if kind == 'END':
+                return tokens
+            if debug:
+                print(self.location(start))
+
+            if kind == 'IDENTIFIER':
+                type_ = KEYWORDS.get(match.group(kind), TokenType.IDENTIFIER)
+            elif kind == 'INT':
+                type_ = TokenType.INT
+            elif kind == 'SYMBOL':
+                type_ = SYMBOLS[match.group(kind)]
+            elif kind == 'STRING' or kind == 'CHAR':
+                type_ = TokenType.STRING if kind == 'STRING' else TokenType.INT
+                tokens.append(type_, start, self.cursor, self.line)
+                self.skip_lines(start, self.cursor)
+                continue
             else:
-                literal = self.chop_char()
-                type_ = TokenType.ASSIGN
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == '-':
-            literal = self.chop_char()
-            type_ = TokenType.MINUS
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == '+':
-            literal = self.chop_char()
-            type_ = TokenType.ADD
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == '/':
-            literal = self.chop_char()
-            type_ = TokenType.DIV
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == '%':
-            literal = self.chop_char()
-            type_ = TokenType.MOD
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == '|':
-            literal = self.chop_char()
-            type_ = TokenType.BIT_OR
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == '&':
-            literal = self.chop_char()
-            type_ = TokenType.BIT_AND
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == '<':
-            if self.program_string[self.cursor + 1] == '<':
-                literal = self.chop_char()
-                self.chop_char()
-                type_ = TokenType.LEFT_SHIFT
-                return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == '>':
-            if self.program_string[self.cursor + 1] == '>':
-                literal = self.chop_char()
-                self.chop_char()
-                type_ = TokenType.RIGHT_SHIFT
-                return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == ';':
-            literal = self.chop_char()
-            type_ = TokenType.SEMICOLON
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == '(':
-            literal = self.chop_char()
-            type_ = TokenType.OPEN_PAREN
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == ')':
-            literal = self.chop_char()
-            type_ = TokenType.CLOSE_PAREN
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == '*':
-            literal = self.chop_char()
-            type_ = TokenType.MULT
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == '{':
-            literal = self.chop_char()
-            type_ = TokenType.OPEN_CURLY_BRACKET
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == '}':
-            literal = self.chop_char()
-            type_ = TokenType.CLOSE_CURLY_BRACKET
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == '[':
-            literal = self.chop_char()
-            type_ = TokenType.OPEN_BRACKET
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == ']':
-            literal = self.chop_char()
-            type_ = TokenType.CLOSE_BRACKET
-            return Token(literal, type_, location)
-        elif self.program_string[self.cursor] == ',':
-            literal = self.chop_char()
-            type_ = TokenType.COMMA
-            return Token(literal, type_, location)
-        else:
-            print(self.program_string[self.cursor])
-            todo()
+                literal = match.group(kind)
+                if literal == '"':
+                    print(f"{self.location(start)}:ERROR: the string is not closed")
+                else:
+                    print(f"{self.location(start)}:ERROR: `{literal}` is not a valid symbol")
+                exit(1)
+            tokens.append(type_, start, self.cursor, self.line)
+
+
+# Registers used for the partial results of expressions. rax holds the final result, rcx (shift count),
+# rdx (div) and r10 (table access) are used as scratch registers by the instructions themselves.
+EXPRESSION_REGISTERS = ['rbx', 'rsi', 'rdi', 'r8', 'r9', 'r11', 'r12', 'r13', 'r14', 'r15']
+
+# Calling convention (System V order): the first arguments are passed in ARGUMENT_REGISTERS, the others on
+# the stack with the last one on top. The functions keep the registers of CALLEE_SAVED_REGISTERS and
+# their variables live in a frame under rbp.
+ARGUMENT_REGISTERS = ['rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9']
+SYSCALL_REGISTERS = ['rax', 'rdi', 'rsi', 'rdx', 'r10', 'r8', 'r9']
+CALLEE_SAVED_REGISTERS = ['rbx', 'r12', 'r13', 'r14', 'r15']
+
+BYTE_REGISTERS = {
+    'rax': 'al', 'rbx': 'bl', 'rsi': 'sil', 'rdi': 'dil',
+    'r8': 'r8b', 'r9': 'r9b', 'r11': 'r11b', 'r12': 'r12b', 'r13': 'r13b', 'r14': 'r14b', 'r15': 'r15b',
+}
+
+
+def int_value(literal) -> int | None:
+    if isinstance(literal, int):
+        return literal
+    if literal.isdigit():
+        return int(literal, 10)
+    if literal.startswith('0x'):
+        try:
+            return int(literal, 16)
+        except ValueError:
+            return None
+    return None
+
+
+def is_imm32(literal) -> bool:
+    value = int_value(literal)
+    return value is not None and -(1 << 31) <= value < (1 << 31)
+
+
+def power_of_two(value: int | None) -> int | None:
+    # the shift equivalent to a multiplication or an unsigned division by value
+    if value is None or value <= 0 or value & (value - 1) != 0:
+        return None
+    return value.bit_length() - 1
+
+
+def multiply_by_constant(out_file, target: str, value: int | None) -> bool:
+    """
+    Multiplies target by a constant with shifts and lea (scale 2, 4 or 8 plus the base register)
+    instead of imul, returns False when the constant has no such form.
+    """
+    if value is None:
+        return False
+    shift = power_of_two(value)
+    if shift is not None:
+        if shift != 0:
+            out_file.emit(f"shl {target}, {shift}")
+        return True
+    for scale in (2, 4, 8):
+        shift = power_of_two(value // (scale + 1))
+        if value % (scale + 1) == 0 and shift is not None:
+            out_file.emit(f"lea {target}, [{target}+{target}*{scale}]")
+            if shift != 0:
+                out_file.emit(f"shl {target}, {shift}")
+            return True
+    return False
+
+
+class Registers:
+    """Allocation state of the registers while an expression tree is generated."""
+    def __init__(self):
+        self.free: List[str] = list(EXPRESSION_REGISTERS)
+        self.live: List[str] = list()  # registers holding a partial result, in allocation order
+
+    def allocate(self) -> str | None:
+        if len(self.free) == 0:
+            return None
+        return self.free.pop(0)
+
+    def release(self, register: str):
+        self.free.insert(0, register)
+
+    def hold(self, register: str):
+        self.live.append(register)
+
+    def drop(self, register: str):
+        self.live.remove(register)
 
 
 class AST():
@@ -338,6 +542,118 @@ class AST():
     def generate(self, generator, out_file):
         pass
 
+    # Expressions are generated into any register with generate_into. The default implementation is for
+    # the nodes that can only compute their value in rax and may clobber every register (calls, table
+    # accesses...), the live registers are saved around them.
+
+    def register_need(self) -> int:
+        return 1
+
+    def clobbers_registers(self) -> bool:
+        return True
+
+    def operand(self, generator) -> str | None:
+        # the value as an immediate or memory operand, if it does not need a register
+        return None
+
+    def clobbers(self, register: str) -> bool:
+        return True
+
+    def generate_into(self, generator, out_file, target: str, registers: Registers):
+        saved = [register for register in registers.live if self.clobbers(register)]
+        for register in saved:
+            out_file.emit(f"push {register}")
+        self.generate(generator, out_file)
+        if target != 'rax':
+            out_file.emit(f"mov {target}, rax")
+        for register in reversed(saved):
+            out_file.emit(f"pop {register}")
+
+    # Conditions of if and while jump with branch instead of computing their value.
+
+    def is_boolean(self) -> bool:
+        # whether the value is always 0 or 1
+        return False
+
+    def branch(self, generator, out_file, label: str, when: bool):
+        # jumps to label when the truth of the value is `when`, falls through otherwise
+        self.generate(generator, out_file)
+        out_file.emit(f"cmp rax, 0")
+        out_file.emit(f"{'jne' if when else 'je'} {label}")
+
+
+def apply_operator(out_file, type_: int, target: str, operand: str, registers: Registers):
+    # target = target <op> operand
+    assert TokenType.TokenType_NUMBERS == 34
+    if type_ == TokenType.LEFT_SHIFT or type_ == TokenType.RIGHT_SHIFT:
+        instruction = "shl" if type_ == TokenType.LEFT_SHIFT else "shr"
+        out_file.emit(f"; {'SHL' if instruction == 'shl' else 'SRL'}")
+        if int_value(operand) is not None:
+            out_file.emit(f"{instruction} {target}, {int_value(operand) & 63}")
+        else:
+            out_file.emit(f"mov rcx, {operand}")
+            out_file.emit(f"{instruction} {target}, cl")
+    elif type_ == TokenType.BIT_OR:
+        out_file.emit(f"; B OR")
+        out_file.emit(f"or {target}, {operand}")
+    elif type_ == TokenType.BIT_AND:
+        out_file.emit(f"; B AND")
+        out_file.emit(f"and {target}, {operand}")
+    elif type_ == TokenType.MINUS:
+        out_file.emit(f"; MINUS")
+        out_file.emit(f"sub {target}, {operand}")
+    elif type_ == TokenType.ADD:
+        out_file.emit(f"; ADD")
+        out_file.emit(f"add {target}, {operand}")
+    elif type_ == TokenType.NEQ or type_ == TokenType.EQ:
+        instruction = "setne" if type_ == TokenType.NEQ else "sete"
+        out_file.emit(f"; {'NEQ' if instruction == 'setne' else 'EQ'}")
+        out_file.emit(f"cmp {target}, {operand}")
+        out_file.emit(f"{instruction} {BYTE_REGISTERS[target]}")
+        out_file.emit(f"movzx {target}, {BYTE_REGISTERS[target]}")
+    elif type_ == TokenType.MULT:
+        out_file.emit(f"; MULT")
+        if multiply_by_constant(out_file, target, int_value(operand)):
+            pass
+        elif int_value(operand) is not None:
+            out_file.emit(f"imul {target}, {target}, {operand}")
+        else:
+            out_file.emit(f"imul {target}, {operand}")
+    elif type_ == TokenType.DIV or type_ == TokenType.MOD:
+        out_file.emit(f"; {'DIV' if type_ == TokenType.DIV else 'MOD'}")
+        shift = power_of_two(int_value(operand))
+        if shift is not None and type_ == TokenType.DIV:
+            if shift != 0:
+                out_file.emit(f"shr {target}, {shift}")
+            return
+        if shift is not None and shift < 31:
+            out_file.emit(f"and {target}, {(1 << shift) - 1}")
+            return
+        if int_value(operand) is not None:
+            out_file.emit(f"mov r10, {operand}")
+            operand = 'r10'
+        save_rax = target != 'rax' and 'rax' in registers.live
+        if save_rax:
+            out_file.emit(f"push rax")
+        if target != 'rax':
+            out_file.emit(f"mov rax, {target}")
+        out_file.emit(f"xor rdx, rdx")
+        out_file.emit(f"div {operand}")
+        if type_ == TokenType.MOD:
+            out_file.emit(f"mov {target}, rdx")
+        elif target != 'rax':
+            out_file.emit(f"mov {target}, rax")
+        if save_rax:
+            out_file.emit(f"pop rax")
+
+
+# the jumps taken when a comparison is true and when it is false
+CONDITION_JUMPS = {
+    TokenType.EQ: ('je', 'jne'),
+    TokenType.NEQ: ('jne', 'je'),
+}
+
+
 class BinaryOperator(AST):
     def __init__(self, token: Token, left: AST, right: AST):
         super().__init__(token)
@@ -359,113 +675,98 @@ class BinaryOperator(AST):
             right=rtd,
         )
 
+    def register_need(self) -> int:
+        # Sethi-Ullman number: the registers needed to evaluate the tree without spilling
+        left = self.left.register_need()
+        if self.right.operand(None) is not None:
+            return left
+        right = self.right.register_need()
+        if left == right:
+            return left + 1
+        return max(left, right)
+
+    def clobbers_registers(self) -> bool:
+        return self.left.clobbers_registers() or self.right.clobbers_registers()
+
     def generate(self, generator, out_file):
-        assert TokenType.TokenType_NUMBERS == 33
-        if self.token.type == TokenType.LEFT_SHIFT:
-            self.left.generate(generator, out_file)
-            print(f"push rax", file=out_file)
-            self.right.generate(generator, out_file)
-            print(f"pop rbx", file=out_file)
-            print(f"; SHL", file=out_file)
-            print(f"mov rcx, rax", file=out_file)
-            print(f"mov rax, rbx", file=out_file)
-            print(f"shl rax, cl", file=out_file)
-        elif self.token.type == TokenType.RIGHT_SHIFT:
-            self.left.generate(generator, out_file)
-            print(f"push rax", file=out_file)
-            self.right.generate(generator, out_file)
-            print(f"pop rbx", file=out_file)
-            print(f"; SRL", file=out_file)
-            print(f"mov rcx, rax", file=out_file)
-            print(f"mov rax, rbx", file=out_file)
-            print(f"shr rax, cl", file=out_file)
-        elif self.token.type == TokenType.BIT_OR:
-            self.left.generate(generator, out_file)
-            print(f"push rax", file=out_file)
-            self.right.generate(generator, out_file)
-            print(f"pop rbx", file=out_file)
-            print(f"; B OR", file=out_file)
-            print(f"or rbx, rax", file=out_file)
-            print(f"mov rax, rbx", file=out_file)
-        elif self.token.type == TokenType.BIT_AND:
-            self.left.generate(generator, out_file)
-            print(f"push rax", file=out_file)
-            self.right.generate(generator, out_file)
-            print(f"pop rbx", file=out_file)
-            print(f"; B AND", file=out_file)
-            print(f"and rbx, rax", file=out_file)
-            print(f"mov rax, rbx", file=out_file)
-
-
-        elif self.token.type == TokenType.MINUS:
-            self.left.generate(generator, out_file)
-            print(f"push rax", file=out_file)
-            self.right.generate(generator, out_file)
-            print(f"pop rbx", file=out_file)
-            print(f"; MINUS", file=out_file)
-            print(f"sub rbx, rax", file=out_file)
-            print(f"mov rax, rbx", file=out_file)
-        if self.token.type == TokenType.ADD:
-            self.left.generate(generator, out_file)
-            print(f"push rax", file=out_file)
-            self.right.generate(generator, out_file)
-            print(f"pop rbx", file=out_file)
-            print(f"; ADD", file=out_file)
-            print(f"add rax, rbx", file=out_file)
-        elif self.token.type == TokenType.NEQ:
-            self.left.generate(generator, out_file)
-            print(f"push rax", file=out_file)
-            self.right.generate(generator, out_file)
-            print(f"pop rbx", file=out_file)
-            print(f"; NEQ", file=out_file)
-            print(f"mov rcx, 0", file=out_file)
-            print(f"mov rdx, 1", file=out_file)
-            print(f"cmp rax, rbx", file=out_file)
-            print(f"cmovne rcx, rdx", file=out_file)
-            print(f"mov rax, rcx", file=out_file)
-        elif self.token.type == TokenType.EQ:
-            self.left.generate(generator, out_file)
-            print(f"push rax", file=out_file)
-            self.right.generate(generator, out_file)
-            print(f"pop rbx", file=out_file)
-            print(f"; EQ", file=out_file)
-            print(f"mov rcx, 0", file=out_file)
-            print(f"mov rdx, 1", file=out_file)
-            print(f"cmp rax, rbx", file=out_file)
-            print(f"cmove rcx, rbx", file=out_file)
-            print(f"mov rax, rcx", file=out_file)
-        elif self.token.type == TokenType.MULT:
-            self.left.generate(generator, out_file)
-            print(f"push rax", file=out_file)
-            self.right.generate(generator, out_file)
-            print(f"pop rbx", file=out_file)
-            print(f"; MULT", file=out_file)
-            print(f"mul rbx", file=out_file)
-        elif self.token.type == TokenType.DIV:
-            self.left.generate(generator, out_file)
-            print(f"push rax", file=out_file)
-            self.right.generate(generator, out_file)
-            print(f"pop rbx", file=out_file)
-            print(f"xor rdx, rdx", file=out_file)
-            print(f"mov rcx, rax", file=out_file)
-            print(f"mov rax, rbx", file=out_file)
-            print(f"mov rbx, rcx", file=out_file)
-            print(f"div rbx", file=out_file)
-                
-        elif self.token.type == TokenType.MOD:
-            self.left.generate(generator, out_file)
-            print(f"push rax", file=out_file)
-            self.right.generate(generator, out_file)
-            print(f"pop rbx", file=out_file)
-            print(f"xor rdx, rdx", file=out_file)
-            print(f"mov rcx, rax", file=out_file)
-            print(f"mov rax, rbx", file=out_file)
-            print(f"mov rbx, rcx", file=out_file)
-            print(f"div rbx", file=out_file)
-            print(f"mov rax, rdx", file=out_file)
+        self.generate_into(generator, out_file, 'rax', Registers())
+
+    def generate_into(self, generator, out_file, target: str, registers: Registers, apply=None):
+        # apply(out_file, target, operand, registers) combines the values of the operands
+        if apply is None:
+            apply = self.apply
+        operand = self.right.operand(generator)
+        if operand is not None:
+            self.left.generate_into(generator, out_file, target, registers)
+            apply(out_file, target, operand, registers)
+            return
 
+        other = registers.allocate()
+        if other is None:
+            # out of registers: spill the left value on the stack
+            self.left.generate_into(generator, out_file, target, registers)
+            out_file.emit(f"push {target}")
+            self.right.generate_into(generator, out_file, target, registers)
+            out_file.emit(f"mov r10, {target}")
+            out_file.emit(f"pop {target}")
+            apply(out_file, target, 'r10', registers)
+            return
 
+        # The subtree that needs more registers goes first, evaluation order only changes when
+        # neither side has side effects.
+        right_first = (not self.left.clobbers_registers() and not self.right.clobbers_registers()
+                       and self.right.register_need() > self.left.register_need())
+        if right_first:
+            self.right.generate_into(generator, out_file, other, registers)
+            registers.hold(other)
+            self.left.generate_into(generator, out_file, target, registers)
+            registers.drop(other)
+        else:
+            self.left.generate_into(generator, out_file, target, registers)
+            registers.hold(target)
+            self.right.generate_into(generator, out_file, other, registers)
+            registers.drop(target)
+        apply(out_file, target, other, registers)
+        registers.release(other)
+
+    def is_boolean(self) -> bool:
+        if self.token.type in CONDITION_JUMPS:
+            return True
+        if self.token.type == TokenType.BIT_AND or self.token.type == TokenType.BIT_OR:
+            return self.left.is_boolean() and self.right.is_boolean()
+        return False
+
+    def branch(self, generator, out_file, label: str, when: bool):
+        if self.token.type in CONDITION_JUMPS:
+            # cmp left, right and jump on the flags, without materializing the 0/1 value
+            def compare(out_file, target: str, operand: str, registers: Registers):
+                out_file.emit(f"; {'EQ' if self.token.type == TokenType.EQ else 'NEQ'}")
+                out_file.emit(f"cmp {target}, {operand}")
+            self.generate_into(generator, out_file, 'rax', Registers(), compare)
+            (jump_if_true, jump_if_false) = CONDITION_JUMPS[self.token.type]
+            out_file.emit(f"{jump_if_true if when else jump_if_false} {label}")
+            return
+        # Short-circuit: the right operand is skipped when the left one decides, which is only done
+        # when the right operand has no side effects. a | b is true when one operand is true,
+        # a & b only when both operands are 0 or 1.
+        is_or = self.token.type == TokenType.BIT_OR
+        is_and = self.token.type == TokenType.BIT_AND and self.is_boolean()
+        if (not is_or and not is_and) or self.right.clobbers_registers():
+            super().branch(generator, out_file, label, when)
+            return
+        if when == is_or:
+            # a | b jumps when a is true, a & b does not jump when a is false
+            self.left.branch(generator, out_file, label, when)
+            self.right.branch(generator, out_file, label, when)
+            return
+        skip_label = f".L{generator.label_count}"
+        generator.label_count += 1
+        self.left.branch(generator, out_file, skip_label, not when)
+        self.right.branch(generator, out_file, label, when)
+        out_file.emit(f"{skip_label}:")
 
+    def apply(self, out_file, target: str, operand: str, registers: Registers):
+        apply_operator(out_file, self.token.type, target, operand, registers)
 
 
 class IfNode(AST):
@@ -482,13 +783,11 @@ class IfNode(AST):
         generator.label_count += 1
         end_label = generator.label_count
         generator.label_count += 1
-        print(f"; IF", file=out_file)
-        print(f".L{condition_label}:", file=out_file)
-        self.condition.generate(generator, out_file)
-        print(f"cmp rax, 0", file=out_file)
-        print(f"je .L{end_label}", file=out_file)
+        out_file.emit(f"; IF")
+        out_file.emit(f".L{condition_label}:")
+        self.condition.branch(generator, out_file, f".L{end_label}", False)
         self.body.generate(generator, out_file)
-        print(f".L{end_label}:", file=out_file)
+        out_file.emit(f".L{end_label}:")
 
 
 class WhileNode(AST):
@@ -505,128 +804,538 @@ class WhileNode(AST):
         generator.label_count += 1
         end_label = generator.label_count
         generator.label_count += 1
-        print(f"; WHILE", file=out_file)
-        print(f".L{condition_label}:", file=out_file)
-        self.condition.generate(generator, out_file)
-        print(f"cmp rax, 0", file=out_file)
-        print(f"je .L{end_label}", file=out_file)
-        self.body.generate(generator, out_file)
-        print(f"jmp .L{condition_label}", file=out_file)
-        print(f".L{end_label}:", file=out_file)
+        out_file.emit(f"; WHILE")
+        probe = None
+        if profile:
+            probe = profile_probe(generator, f"{self.token.location}: loop")
+            profile_start(out_file, probe)
+        out_file.emit(f".L{condition_label}:")
+        self.condition.branch(generator, out_file, f".L{end_label}", False)
+        if optimization_level >= 2:
+            # rotated loop: the condition is tested again at the bottom, one branch per iteration
+            body_label = generator.label_count
+            generator.label_count += 1
+            out_file.emit(f".L{body_label}:")
+            self.body.generate(generator, out_file)
+            if probe is not None:
+                profile_iteration(out_file, probe)
+            self.condition.branch(generator, out_file, f".L{body_label}", True)
+        else:
+            self.body.generate(generator, out_file)
+            if probe is not None:
+                profile_iteration(out_file, probe)
+            out_file.emit(f"jmp .L{condition_label}")
+        out_file.emit(f".L{end_label}:")
+
+
+def profile_probe(generator, description: str) -> int:
+    # the index of the counters of a new probe, its description is printed at exit
+    generator.probes.append(description)
+    return len(generator.probes) - 1
+
+
+def profile_timestamp(out_file):
+    # the time stamp counter in rax, rdx is overwritten
+    out_file.emit("rdtsc")
+    out_file.emit("shl rdx, 32")
+    out_file.emit("or rax, rdx")
+
+
+def profile_start(out_file, probe: int):
+    profile_timestamp(out_file)
+    out_file.emit(f"mov qword [profile_state+{8 * probe}], rax")
+
+
+def profile_iteration(out_file, probe: int):
+    # on the back edge: one more iteration, and the cycles since the previous one (or the start of the loop)
+    profile_timestamp(out_file)
+    out_file.emit("mov rdx, rax")
+    out_file.emit(f"sub rax, qword [profile_state+{8 * probe}]")
+    out_file.emit(f"add qword [profile_cycles+{8 * probe}], rax")
+    out_file.emit(f"mov qword [profile_state+{8 * probe}], rdx")
+    out_file.emit(f"add qword [profile_counts+{8 * probe}], 1")
+
+
+def profile_enter(generator, out_file, probe: int):
+    # a function accumulates minus its entry time and plus its exit time, only at the outermost of recursive calls
+    label = generator.label_count
+    generator.label_count += 1
+    out_file.emit(f"add qword [profile_counts+{8 * probe}], 1")
+    out_file.emit(f"add qword [profile_state+{8 * probe}], 1")
+    out_file.emit(f"cmp qword [profile_state+{8 * probe}], 1")
+    out_file.emit(f"jne .L{label}")
+    profile_timestamp(out_file)
+    out_file.emit(f"sub qword [profile_cycles+{8 * probe}], rax")
+    out_file.emit(f".L{label}:")
+
+
+def profile_leave(generator, out_file, probe: int):
+    # rax holds the returned value
+    label = generator.label_count
+    generator.label_count += 1
+    out_file.emit(f"sub qword [profile_state+{8 * probe}], 1")
+    out_file.emit(f"jnz .L{label}")
+    out_file.emit("mov r10, rax")
+    profile_timestamp(out_file)
+    out_file.emit(f"add qword [profile_cycles+{8 * probe}], rax")
+    out_file.emit("mov rax, r10")
+    out_file.emit(f".L{label}:")
+
+
+def profile_dump(generator, out_file):
+    # one line per probe on stderr: count, cycles and location
+    out_file.emit("; PROFILE")
+    out_file.emit("lea rsi, [profile_header]")
+    out_file.emit(f"mov rdx, {len(PROFILE_HEADER)}")
+    out_file.emit("call RUNTIME_profile_write")
+    for probe, description in enumerate(generator.probes):
+        out_file.emit(f"mov rax, qword [profile_counts+{8 * probe}]")
+        out_file.emit("call RUNTIME_profile_number")
+        out_file.emit(f"mov rax, qword [profile_cycles+{8 * probe}]")
+        out_file.emit("call RUNTIME_profile_number")
+        out_file.emit(f"lea rsi, [profile_probe_{probe}]")
+        out_file.emit(f"mov rdx, {len(description.encode()) + 1}")
+        out_file.emit("call RUNTIME_profile_write")
+
+
+def putc_buffer_size() -> int:
+    # In unbuffered mode the buffer only holds one character, so every putc is flushed.
+    if unbuffered:
+        return 8
+    return PUTC_BUFFER_SIZE
+
+
+def generate_runtime(out_file):
+    # putc appends rax to putc_buffer and flushes it when it is full.
+    out_file.emit("; RUNTIME")
+    out_file.emit("RUNTIME_putc:")
+    out_file.emit("mov rcx, qword [putc_buffer_length]")
+    out_file.emit("mov qword [putc_buffer+rcx], rax")
+    out_file.emit("add rcx, 8")
+    out_file.emit("mov qword [putc_buffer_length], rcx")
+    out_file.emit(f"cmp rcx, {putc_buffer_size()}")
+    out_file.emit("jb .L_putc_end")
+    out_file.emit("call RUNTIME_flush")
+    out_file.emit(".L_putc_end:")
+    out_file.emit("ret")
+
+    # flush writes the pending bytes of putc_buffer to stdout. A write can be short (pipes, sockets): it is
+    # repeated with the rest of the buffer until everything is written or it fails.
+    out_file.emit("RUNTIME_flush:")
+    out_file.emit("mov rdx, qword [putc_buffer_length]")
+    out_file.emit("lea rsi, [putc_buffer]")
+    out_file.emit(".L_flush_write:")
+    out_file.emit("cmp rdx, 0")
+    out_file.emit("jle .L_flush_end")
+    out_file.emit("mov rdi, 1")
+    out_file.emit("mov rax, 1")
+    out_file.emit("syscall")
+    out_file.emit("cmp rax, 0")
+    out_file.emit("jle .L_flush_end")
+    out_file.emit("add rsi, rax")
+    out_file.emit("sub rdx, rax")
+    out_file.emit("jmp .L_flush_write")
+    out_file.emit(".L_flush_end:")
+    out_file.emit("mov qword [putc_buffer_length], 0")
+    out_file.emit("ret")
+
+    if not profile:
+        return
+    # profile_write writes rdx bytes from rsi to stderr.
+    out_file.emit("RUNTIME_profile_write:")
+    out_file.emit("mov rdi, 2")
+    out_file.emit("mov rax, 1")
+    out_file.emit("syscall")
+    out_file.emit("ret")
+
+    # profile_number writes rax in decimal to stderr, followed by a space.
+    out_file.emit("RUNTIME_profile_number:")
+    out_file.emit(f"lea rsi, [profile_number+{PROFILE_NUMBER_SIZE - 1}]")
+    out_file.emit("mov byte [rsi], 32")
+    out_file.emit("mov rcx, 10")
+    out_file.emit(".L_profile_digit:")
+    out_file.emit("sub rsi, 1")
+    out_file.emit("xor rdx, rdx")
+    out_file.emit("div rcx")
+    out_file.emit("add dl, 48")
+    out_file.emit("mov byte [rsi], dl")
+    out_file.emit("test rax, rax")
+    out_file.emit("jnz .L_profile_digit")
+    out_file.emit(f"lea rdx, [profile_number+{PROFILE_NUMBER_SIZE}]")
+    out_file.emit("sub rdx, rsi")
+    out_file.emit("jmp RUNTIME_profile_write")
+
+
+REGISTER_FAMILIES = {
+    'rax': ['rax', 'eax', 'ax', 'al', 'ah'],
+    'rbx': ['rbx', 'ebx', 'bx', 'bl', 'bh'],
+    'rcx': ['rcx', 'ecx', 'cx', 'cl', 'ch'],
+    'rdx': ['rdx', 'edx', 'dx', 'dl', 'dh'],
+    'rsi': ['rsi', 'esi', 'si', 'sil'],
+    'rdi': ['rdi', 'edi', 'di', 'dil'],
+    'rbp': ['rbp', 'ebp', 'bp', 'bpl'],
+    'rsp': ['rsp', 'esp', 'sp', 'spl'],
+}
+for number in range(8, 16):
+    REGISTER_FAMILIES[f'r{number}'] = [f'r{number}', f'r{number}d', f'r{number}w', f'r{number}b']
+REGISTER_FAMILY = {name: family for family, names in REGISTER_FAMILIES.items() for name in names}
+
+
+def register_family(operand: str) -> str | None:
+    return REGISTER_FAMILY.get(operand)
+
+
+def mentions_register(operand: str, family: str) -> bool:
+    return any(REGISTER_FAMILY.get(word) == family for word in re.findall(r'\w+', operand))
+
+
+def is_memory(operand: str) -> bool:
+    return '[' in operand
+
+
+class Instruction:
+    """
+    One line of the text segment. Comments and blank lines have no opcode, labels have the opcode `:`.
+    """
+    __slots__ = ('line', 'opcode', 'operands')
+
+    def __init__(self, line: str):
+        self.line = line
+        text = line.split(';', 1)[0].strip()
+        self.opcode = None
+        self.operands = list()
+        if text.endswith(':'):
+            self.opcode = ':'
+            self.operands = [text[:-1]]
+        elif text != '':
+            (self.opcode, _, operands) = text.partition(' ')
+            if operands.strip() != '':
+                self.operands = [operand.strip() for operand in operands.split(',')]
+
+    @staticmethod
+    def make(opcode: str, *operands: str) -> 'Instruction':
+        if opcode == ':':
+            return Instruction(f"{operands[0]}:")
+        return Instruction(f"{opcode} {', '.join(operands)}")
+
+    def is_(self, opcode: str, operand_count: int) -> bool:
+        return self.opcode == opcode and len(self.operands) == operand_count
+
+
+class PeepholeRule:
+    """
+    A rewrite of `size` consecutive instructions (comments are skipped).
+    `match` returns the replacing instructions, or None when the rule does not apply.
+    """
+    def __init__(self, name: str, size: int, match):
+        self.name = name
+        self.size = size
+        self.match = match
+
+
+def peephole_push_pop(window: List[Instruction]) -> List[Instruction] | None:
+    # push X / pop Y -> mov Y, X
+    (push, pop) = window
+    if not push.is_('push', 1) or not pop.is_('pop', 1):
+        return None
+    (source, target) = (push.operands[0], pop.operands[0])
+    if source == target:
+        return []
+    if is_memory(source) and is_memory(target):
+        return None
+    return [Instruction.make('mov', target, source)]
+
+
+def peephole_move_back(window: List[Instruction]) -> List[Instruction] | None:
+    # mov A, B / mov B, A -> mov A, B
+    (first, second) = window
+    if not first.is_('mov', 2) or not second.is_('mov', 2):
+        return None
+    (a, b) = first.operands
+    if second.operands != [b, a]:
+        return None
+    for (operand, other) in ((a, b), (b, a)):
+        family = register_family(operand)
+        if family is not None and mentions_register(other, family):
+            return None
+    return [first]
+
+
+def peephole_store_load(window: List[Instruction]) -> List[Instruction] | None:
+    # mov M, A / mov B, M -> mov M, A / mov B, A
+    (store, load) = window
+    if not store.is_('mov', 2) or not load.is_('mov', 2):
+        return None
+    (memory, source) = store.operands
+    (target, loaded) = load.operands
+    if not is_memory(memory) or loaded != memory or source == target:
+        return None
+    if source not in REGISTER_FAMILIES or target not in REGISTER_FAMILIES:
+        return None
+    return [store, Instruction.make('mov', target, source)]
+
+
+def peephole_self_move(window: List[Instruction]) -> List[Instruction] | None:
+    # mov A, A with a 64 bits register does nothing
+    (move,) = window
+    if move.is_('mov', 2) and move.operands[0] == move.operands[1] and move.operands[0] in REGISTER_FAMILIES:
+        return []
+    return None
+
+
+def peephole_dead_store(window: List[Instruction]) -> List[Instruction] | None:
+    # a register written and then overwritten before being read
+    (first, second) = window
+    if first.opcode not in ('mov', 'lea', 'movzx') or len(first.operands) != 2:
+        return None
+    family = register_family(first.operands[0])
+    if family is None or family == 'rsp':
+        return None
+    if second.is_('pop', 1):
+        sources = []
+    elif second.opcode in ('mov', 'lea', 'movzx') and len(second.operands) == 2:
+        sources = second.operands[1:]
+    else:
+        return None
+    if second.operands[0] != family:  # only a 64 bits destination overwrites the whole register
+        return None
+    if any(mentions_register(source, family) for source in sources):
+        return None
+    return [second]
+
+
+def peephole_jump_to_next(window: List[Instruction]) -> List[Instruction] | None:
+    # jmp L / L: -> L:
+    (jump, label) = window
+    if jump.is_('jmp', 1) and label.opcode == ':' and jump.operands[0] == label.operands[0]:
+        return [label]
+    return None
+
+
+PEEPHOLE_RULES: List[PeepholeRule] = [
+    PeepholeRule("push_pop", 2, peephole_push_pop),
+    PeepholeRule("move_back", 2, peephole_move_back),
+    PeepholeRule("store_load", 2, peephole_store_load),
+    PeepholeRule("self_move", 1, peephole_self_move),
+    PeepholeRule("dead_store", 2, peephole_dead_store),
+    PeepholeRule("jump_to_next", 2, peephole_jump_to_next),
+]
+
+
+def peephole_window(out: List[Instruction], size: int) -> List[int]:
+    # indices of the last `size` instructions of `out` (fewer at the beginning), ignoring comments
+    indices = list()
+    i = len(out) - 1
+    while i >= 0 and len(indices) < size:
+        if out[i].opcode is not None:
+            indices.append(i)
+        i -= 1
+    indices.reverse()
+    return indices
+
+
+def peephole(code: str, rules: List[PeepholeRule] = PEEPHOLE_RULES) -> str:
+    """
+    Rewrites the text segment with the rules. Every instruction is pushed on `out` and the rules are
+    matched against the tail of `out` until none applies, so that a rewrite can enable the previous ones.
+    """
+    applied = {rule.name: 0 for rule in rules}
+    removed = {rule.name: 0 for rule in rules}
+    out: List[Instruction] = list()
+    size = max(rule.size for rule in rules)
+    for line in code.splitlines():
+        out.append(Instruction(line))
+        if out[-1].opcode is None:
+            continue
+        changed = True
+        while changed:
+            changed = False
+            window = peephole_window(out, size)
+            for rule in rules:
+                indices = window[len(window) - rule.size:]
+                if len(indices) < rule.size:
+                    continue
+                replacement = rule.match([out[i] for i in indices])
+                if replacement is None:
+                    continue
+                for i in reversed(indices):
+                    del out[i]
+                out += replacement
+                applied[rule.name] += 1
+                removed[rule.name] += rule.size - len(replacement)
+                changed = True
+                break
+    for name in removed:
+        print_info(f"peephole: {name} applied {applied[name]} times, removed {removed[name]} instructions")
+    return "\n".join(instruction.line for instruction in out) + "\n"
+
+
+class Emitter(ABC):
+    """
+    Collects the lines of the text segment in memory, the assembly file is then written with a single write.
+    The subclasses are the dialects of the assemblers.
+    """
+    entry = "start"
+    statement_labels = False  # a label before each top level statement
+
+    def __init__(self):
+        self.lines: List[str] = list()
+
+    def emit(self, line: str):
+        self.lines.append(line)
+
+    def buffer(self) -> 'Emitter':
+        # for the code generated before the code that goes in front of it (function prologues)
+        return type(self)()
+
+    def extend(self, other: 'Emitter'):
+        self.lines += other.lines
+
+    def words(self) -> set[str]:
+        return set(re.findall(r'\w+', "\n".join(self.lines)))
+
+    def text(self) -> str:
+        return "\n".join(self.lines) + "\n"
 
+    @abstractmethod
+    def text_header(self) -> List[str]:
+        pass
 
-class Generator_NASM:
-    def __init__(self, statements: List[AST], out_file_name="foo.asm"):
-        self.out_file = None
-        self.constants: Dict[str, str]  = dict()
-        self.statements = statements
-        self.table_list: Dict[str, str] = dict()
-        self.table_length: Dict[str, TableElement] = dict()
-        self.variables: Dict[str, str]  = dict()
-        self.functions: Dict[str, str]  = dict()
-        self.out_file_name = out_file_name
-        self.memory_depth = 0
-        self.label_count = 0
+    @abstractmethod
+    def data_header(self) -> List[str]:
+        pass
 
-    def generate(self):
-        out_file = open(self.out_file_name, "w")
-        # Allocate static memory to do operations
-
-        print("BITS 64", file=out_file)
-        print("section .text", file=out_file)
-        print("    global _start", file=out_file)
-        for i, statement in enumerate(self.statements):
-            if i != 0:
-                print(f".l{i}:", file=out_file)
-            statement.generate(self, out_file)
-
-        print("; STOP", file=out_file)
-        print("mov rax, 60", file=out_file)
-        print("xor rdi, rdi", file=out_file)
-        print("syscall", file=out_file)
-
-        print("section .data", file=out_file)
-        for table in self.table_list:
-            if self.table_length[table].elements is None:
-                print(f"{self.table_list[table].removeprefix('[').removesuffix(']')} times {self.table_length[table].length} * 8 {self.table_length[table].data_length} 0", file=out_file)
+    @abstractmethod
+    def reserve(self, name: str, size: str) -> str:
+        # size bytes set to 0
+        pass
+
+    @abstractmethod
+    def reserve_table(self, name: str, element: 'TableElement') -> str:
+        pass
 
+    def data(self, name: str, directive: str, elements: List[str]) -> str:
+        return f"{name} {directive} {','.join(str(element) for element in elements)}"
+
+    def data_segment(self, generator) -> List[str]:
+        lines = self.data_header()
+        for table, element in generator.table_length.items():
+            name = generator.table_list[table].removeprefix('[').removesuffix(']')
+            if element.elements is None:
+                lines.append(self.reserve_table(name, element))
             else:
-                print(f"{self.table_list[table].removeprefix('[').removesuffix(']')} {self.table_length[table].data_length} ", end="", file=out_file)
-                assert(self.table_length[table].elements is not None)
-                for idx, data in enumerate(self.table_length[table].elements):
-                    if idx != 0:
-                        print(",", end="", file=out_file)
-                    print(data, end="", file=out_file)
-                print("", file=out_file)
-        print(f"fstack times {8 << MAX_ARGS} db 0", file=out_file)
-        print(f"mem times {STATIC_MEMORY_SIZE} db 0", file=out_file)
-        out_file.close()
+                lines.append(self.data(name, element.data_length, element.elements))
+        for idx, string in enumerate(strings):
+            lines.append(self.data(f"string_{idx}", "db", [char.literal for char in string] or ["0"]))
+        lines.append(self.reserve("putc_buffer", str(putc_buffer_size())))
+        lines.append("putc_buffer_length dq 0")
+        lines.append(self.reserve("mem", str(max(generator.memory_depth, 8))))
+        if profile:
+            # profile_state: the start of the current iteration of a loop, the recursion depth of a function
+            for name in ("profile_counts", "profile_cycles", "profile_state"):
+                lines.append(self.reserve(name, str(max(8 * len(generator.probes), 8))))
+            lines.append(self.reserve("profile_number", str(PROFILE_NUMBER_SIZE)))
+            lines.append(self.data("profile_header", "db", list(PROFILE_HEADER.encode())))
+            for probe, description in enumerate(generator.probes):
+                lines.append(self.data(f"profile_probe_{probe}", "db", list(description.encode()) + [10]))
+        return lines
 
-    def deepcopy(self):
-        statements = copy.deepcopy(self.statements)
-        out_file_name = copy.deepcopy(self.out_file_name)
+    def write(self, file_name: str, text: str, data: List[str]):
+        with open(file_name, "w") as out_file:
+            out_file.write(text + "\n".join(data) + "\n")
 
-        gen = Generator_NASM(statements, out_file_name)
-        gen.functions = copy.deepcopy(self.functions)
-        gen.memory_depth = copy.deepcopy(self.memory_depth)
-        gen.label_count = copy.deepcopy(self.label_count)
 
-        return gen
+class FasmEmitter(Emitter):
+    def text_header(self) -> List[str]:
+        return ["format ELF64 executable", "segment readable executable", f"    entry {self.entry}"]
+
+    def data_header(self) -> List[str]:
+        return ["segment readable writable"]
+
+    def reserve(self, name: str, size: str) -> str:
+        return f"{name} rb {size}"
+
+    def reserve_table(self, name: str, element: 'TableElement') -> str:
+        return f"{name} {element.data_length} {element.length} * 8  dup(0)"
 
 
+class NasmEmitter(Emitter):
+    entry = "_start"
+    statement_labels = True
 
+    def text_header(self) -> List[str]:
+        return ["BITS 64", "section .text", f"    global {self.entry}"]
 
-class Generator_FASM:
-    def __init__(self, statements: List[AST], out_file_name="foo.asm"):
-        self.out_file = None
+    def data_header(self) -> List[str]:
+        return ["section .data"]
+
+    def reserve(self, name: str, size: str) -> str:
+        return f"{name} times {size} db 0"
+
+    def reserve_table(self, name: str, element: 'TableElement') -> str:
+        return f"{name} times {element.length} * 8 {element.data_length} 0"
+
+
+class Generator:
+    def __init__(self, statements: List[AST], out_file_name="foo.asm", emitter: type[Emitter] = FasmEmitter):
+        self.emitter = emitter
         self.constants: Dict[str, str]  = dict()
         self.statements = statements
         self.table_list: Dict[str, str] = dict()
         self.table_length: Dict[str, TableElement] = dict()
         self.variables: Dict[str, str]  = dict()
         self.functions: Dict[str, str]  = dict()
+        self.imports: set[str] = set()
         self.out_file_name = out_file_name
         self.memory_depth = 0
         self.label_count = 0
+        self.frames: Dict[str, Frame] = dict()
+        self.frame: Optional[Frame] = None
+        self.return_label: Optional[str] = None
+        self.inlined: List[str] = list()  # end labels of the InlineNodes being generated
+        self.probes: List[str] = list()  # descriptions of the counters of --profile, by index
+        self.main_probe: Optional[int] = None
+        self.code = ""  # the text segment, then the lines of the data segment, once generated
+        self.data: List[str] = list()
 
     def generate(self):
-        out_file = open(self.out_file_name, "w")
-        # Allocate static memory to do operations
-
-        print("format ELF64 executable", file=out_file)
-        print("segment readable executable", file=out_file)
-        print("    entry start", file=out_file)
-        for i, statement in enumerate(self.statements):
-            statement.generate(self, out_file)
-
-        print("; STOP", file=out_file)
-        print("mov rax, 60", file=out_file)
-        print("xor rdi, rdi", file=out_file)
-        print("syscall", file=out_file)
-
-        print("segment readable writable", file=out_file)
-
-
-        for table in self.table_list:
-            if self.table_length[table].elements is None:
-                print(f"{self.table_list[table].removeprefix('[').removesuffix(']')} {self.table_length[table].data_length} {self.table_length[table].length} * 8  dup(0)", file=out_file)
-            else:
-                print(f"{self.table_list[table].removeprefix('[').removesuffix(']')} {self.table_length[table].data_length} ", end="", file=out_file)
-                assert(self.table_length[table].elements is not None)
-                for idx, data in enumerate(self.table_length[table].elements):
-                    if idx != 0:
-                        print(",", end="", file=out_file)
-                    print(data, end="", file=out_file)
-                print("", file=out_file)
-        print(f"fstack rb {8 << MAX_ARGS}", file=out_file)
-        print(f"mem rb {STATIC_MEMORY_SIZE}", file=out_file)
-        out_file.close()
+        out_file = self.emitter()
+        for line in out_file.text_header():
+            out_file.emit(line)
+        if use_ir:
+            generate_ir_program(self, out_file)
+        else:
+            self.frames, self.memory_depth = allocate_frames(self.statements)
+            for i, statement in enumerate(self.statements):
+                if i != 0 and out_file.statement_labels:
+                    out_file.emit(f".l{i}:")
+                statement.generate(self, out_file)
+
+        out_file.emit("; STOP")
+        out_file.emit("call RUNTIME_flush")
+        if profile:
+            if self.main_probe is not None:
+                profile_leave(self, out_file, self.main_probe)
+            profile_dump(self, out_file)
+        out_file.emit("mov rax, 60")
+        out_file.emit("xor rdi, rdi")
+        out_file.emit("syscall")
+        generate_runtime(out_file)
+
+        self.code = out_file.text()
+        if optimization_level >= 1:
+            self.code = peephole(self.code)
+        print_info(f"static memory high-water mark: {self.memory_depth} bytes")
+        self.data = out_file.data_segment(self)
+
+    def write(self):
+        self.emitter().write(self.out_file_name, self.code, self.data)
 
     def deepcopy(self):
         statements = copy.deepcopy(self.statements)
         out_file_name = copy.deepcopy(self.out_file_name)
 
-        gen = Generator_FASM(statements, out_file_name)
+        gen = Generator(statements, out_file_name, self.emitter)
         gen.functions = copy.deepcopy(self.functions)
         gen.memory_depth = copy.deepcopy(self.memory_depth)
         gen.label_count = copy.deepcopy(self.label_count)
@@ -634,7 +1343,6 @@ class Generator_FASM:
         return gen
 
 
-
 class FunctionNode(AST):
     def __init__(self, token: Token, arguments: List[Token],
                  body: AST, name: Token):
@@ -655,43 +1363,68 @@ class FunctionNode(AST):
             print(f"{self.token.location}: ERROR: this token already exists. This is a variable.")
         asm_func_name = f"FUNC_{function_name}"
         if function_name == 'main':
-            if debug: 
-                asm_func_name = "_start"
-            else:
-                asm_func_name = "start"
+            asm_func_name = out_file.entry
         generator.functions[function_name] = asm_func_name
 
         new_gen = generator
 
         if function_name != 'main':
-            if debug:
-                new_gen = Generator_NASM(generator.statements)
-            else:
-                new_gen = Generator_FASM(generator.statements)
+            new_gen = Generator(generator.statements, generator.out_file_name, generator.emitter)
             new_gen.memory_depth = generator.memory_depth
             new_gen.functions = generator.functions
+            new_gen.imports = generator.imports
             new_gen.label_count = generator.label_count
             new_gen.table_list = generator.table_list
             new_gen.table_length = generator.table_length
+            new_gen.return_label = f".{asm_func_name}_return"
+            new_gen.probes = generator.probes
+        new_gen.frame = generator.frames.get(function_name)
 
-        print(f"{asm_func_name}:", file=out_file)
-
-        function_stack = 0
-        for arg in self.arguments:
+        # the body is generated first: the prologue saves the callee saved registers it uses
+        body = out_file.buffer()
+        for idx, arg in enumerate(self.arguments):
             identifier = arg.literal
-
-            new_gen.variables[identifier] = f"[mem+{new_gen.memory_depth}]"
-            print(f"mov r10, qword [fstack+{function_stack}]", file=out_file)
-            print(f"mov qword {new_gen.variables[identifier]}, r10", file=out_file)
-
-            new_gen.memory_deptength= 8
-            function_stack += 8
-
-        self.body.generate(new_gen, out_file)
-        if function_name != 'main':
-            print(f"ret", file=out_file)
+            new_gen.variables[identifier] = variable_slot(new_gen, identifier)
+            if function_name == 'main':
+                body.emit(f"mov qword {new_gen.variables[identifier]}, 0")  # main is not called
+            elif idx < len(ARGUMENT_REGISTERS):
+                body.emit(f"mov qword {new_gen.variables[identifier]}, {ARGUMENT_REGISTERS[idx]}")
+            else:
+                body.emit(f"mov r10, qword {stack_argument(idx, len(self.arguments))}")
+                body.emit(f"mov qword {new_gen.variables[identifier]}, r10")
+        probe = None
+        if profile:
+            # after the arguments are stored: rdtsc overwrites rdx
+            probe = profile_probe(generator, f"{self.token.location}: function {function_name}")
+            profile_enter(new_gen, body, probe)
+            if function_name == 'main':
+                generator.main_probe = probe  # main ends at the exit of the program
+        self.body.generate(new_gen, body)
+
+        out_file.emit(f"{asm_func_name}:")
+        if function_name == 'main':
+            out_file.extend(body)
+        else:
+            words = body.words()
+            saved = [register for register in CALLEE_SAVED_REGISTERS
+                     if not words.isdisjoint(REGISTER_FAMILIES[register])]
+            out_file.emit("push rbp")
+            out_file.emit("mov rbp, rsp")
+            if new_gen.frame.size > 0:
+                out_file.emit(f"sub rsp, {new_gen.frame.size}")
+            for register in saved:
+                out_file.emit(f"push {register}")
+            out_file.extend(body)
+            out_file.emit(f"{new_gen.return_label}:")
+            if probe is not None:
+                profile_leave(new_gen, out_file, probe)
+            for register in reversed(saved):
+                out_file.emit(f"pop {register}")
+            out_file.emit("leave")
+            out_file.emit("ret")
+        new_gen.frame = None
         generator.label_count = new_gen.label_count
-        generator.memory_depth = new_gen.memory_depth  # TODO optimize memory
+        generator.memory_depth = new_gen.memory_depth
         generator.table_list = new_gen.table_list # TODO optimize memory
         generator.table_length = new_gen.table_length # TODO optimize memory
 
@@ -704,17 +1437,18 @@ class FunctionCall(AST):
     def to_dict(self):
         return dict(arguments=[a.to_dict() for a in self.arguments])
 
+    def clobbers(self, register: str) -> bool:
+        return register not in CALLEE_SAVED_REGISTERS
+
     def generate(self, generator, out_file):
         identifier = self.token.literal
-        function_stack = 0
         if identifier not in generator.functions:
             print(f"{self.token.location}: ERROR: no function named `{identifier}`")
             exit(1)
-        for arg in self.arguments:
-            arg.generate(generator, out_file)
-            print(f"mov qword [fstack+{function_stack}], rax", file=out_file)
-            function_stack += 8  # TODO 8 = sizeof int
-        print(f"call {generator.functions[identifier]}", file=out_file)
+        stack = pass_arguments(generator, out_file, self.arguments, ARGUMENT_REGISTERS)
+        out_file.emit(f"call {generator.functions[identifier]}")
+        if stack > 0:
+            out_file.emit(f"add rsp, {stack}")
 
 class SystemCall(AST):
     def __init__(self, token: Token, arguments: List[AST]):
@@ -724,32 +1458,54 @@ class SystemCall(AST):
     def to_dict(self):
         return dict(arguments=[a.to_dict() for a in self.arguments])
 
+    def clobbers(self, register: str) -> bool:
+        # RUNTIME_flush and syscall keep the callee saved registers
+        return register not in CALLEE_SAVED_REGISTERS
+
     def generate(self, generator, out_file):
         # TODO make shure the syscall is legal (args == syscall number)
-        function_stack = 0
-        for arg in self.arguments:
-            arg.generate(generator, out_file)
-            print(f"mov qword [fstack+{function_stack}], rax", file=out_file)
-            function_stack += 8  # TODO 8 = sizeof int
         if len(self.arguments) < 1:
             print(f"{self.token.location}: ERROR: Not enought arguments for syscall")
-        print(f"mov rax, qword [fstack]", file=out_file)
-        if len(self.arguments) > 1:
-            print(f"mov rdi, qword [fstack+8]", file=out_file)
-        if len(self.arguments) > 2:
-            print(f"mov rsi, qword [fstack+16]", file=out_file)
-        if len(self.arguments) > 3:
-            print(f"mov rdx, qword [fstack+24]", file=out_file)
-        if len(self.arguments) > 4:
-            print(f"mov r10, qword [fstack+32]", file=out_file)
-        if len(self.arguments) > 5:
-            print(f"mov r8, qword [fstack+40]", file=out_file)
-        if len(self.arguments) > 6:
-            print(f"mov r9, qword [fstack+48]", file=out_file)
-        if len(self.arguments) > 7:
-            print(f"{self.token.location}: ERROR: Too many arguments for syscall")
-
-        print(f"syscall", file=out_file)
+        if len(self.arguments) > len(SYSCALL_REGISTERS):
+            print(f"{self.token.location}: ERROR: Too many arguments for syscall", file=sys.stderr)
+            exit(1)
+        # the flush keeps putc output ordered with the syscall
+        stack = pass_arguments(generator, out_file, self.arguments, SYSCALL_REGISTERS,
+                               lambda: out_file.emit(f"call RUNTIME_flush"))
+        out_file.emit(f"syscall")
+        if stack > 0:
+            out_file.emit(f"add rsp, {stack}")
+
+
+def stack_argument(idx: int, count: int) -> str:
+    # the arguments after ARGUMENT_REGISTERS, above the saved rbp and the return address
+    return f"[rbp+{16 + 8 * (count - 1 - idx)}]"
+
+
+def pass_arguments(generator, out_file, arguments: List[AST], registers: List[str], before_load=None) -> int:
+    """
+    Evaluates the arguments in order and loads the first ones in registers, the others stay on the stack.
+    The immediate and memory operands are loaded last when no argument has side effects.
+    Returns the size of the arguments left on the stack, for the caller to remove after the call.
+    """
+    deferred = len(arguments) <= len(registers) and not any(arg.clobbers_registers() for arg in arguments)
+    operands = [arg.operand(generator) if deferred else None for arg in arguments]
+    pushed = [idx for idx, operand in enumerate(operands) if operand is None]
+    for idx in pushed:
+        arguments[idx].generate(generator, out_file)
+        out_file.emit("push rax")
+    if before_load is not None:
+        before_load()
+    if len(arguments) > len(registers):
+        for idx, register in enumerate(registers):
+            out_file.emit(f"mov {register}, qword [rsp+{8 * (len(arguments) - 1 - idx)}]")
+        return 8 * len(arguments)
+    for idx in reversed(pushed):
+        out_file.emit(f"pop {registers[idx]}")
+    for idx, operand in enumerate(operands):
+        if operand is not None:
+            out_file.emit(f"mov {registers[idx]}, {operand}")
+    return 0
 
 
 class BlockNode(AST):
@@ -782,22 +1538,26 @@ class AssignNode(AST):
             exit(1)
         if identifier in generator.variables:
             if generator.variables[identifier] is None:
-                generator.variables[identifier] = f"[mem+{generator.memory_depth}]"
-                generator.memory_depth += 8
+                generator.variables[identifier] = variable_slot(generator, identifier)
             var_to_print = generator.variables[identifier]
         elif identifier in generator.table_list:
             var_to_print = None 
         else:
             print(f"{self.token.location}: ERROR: unknown word `{identifier}`.")
             exit(1)
-        print(f"; ASSIGN", file=out_file)
+        out_file.emit(f"; ASSIGN")
         if isinstance(self.variable, TableAccessNode):
-            print("push rax", file=out_file)
-            self.variable.generate(generator, out_file)
-            print("pop rax ", file=out_file)
-            print("mov qword [rbx], rax", file=out_file)
+            # rax holds the value while the index is computed in rbx
+            registers = Registers()
+            registers.free.remove('rbx')
+            registers.hold('rax')
+            (element, sizeof_var) = self.variable.element(generator, out_file, 'rbx', registers)
+            if sizeof_var == 1:
+                out_file.emit(f"mov byte {element}, al")
+            else:
+                out_file.emit(f"mov qword {element}, rax")
         else:
-            print(f"mov qword {var_to_print}, rax", file=out_file)
+            out_file.emit(f"mov qword {var_to_print}, rax")
 
 
 class ReturnNode(AST):
@@ -810,7 +1570,40 @@ class ReturnNode(AST):
 
     def generate(self, generator, out_file):
         self.expression.generate(generator, out_file)
-        print("ret", file=out_file)
+        if generator.return_label is not None:
+            out_file.emit(f"jmp {generator.return_label}")
+        else:
+            out_file.emit("ret")
+
+class InlineNode(AST):
+    """The body of an inlined function: the returns assign the result and leave with InlineReturnNode."""
+    def __init__(self, token: Token, body: AST):
+        super().__init__(token)
+        self.body = body
+
+    def to_dict(self):
+        return dict(body=self.body.to_dict())
+
+    def generate(self, generator, out_file):
+        end_label = generator.label_count
+        generator.label_count += 1
+        out_file.emit(f"; INLINE {self.token.literal}")
+        generator.inlined.append(f".L{end_label}")
+        self.body.generate(generator, out_file)
+        generator.inlined.pop()
+        out_file.emit(f".L{end_label}:")
+
+
+class InlineReturnNode(AST):
+    def __init__(self, token: Token):
+        super().__init__(token)
+
+    def to_dict(self):
+        return dict()
+
+    def generate(self, generator, out_file):
+        out_file.emit(f"jmp {generator.inlined[-1]}")
+
 
 class PutcNode(AST):
     def __init__(self, token: Token, expression: AST):
@@ -822,17 +1615,21 @@ class PutcNode(AST):
 
     def generate(self, generator, out_file):
         self.expression.generate(generator, out_file)
-        print(f"; PUTC", file=out_file)
-        mem_addr = f"[mem+{generator.memory_depth}]"
-        generator.memory_depth += 8  # TODO optimize memory
-        print(f"mov qword {mem_addr}, rax", file=out_file)
-        print(f"lea rsi, {mem_addr}", file=out_file)
-        print("mov rdx, 8", file=out_file)
-        print("mov rdi, 1", file=out_file)
-        print("mov rax, 1", file=out_file)
-        print("syscall", file=out_file)
+        out_file.emit(f"; PUTC")
+        out_file.emit("call RUNTIME_putc")
 
 
+class FlushNode(AST):
+    def __init__(self, token: Token):
+        super().__init__(token)
+
+    def to_dict(self):
+        return dict()
+
+    def generate(self, generator, out_file):
+        out_file.emit(f"; FLUSH")
+        out_file.emit("call RUNTIME_flush")
+
 
 class VariableDeclarationNode(AST):
     def __init__(self, token: Token, variable: Token):
@@ -855,9 +1652,23 @@ class IntNode(AST):
     def to_dict(self):
         return dict(value=self.value)
 
+    def register_need(self) -> int:
+        return 1
+
+    def clobbers_registers(self) -> bool:
+        return False
+
+    def operand(self, generator) -> str | None:
+        if is_imm32(self.token.literal):
+            return str(self.token.literal)
+        return None
+
     def generate(self, generator, out_file):
-        print(f"; INT", file=out_file)
-        print(f"mov rax, {self.token.literal}", file=out_file)
+        self.generate_into(generator, out_file, 'rax', Registers())
+
+    def generate_into(self, generator, out_file, target: str, registers: Registers):
+        out_file.emit(f"; INT")
+        out_file.emit(f"mov {target}, {self.token.literal}")
 
 
 class IdentifierNode(AST):
@@ -868,22 +1679,44 @@ class IdentifierNode(AST):
     def to_dict(self):
         return dict(value=self.value)
 
+    def register_need(self) -> int:
+        return 1
+
+    def clobbers_registers(self) -> bool:
+        return False
+
+    def operand(self, generator) -> str | None:
+        identifier = self.token.literal
+        if generator is None:
+            # register_need only asks whether the identifier can be an operand
+            return identifier
+        if identifier in generator.constants:
+            if is_imm32(generator.constants[identifier]):
+                return str(generator.constants[identifier])
+            return None
+        if identifier in generator.variables and generator.variables[identifier] is not None:
+            return f"qword {generator.variables[identifier]}"
+        return None
+
     def generate(self, generator, out_file):
+        self.generate_into(generator, out_file, 'rax', Registers())
+
+    def generate_into(self, generator, out_file, target: str, registers: Registers):
         identifier = self.token.literal
         if self.token.literal in generator.constants:
-            print(f"mov rax, {generator.constants[self.token.literal]}", file=out_file)
+            out_file.emit(f"mov {target}, {generator.constants[self.token.literal]}")
             return
         if identifier not in generator.variables and identifier not in generator.functions:
             for idx, table in enumerate(generator.table_list):
                 if table == identifier:
-                    print(f"mov rax, qword table_{idx}", file=out_file)
+                    out_file.emit(f"mov {target}, qword table_{idx}")
                     return
             print(f"{self.token.location}: ERROR: identifier `{identifier}` is not declared")
             exit(1)
         if generator.variables[identifier] is None:
             print(f"{self.token.location}: ERROR: identifier `{identifier}` is not assigned")
             exit(1)
-        print(f"mov rax, qword {generator.variables[identifier]}", file=out_file)
+        out_file.emit(f"mov {target}, qword {generator.variables[identifier]}")
 
 
 class TableAccessNode(AST):
@@ -895,29 +1728,40 @@ class TableAccessNode(AST):
     def to_dict(self):
         return dict(value=self.value, index=self.index.to_dict())
 
-    def generate(self, generator, out_file):
+    def register_need(self) -> int:
+        return self.index.register_need()
+
+    def clobbers_registers(self) -> bool:
+        return self.index.clobbers_registers()
+
+    def element(self, generator, out_file, register: str, registers: Registers) -> Tuple[str, int]:
+        """
+        Returns the memory operand of the element and its size, the index is computed in `register`
+        unless it is a constant.
+        """
         identifier = self.token.literal
         if identifier not in generator.table_list:
             print(f"{self.token.location}: ERROR: the identifier is not initialized")
             exit(1)
-        self.index.generate(generator, out_file)
-        mem_variable = generator.table_list[identifier]
-        string = False
-        mem = generator.table_list[identifier]
-        var = mem.removeprefix('[').removesuffix(']')
-        print(f"lea r10, qword [{var}]", file=out_file)
-        string = True
+        var = generator.table_list[identifier].removeprefix('[').removesuffix(']')
         sizeof_var = generator.table_length[identifier].data_length_int  # TODO  sizeof VAR at compile time (when adding struct ?)
-        # rax is the index
-        print(f"mov rcx, {sizeof_var}", file=out_file)
-        print("mul rcx", file=out_file)
-        print("add rax, r10", file=out_file)
-        print(f"mov rbx, rax", file=out_file)
-        if string:
-            print(f"mov al, [rbx]", file=out_file)
-            print(f"movzx rax, al", file=out_file)
+        index = int_value(self.index.operand(generator) or '')
+        if index is not None:
+            return (f"[{var}+{index * sizeof_var}]", sizeof_var)
+        self.index.generate_into(generator, out_file, register, registers)
+        if sizeof_var == 1:
+            return (f"[{var}+{register}]", sizeof_var)
+        return (f"[{var}+{register}*{sizeof_var}]", sizeof_var)
+
+    def generate(self, generator, out_file):
+        self.generate_into(generator, out_file, 'rax', Registers())
+
+    def generate_into(self, generator, out_file, target: str, registers: Registers):
+        (element, sizeof_var) = self.element(generator, out_file, target, registers)
+        if sizeof_var == 1:
+            out_file.emit(f"movzx {target}, byte {element}")
         else:
-            print(f"mov rax, qword [rbx]", file=out_file)
+            out_file.emit(f"mov {target}, qword {element}")
 
 
 class TableElement:
@@ -964,17 +1808,16 @@ class ArrayNode(AST):
         global strings
         global string_length
         first_raw = generator.memory_depth
-        print(f"; ARRAYNODE", file=out_file)
+        out_file.emit(f"; ARRAYNODE")
         if self.token.type == TokenType.STRING:
             strings.append([ord_ for ord_ in self.array])
-            print(f"lea rax, [string_{string_length}]", file=out_file)
+            out_file.emit(f"lea rax, [string_{string_length}]")
             string_length += 1
         else:
             for i in range(len(self.array)):
-                print(f"mov qword [mem+{generator.memory_depth}], {self.array[i].literal}",
-                      file=out_file)
+                out_file.emit(f"mov qword [mem+{generator.memory_depth}], {self.array[i].literal}")
                 generator.memory_depth += 8
-            print(f"lea rax, qword [mem+{first_raw}]", file=out_file)
+            out_file.emit(f"lea rax, qword [mem+{first_raw}]")
 
 class DirectTableDeclarationNode(AST):
     def __init__(self, token: Token, variable: Token, array_node: ArrayNode):
@@ -1005,7 +1848,7 @@ class DirectTableDeclarationNode(AST):
                     [char.literal for char in self.array_node.array],
             )
             var_to_print = generator.table_list[self.variable.literal] 
-        print(f"lea rax, qword {var_to_print}", file=out_file)
+        out_file.emit(f"lea rax, qword {var_to_print}")
         
         
 
@@ -1034,27 +1877,176 @@ class VariableDeclarationAndAssignNode(AST):
         return dict(assign_node=self.assign_node.to_dict())
 
     def generate(self, generator, out_file):
-        generator.variables[self.identifier.literal] = f"[mem+{generator.memory_depth}]"
-        generator.memory_depth += 8
+        generator.variables[self.identifier.literal] = variable_slot(generator, self.identifier.literal)
         self.assign_node.generate(generator, out_file) 
 
 class ImportNode(AST):
-    def __init__(self, token:Token, file: Token, statements: List[AST]):
+    def __init__(self, token:Token, file: Token, statements: List[AST], path: str):
         super().__init__(token)
         self.file = file
         self.statements = statements
+        self.path = path
 
     def to_dict(self):
         return dict(file=self.file.to_dict(), statements=[s.to_dict() for s in self.statements])
 
     def generate(self, generator, out_file):
+        # a module imported several times is only generated once
+        if self.path in generator.imports:
+            return
+        generator.imports.add(self.path)
         for stmt in self.statements:
             stmt.generate(generator, out_file)
 
+
+AWC_MAGIC = b"AWC1"
+
+
+def compiler_version() -> bytes:
+    global compiler_version_
+    if compiler_version_ is None:
+        with open(__file__, "rb") as f:
+            compiler_version_ = hashlib.sha256(f.read()).digest()[:8]
+    return compiler_version_
+
+
+compiler_version_ = None
+
+
+class ModulePickler(pickle.Pickler):
+    """Pickles the statements of one module, the modules it imports are only referenced by path."""
+    def __init__(self, file, module: str):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.module = module
+
+    def persistent_id(self, obj):
+        if isinstance(obj, ImportNode) and obj.path != self.module:
+            return (obj.token, obj.file)
+        return None
+
+
+class ModuleUnpickler(pickle.Unpickler):
+    def __init__(self, file, modules, module: str):
+        super().__init__(file)
+        self.modules = modules
+        self.module = module
+
+    def persistent_load(self, pid):
+        import_token, file = pid
+        return self.modules.import_module(import_token, file, self.module)
+
+    def find_class(self, module, name):
+        # the compiler runs as __main__, but the cache can also be read when it is imported
+        if module in ("__main__", __name__) and isinstance(globals().get(name), type):
+            return globals()[name]
+        if module == "array" and name in ("array", "_array_reconstructor"):
+            return getattr(sys.modules["array"], name)
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a module cache")
+
+
+def awc_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".awc"
+
+
+def awc_header(digest: bytes) -> bytes:
+    return AWC_MAGIC + compiler_version() + digest
+
+
+class ModuleRegistry:
+    """
+    The modules imported during one compilation, each one is parsed once. The imports that are not relative to
+    their importer are relative to `directory`, the current directory by default.
+    """
+    def __init__(self, root_file: str, directory: str | None = None):
+        self.directory = os.getcwd() if directory is None else directory
+        self.modules: Dict[str, ImportNode] = dict()
+        self.digests: Dict[str, bytes] = dict()  # sha256 of the source of every imported module
+        self.importing: List[str] = [os.path.realpath(root_file)]
+        self.parsed: List[str] = list()  # the modules that were not read from a cache
+
+    def resolve(self, file: Token, importer: str) -> str:
+        path = file.literal
+        if not os.path.isabs(path):
+            relative_to_importer = os.path.join(os.path.dirname(importer), path)
+            if os.path.exists(relative_to_importer):
+                path = relative_to_importer
+        return os.path.realpath(os.path.join(self.directory, path))
+
+    def import_module(self, import_token: Token, file: Token, importer: str) -> ImportNode:
+        path = self.resolve(file, importer)
+        if path in self.modules:
+            return self.modules[path]
+        if path in self.importing:
+            cycle = self.importing[self.importing.index(path):] + [path]
+            print(f"{file.location}: ERROR: import cycle {' -> '.join(cycle)}")
+            exit(1)
+        if not os.path.exists(path):
+            print(f"{file.location}: ERROR: cannot import `{file.literal}`, the file does not exist")
+            exit(1)
+
+        begin = time.time()
+        with open(path, "rb") as f:
+            source = f.read()
+        self.digests[path] = hashlib.sha256(source).digest()
+        self.importing.append(path)
+        statements = self.load_cache(path)
+        cached = statements is not None
+        if not cached:
+            tokens = Lexer(path, source.decode()).tokenize()
+            statements = Parser(tokens, self).parse()
+            self.parsed.append(path)
+        self.importing.pop()
+        end = time.time()
+        print_info(f"importing {path}{' from cache' if cached else ''} took {end - begin} seconds")
+
+        self.modules[path] = ImportNode(import_token, file, statements, path)
+        if not cached:
+            self.write_cache(path, statements)
+        return self.modules[path]
+
+    def load_cache(self, path: str) -> List[AST] | None:
+        header = awc_header(self.digests[path])
+        pickled = memory_modules.get((path, header)) if memory_modules is not None else None
+        try:
+            if pickled is None:
+                with open(awc_path(path), "rb") as f:
+                    if f.read(len(header)) != header:
+                        return None
+                    pickled = f.read()
+            statements = ModuleUnpickler(io.BytesIO(pickled), self, path).load()
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # corrupted cache, the module is parsed again and the cache rewritten
+            return None
+        if memory_modules is not None:
+            memory_modules.put((path, header), pickled)
+        return statements
+
+    def write_cache(self, path: str, statements: List[AST]):
+        cache_file = awc_path(path)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        try:
+            pickled = io.BytesIO()
+            ModulePickler(pickled, path).dump(statements)
+            if memory_modules is not None:
+                memory_modules.put((path, awc_header(self.digests[path])), pickled.getvalue())
+            with open(tmp_file, "wb") as f:
+                f.write(awc_header(self.digests[path]))
+                f.write(pickled.getvalue())
+            os.replace(tmp_file, cache_file)
+        except Exception:
+            # the cache is optional, a read-only directory only makes imports slower
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
 class Parser:
-    def __init__(self, tokens: List[Token]):
+    def __init__(self, tokens: TokenStream, modules: ModuleRegistry | None = None):
         self.tokens = tokens
         self.cursor = 0
+        if modules is None:
+            modules = ModuleRegistry(file_table[tokens.file_id])
+        self.modules = modules
 
     def parse(self):
         return self.statement_list()
@@ -1067,7 +2059,7 @@ class Parser:
 
     def parse_statement(self):
         if debug:
-            print("`"+self.tokens[self.cursor].literal+"`", self.current_token_location())
+            print("`"+self.tokens.literal(self.cursor)+"`", self.current_token_location())
         if self.current_token() == TokenType.IF:
             return self.parse_if()
         if self.current_token() == TokenType.WHILE:
@@ -1077,18 +2069,20 @@ class Parser:
         if self.current_token() == TokenType.OPEN_CURLY_BRACKET:
             return self.parse_block()
         if self.current_token() == TokenType.IDENTIFIER:
-            if self.tokens[self.cursor + 1].type == TokenType.OPEN_PAREN:
+            if self.tokens.type(self.cursor + 1) == TokenType.OPEN_PAREN:
                 funcall = self.parse_function_call()
                 self.chop_token() # drop token
                 return funcall
-            if self.tokens[self.cursor + 1].type == TokenType.OPEN_BRACKET:
+            if self.tokens.type(self.cursor + 1) == TokenType.OPEN_BRACKET:
                 return self.parse_table_access_for_assigment()
-            if self.tokens[self.cursor + 1].type == TokenType.ASSIGN:
+            if self.tokens.type(self.cursor + 1) == TokenType.ASSIGN:
                 return self.parse_assign()
         if self.current_token() == TokenType.FUNCTION:
             return self.parse_function()
         if self.current_token() == TokenType.PUTC:
             return self.parse_putc()
+        if self.current_token() == TokenType.FLUSH:
+            return self.parse_flush()
         if self.current_token() == TokenType.LET:
             return self.parse_var_declaration()
         if self.current_token() == TokenType.CONST:
@@ -1099,10 +2093,13 @@ class Parser:
             ast = self.parse_syscall()
             self.chop_token()
             return ast
+        token = self.tokens[self.cursor]
+        print(f"{token.location}: ERROR: unexpected token `{token.literal}`")
+        exit(1)
 
 
     def parse_expr(self) -> AST:
-        assert TokenType.TokenType_NUMBERS == 33
+        assert TokenType.TokenType_NUMBERS == 34
         left = self.parse_T()
         if self.current_token() == TokenType.MINUS:
             token = self.chop_token()
@@ -1178,9 +2175,9 @@ class Parser:
         elif self.current_token() == TokenType.INT:
             return IntNode(self.chop_token())
         elif self.current_token() == TokenType.IDENTIFIER:
-            if self.cursor + 1 < len(self.tokens) and self.tokens[self.cursor + 1].type == TokenType.OPEN_PAREN:
+            if self.cursor + 1 < len(self.tokens) and self.tokens.type(self.cursor + 1) == TokenType.OPEN_PAREN:
                 return self.parse_function_call() 
-            elif self.cursor + 1 < len(self.tokens) and self.tokens[self.cursor + 1].type == TokenType.OPEN_BRACKET:
+            elif self.cursor + 1 < len(self.tokens) and self.tokens.type(self.cursor + 1) == TokenType.OPEN_BRACKET:
                 token = self.chop_token()
                 self.chop_token()  # token [
                 index = self.parse_expr()
@@ -1267,22 +2264,22 @@ class Parser:
         body = self.parse_statement()
         return FunctionNode(token, args, body, function_name_token)
 
-    def current_token(self):
+    def current_token(self) -> int:
         if self.cursor > len(self.tokens):
             raise Exception
-        return self.tokens[self.cursor].type
+        return self.tokens.type(self.cursor)
 
     def current_token_location(self) -> Location:
         if self.cursor > len(self.tokens):
             raise Exception
-        return self.tokens[self.cursor].location
+        return self.tokens.location(self.cursor)
 
-    def chop_token(self) -> Token:
+    def chop_token(self) -> TokenView:
         if self.cursor >= len(self.tokens):
             raise ValueError
         cursor = self.cursor
         self.cursor += 1
-        return self.tokens[cursor]
+        return TokenView(self.tokens, cursor)
 
     def parse_block(self) -> AST:
         token = self.chop_token()
@@ -1317,6 +2314,14 @@ class Parser:
             exit(1)
         return PutcNode(token, expression)
 
+    def parse_flush(self) -> AST:
+        token = self.chop_token()
+        ct = self.chop_token()
+        if ct.type != TokenType.SEMICOLON:
+            print(f"{ct.location}:ERROR: missing `;`")
+            exit(1)
+        return FlushNode(token)
+
     def parse_return(self) -> AST:
         token = self.chop_token()
         expression = self.parse_expr()
@@ -1346,7 +2351,7 @@ class Parser:
     def parse_var_declaration(self) -> AST:
         token = self.chop_token()
         variable = self.tokens[self.cursor]
-        if self.tokens[self.cursor+1].type == TokenType.OPEN_BRACKET:
+        if self.tokens.type(self.cursor + 1) == TokenType.OPEN_BRACKET:
             self.chop_token() # chop var
             self.chop_token() # chop [ 
             length = self.chop_token()
@@ -1368,8 +2373,7 @@ class Parser:
                 exit(1)
             return TableDeclarationNode(token, variable, length)
         else:
-            next_token = self.tokens[self.cursor+1]
-            if next_token.type == TokenType.ASSIGN:
+            if self.tokens.type(self.cursor + 1) == TokenType.ASSIGN:
                 parse_eq = self.parse_assign()
                 return VariableDeclarationAndAssignNode(token, variable, parse_eq)
             self.chop_token()
@@ -1405,31 +2409,17 @@ class Parser:
     def parse_import(self):
         import_token = self.chop_token()
         file = self.chop_token()
-        file_to_import = file.literal
-        
-        with open(file_to_import, "r") as f:
-            file_as_string = f.read()
-
-        lexer = Lexer(file_to_import, file_as_string)
-
-        if not os.path.exists(file_to_import):
-            print(f"ERROR: {file_to_import} does not exists")
-
-        tokens = list()
-        for token in lexer:
-            tokens.append(token)
-        print("lexed")
-
-        parser = Parser(tokens)
-        statements = parser.parse()
-        print("parsed")
+        if file.type != TokenType.STRING:
+            print(f"{file.location}: ERROR: expected a file name but got `{file.literal}`")
+            exit(1)
+        import_node = self.modules.import_module(import_token, file, file_table[self.tokens.file_id])
 
         semicolon = self.chop_token()
         if semicolon.type != TokenType.SEMICOLON:
             print(f"{semicolon.location}: ERROR: expected semicolon but got `{semicolon.literal}`")
             exit(1)
 
-        return ImportNode(import_token, file, statements)
+        return import_node
 
     def parse_syscall(self):
         token = self.chop_token()
@@ -1448,6 +2438,2478 @@ class Parser:
                     exit(1)
         self.chop_token() # drop )
         return system_call
+
+
+WORD_MASK = (1 << 64) - 1
+
+
+def evaluate_operator(type_: int, left: int, right: int) -> int | None:
+    # the same 64 bits unsigned arithmetic as the generated code, None when it cannot be folded
+    assert TokenType.TokenType_NUMBERS == 34
+    left &= WORD_MASK
+    right &= WORD_MASK
+    if type_ == TokenType.ADD:
+        return (left + right) & WORD_MASK
+    if type_ == TokenType.MINUS:
+        return (left - right) & WORD_MASK
+    if type_ == TokenType.MULT:
+        return (left * right) & WORD_MASK
+    if type_ == TokenType.DIV:
+        return None if right == 0 else left // right
+    if type_ == TokenType.MOD:
+        return None if right == 0 else left % right
+    if type_ == TokenType.LEFT_SHIFT:
+        return (left << (right & 63)) & WORD_MASK
+    if type_ == TokenType.RIGHT_SHIFT:
+        return left >> (right & 63)
+    if type_ == TokenType.BIT_AND:
+        return left & right
+    if type_ == TokenType.BIT_OR:
+        return left | right
+    if type_ == TokenType.EQ:
+        return int(left == right)
+    if type_ == TokenType.NEQ:
+        return int(left != right)
+    return None
+
+
+def make_int(value: int, token) -> IntNode:
+    return IntNode(Token(str(value), TokenType.INT, token.location))
+
+
+def constant_value(node: AST) -> int | None:
+    if isinstance(node, IntNode):
+        return int_value(node.token.literal)
+    return None
+
+
+def simplify_operator(node: BinaryOperator) -> AST:
+    # algebraic identities, x*0 and x&0 only when x has no side effects
+    left = constant_value(node.left)
+    right = constant_value(node.right)
+    type_ = node.token.type
+    if right == 0 and type_ in (TokenType.ADD, TokenType.MINUS, TokenType.BIT_OR,
+                                TokenType.LEFT_SHIFT, TokenType.RIGHT_SHIFT):
+        return node.left
+    if left == 0 and type_ in (TokenType.ADD, TokenType.BIT_OR):
+        return node.right
+    if right == 1 and type_ in (TokenType.MULT, TokenType.DIV):
+        return node.left
+    if left == 1 and type_ == TokenType.MULT:
+        return node.right
+    if right == 0 and type_ in (TokenType.MULT, TokenType.BIT_AND) and not node.left.clobbers_registers():
+        return make_int(0, node.token)
+    if left == 0 and type_ in (TokenType.MULT, TokenType.BIT_AND) and not node.right.clobbers_registers():
+        return make_int(0, node.token)
+    return node
+
+
+def fold_expression(node: AST, constants: Dict[str, str]) -> AST:
+    if isinstance(node, IdentifierNode):
+        if node.token.literal in constants and int_value(constants[node.token.literal]) is not None:
+            return make_int(int_value(constants[node.token.literal]), node.token)
+        return node
+    if isinstance(node, BinaryOperator):
+        left = fold_expression(node.left, constants)
+        right = fold_expression(node.right, constants)
+        if constant_value(left) is not None and constant_value(right) is not None:
+            value = evaluate_operator(node.token.type, constant_value(left), constant_value(right))
+            if value is not None:
+                return make_int(value, node.token)
+        return simplify_operator(BinaryOperator(node.token, left, right))
+    if isinstance(node, TableAccessNode):
+        return TableAccessNode(node.token, fold_expression(node.index, constants))
+    if isinstance(node, FunctionCall):
+        return FunctionCall(node.token, [fold_expression(arg, constants) for arg in node.arguments])
+    if isinstance(node, SystemCall):
+        return SystemCall(node.token, [fold_expression(arg, constants) for arg in node.arguments])
+    return node
+
+
+def fold_statement(node: AST, constants: Dict[str, str]) -> AST:
+    # Constants are scoped like generator.constants: main shares the top level constants,
+    # the other functions start without any.
+    if isinstance(node, ConstDeclarationNode):
+        if node.value.type == TokenType.INT:
+            constants[node.identifier.literal] = node.value.literal
+        return node
+    if isinstance(node, FunctionNode):
+        function_constants = constants if node.name.literal == 'main' else dict()
+        return FunctionNode(node.token, node.arguments, fold_statement(node.body, function_constants), node.name)
+    if isinstance(node, BlockNode):
+        return BlockNode(node.token, [fold_statement(statement, constants) for statement in node.statements])
+    if isinstance(node, ImportNode):
+        # imported modules are shared between importers, the folded statements are a copy
+        return ImportNode(node.token, node.file, fold_statements(node.statements, constants), node.path)
+    if isinstance(node, IfNode):
+        condition = fold_expression(node.condition, constants)
+        body = fold_statement(node.body, constants)
+        if constant_value(condition) is not None:
+            return body if constant_value(condition) != 0 else BlockNode(node.token, [])
+        return IfNode(node.token, condition, body)
+    if isinstance(node, WhileNode):
+        condition = fold_expression(node.condition, constants)
+        if constant_value(condition) == 0:
+            return BlockNode(node.token, [])
+        return WhileNode(node.token, condition, fold_statement(node.body, constants))
+    if isinstance(node, AssignNode):
+        variable = node.variable
+        if isinstance(variable, TableAccessNode):
+            variable = fold_expression(variable, constants)
+        return AssignNode(node.token, variable, fold_expression(node.expression, constants))
+    if isinstance(node, VariableDeclarationAndAssignNode):
+        return VariableDeclarationAndAssignNode(node.token, node.identifier, fold_statement(node.assign_node, constants))
+    if isinstance(node, ReturnNode):
+        return ReturnNode(node.token, fold_expression(node.expression, constants))
+    if isinstance(node, PutcNode):
+        return PutcNode(node.token, fold_expression(node.expression, constants))
+    if isinstance(node, (FunctionCall, SystemCall)):
+        return fold_expression(node, constants)
+    if isinstance(node, InlineNode):
+        return InlineNode(node.token, fold_statement(node.body, constants))
+    return node
+
+
+def fold_statements(statements: List[AST], constants: Dict[str, str] | None = None) -> List[AST]:
+    if constants is None:
+        constants = dict()
+    return [fold_statement(statement, constants) for statement in statements]
+
+
+def children(node: AST) -> List[AST]:
+    if isinstance(node, BinaryOperator):
+        return [node.left, node.right]
+    if isinstance(node, (IfNode, WhileNode)):
+        return [node.condition, node.body]
+    if isinstance(node, (BlockNode, ImportNode)):
+        return node.statements
+    if isinstance(node, AssignNode):
+        return [node.variable, node.expression]
+    if isinstance(node, (ReturnNode, PutcNode)):
+        return [node.expression]
+    if isinstance(node, (FunctionCall, SystemCall)):
+        return node.arguments
+    if isinstance(node, TableAccessNode):
+        return [node.index]
+    if isinstance(node, VariableDeclarationAndAssignNode):
+        return [node.assign_node]
+    if isinstance(node, (FunctionNode, InlineNode)):
+        return [node.body]
+    return []
+
+
+def walk(node: AST):
+    # preorder, without recursion: nested generators cost a frame per level for every node
+    pending = [node]
+    while pending:
+        node = pending.pop()
+        yield node
+        pending.extend(reversed(children(node)))
+
+
+def assigned_variables(node: AST) -> set[str]:
+    variables = set()
+    for child in walk(node):
+        if isinstance(child, AssignNode) and isinstance(child.variable, IdentifierNode):
+            variables.add(child.variable.token.literal)
+        elif isinstance(child, VariableDeclarationNode):
+            variables.add(child.variable.literal)
+        elif isinstance(child, VariableDeclarationAndAssignNode):
+            variables.add(child.identifier.literal)
+    return variables
+
+
+def map_expressions(node: AST, transform) -> AST:
+    # a copy of the statement with transform applied to each of its top level expressions
+    if isinstance(node, BlockNode):
+        return BlockNode(node.token, [map_expressions(statement, transform) for statement in node.statements])
+    if isinstance(node, IfNode):
+        return IfNode(node.token, transform(node.condition), map_expressions(node.body, transform))
+    if isinstance(node, WhileNode):
+        return WhileNode(node.token, transform(node.condition), map_expressions(node.body, transform))
+    if isinstance(node, AssignNode):
+        variable = node.variable
+        if isinstance(variable, TableAccessNode):
+            variable = TableAccessNode(variable.token, transform(variable.index))
+        return AssignNode(node.token, variable, transform(node.expression))
+    if isinstance(node, VariableDeclarationAndAssignNode):
+        return VariableDeclarationAndAssignNode(node.token, node.identifier, map_expressions(node.assign_node, transform))
+    if isinstance(node, ReturnNode):
+        return ReturnNode(node.token, transform(node.expression))
+    if isinstance(node, PutcNode):
+        return PutcNode(node.token, transform(node.expression))
+    if isinstance(node, InlineNode):
+        return InlineNode(node.token, map_expressions(node.body, transform))
+    if isinstance(node, (FunctionCall, SystemCall)):
+        return transform(node)
+    return node
+
+
+class LoopOptimizer:
+    """
+    Hoists the loop invariant expressions in temporary variables before the loops and unrolls the loops
+    whose trip count is known, the loop rotation is done by WhileNode.generate.
+    The persistent variables live in static memory, so a loop calling a function that can call the current
+    function back may see its variables change: such loops are left untouched.
+    """
+    def __init__(self, statements: List[AST]):
+        self.calls: Dict[str, set[str]] = dict()
+        for statement in statements:
+            for node in walk(statement):
+                if isinstance(node, FunctionNode):
+                    self.calls[node.name.literal] = {call.token.literal for call in walk(node.body)
+                                                     if isinstance(call, FunctionCall)}
+        self.function = 'main'
+        self.temporaries = 0
+        self.hoisted = 0
+        self.unrolled = 0
+
+    def may_recurse(self, node: AST) -> bool:
+        # whether node calls a function that can call the current function
+        pending = [call.token.literal for call in walk(node) if isinstance(call, FunctionCall)]
+        seen = set()
+        while len(pending) > 0:
+            function = pending.pop()
+            if function == self.function:
+                return True
+            if function not in seen:
+                seen.add(function)
+                pending += self.calls.get(function, set())
+        return False
+
+    def statements(self, statements: List[AST]) -> List[AST]:
+        result = list()
+        for statement in statements:
+            if isinstance(statement, WhileNode):
+                result += self.loop(statement, result)
+            else:
+                result.append(self.statement(statement))
+        return result
+
+    def statement(self, node: AST) -> AST:
+        if isinstance(node, FunctionNode):
+            self.function = node.name.literal
+            body = self.statement(node.body)
+            self.function = 'main'
+            return FunctionNode(node.token, node.arguments, body, node.name)
+        if isinstance(node, BlockNode):
+            return BlockNode(node.token, self.statements(node.statements))
+        if isinstance(node, ImportNode):
+            # imported modules are shared between importers, the optimized statements are a copy
+            return ImportNode(node.token, node.file, self.statements(node.statements), node.path)
+        if isinstance(node, IfNode):
+            return IfNode(node.token, node.condition, self.statement(node.body))
+        if isinstance(node, WhileNode):
+            return BlockNode(node.token, self.loop(node, []))
+        if isinstance(node, InlineNode):
+            return InlineNode(node.token, self.statement(node.body))
+        return node
+
+    def loop(self, node: WhileNode, previous: List[AST]) -> List[AST]:
+        if self.may_recurse(node):
+            return [node]
+        (hoisted, node) = self.hoist(node)
+        # the outer loop goes first, the expressions invariant in both loops leave both loops
+        node = WhileNode(node.token, node.condition, self.statement(node.body))
+        unrolled = self.unroll(node, previous)
+        if unrolled is None:
+            return hoisted + [node]
+        self.unrolled += 1
+        return hoisted + unrolled
+
+    def hoist(self, node: WhileNode) -> Tuple[List[AST], WhileNode]:
+        assigned = assigned_variables(node.body)
+        declarations = list()
+
+        def invariant(expression: AST) -> bool:
+            if isinstance(expression, IntNode):
+                return True
+            if isinstance(expression, IdentifierNode):
+                return expression.token.literal not in assigned
+            if isinstance(expression, BinaryOperator):
+                if expression.token.type == TokenType.DIV or expression.token.type == TokenType.MOD:
+                    # the loop may not run, a hoisted division by zero would fault
+                    if constant_value(expression.right) in (None, 0):
+                        return False
+                return invariant(expression.left) and invariant(expression.right)
+            return False
+
+        def replace(expression: AST) -> AST:
+            if isinstance(expression, BinaryOperator) and invariant(expression):
+                name = f"@loop{self.temporaries}"
+                self.temporaries += 1
+                token = Token(name, TokenType.IDENTIFIER, expression.token.location)
+                declarations.append(VariableDeclarationAndAssignNode(
+                    expression.token, token, AssignNode(expression.token, IdentifierNode(token), expression)))
+                return IdentifierNode(token)
+            if isinstance(expression, BinaryOperator):
+                return BinaryOperator(expression.token, replace(expression.left), replace(expression.right))
+            if isinstance(expression, TableAccessNode):
+                return TableAccessNode(expression.token, replace(expression.index))
+            if isinstance(expression, FunctionCall):
+                return FunctionCall(expression.token, [replace(argument) for argument in expression.arguments])
+            if isinstance(expression, SystemCall):
+                return SystemCall(expression.token, [replace(argument) for argument in expression.arguments])
+            return expression
+
+        node = map_expressions(node, replace)
+        self.hoisted += len(declarations)
+        return (declarations, node)
+
+    def unroll(self, node: WhileNode, previous: List[AST]) -> List[AST] | None:
+        """
+        Unrolls `i = start; while (i != end) { ...; i = i + step; }`, the remaining iterations are
+        copied before the loop. Returns None when the trip count is not known.
+        """
+        if loop_unroll_factor <= 1 or len(previous) == 0:
+            return None
+        condition = node.condition
+        if not isinstance(condition, BinaryOperator) or condition.token.type != TokenType.NEQ:
+            return None
+        if not isinstance(condition.left, IdentifierNode) or constant_value(condition.right) is None:
+            return None
+        variable = condition.left.token.literal
+        end = constant_value(condition.right)
+
+        init = previous[-1]
+        if isinstance(init, VariableDeclarationAndAssignNode):
+            init = init.assign_node
+        if (not isinstance(init, AssignNode) or not isinstance(init.variable, IdentifierNode)
+                or init.variable.token.literal != variable or constant_value(init.expression) is None):
+            return None
+        start = constant_value(init.expression)
+
+        body = node.body.statements if isinstance(node.body, BlockNode) else [node.body]
+        if len(body) == 0:
+            return None
+        increment = body[-1]
+        if not isinstance(increment, AssignNode) or not isinstance(increment.variable, IdentifierNode):
+            return None
+        if increment.variable.token.literal != variable or not isinstance(increment.expression, BinaryOperator):
+            return None
+        operator = increment.expression
+        if (not isinstance(operator.left, IdentifierNode) or operator.left.token.literal != variable
+                or constant_value(operator.right) is None):
+            return None
+        step = constant_value(operator.right) & WORD_MASK
+        if operator.token.type == TokenType.ADD:
+            distance = (end - start) & WORD_MASK
+        elif operator.token.type == TokenType.MINUS:
+            distance = (start - end) & WORD_MASK
+        else:
+            return None
+        if step == 0 or distance % step != 0:
+            return None
+        trip_count = distance // step
+
+        for statement in body[:-1]:
+            if variable in assigned_variables(statement):
+                return None
+            for child in walk(statement):
+                # declarations allocate memory each time they are generated
+                if isinstance(child, (VariableDeclarationNode, VariableDeclarationAndAssignNode, TableDeclarationNode,
+                                      DirectTableDeclarationNode, ConstDeclarationNode, ArrayNode)):
+                    return None
+
+        # the nodes are shared between the copies, generating a node does not modify it
+        if trip_count <= loop_unroll_factor:
+            return body * trip_count
+        return (body * (trip_count % loop_unroll_factor)
+                + [WhileNode(node.token, condition, BlockNode(node.body.token, body * loop_unroll_factor))])
+
+
+class Inliner:
+    """
+    Replaces the calls of the small functions (at most INLINE_SIZE nodes) and of the functions called once by
+    their bodies. The calls inlined are the statements, and the values of an assignment, a declaration, a putc
+    or a return. The variables of the body are renamed `@inline{n}.{name}`, the returns assign the result and
+    leave the InlineNode. The recursive functions, the functions whose variables keep their value between
+    calls, main and the functions of --no-inline keep their calls.
+    """
+    def __init__(self, statements: List[AST]):
+        self.functions: Dict[str, FunctionNode] = dict()
+        self.calls: Dict[str, set[str]] = dict()
+        self.call_sites: Dict[str, int] = dict()
+        for statement in statements:
+            for node in walk(statement):
+                if isinstance(node, FunctionNode):
+                    self.functions[node.name.literal] = node
+                    self.calls[node.name.literal] = {call.token.literal for call in walk(node.body)
+                                                     if isinstance(call, FunctionCall)}
+                elif isinstance(node, FunctionCall):
+                    self.call_sites[node.token.literal] = self.call_sites.get(node.token.literal, 0) + 1
+        self.bodies: Dict[FunctionNode, AST] = dict()
+        self.temporaries = 0
+        self.inlined = 0
+
+    def inlinable(self, name: str) -> bool:
+        if name not in self.functions or name == 'main' or name in no_inline:
+            return False
+        function = self.functions[name]
+        if may_recurse(name, self.calls) or len(persistent_variables(function)) > 0:
+            return False
+        # the tables of the body are copied at each call, they must not be written
+        tables = local_tables(function.body)
+        if any(isinstance(node, AssignNode) and isinstance(node.variable, TableAccessNode)
+               and node.variable.token.literal in tables for node in walk(function.body)):
+            return False
+        return self.call_sites.get(name, 0) == 1 or sum(1 for _ in walk(function.body)) <= INLINE_SIZE
+
+    def body(self, function: FunctionNode) -> AST:
+        # the body with the calls to other functions inlined, the callees are inlined first
+        if function not in self.bodies:
+            self.bodies[function] = self.statement(function.body)
+        return self.bodies[function]
+
+    def statements(self, statements: List[AST]) -> List[AST]:
+        return [self.statement(statement) for statement in statements]
+
+    def statement(self, node: AST) -> AST:
+        if isinstance(node, FunctionNode):
+            return FunctionNode(node.token, node.arguments, self.body(node), node.name)
+        if isinstance(node, BlockNode):
+            return BlockNode(node.token, self.statements(node.statements))
+        if isinstance(node, ImportNode):
+            # imported modules are shared between importers, the optimized statements are a copy
+            return ImportNode(node.token, node.file, self.statements(node.statements), node.path)
+        if isinstance(node, IfNode):
+            return IfNode(node.token, node.condition, self.statement(node.body))
+        if isinstance(node, WhileNode):
+            return WhileNode(node.token, node.condition, self.statement(node.body))
+        if isinstance(node, FunctionCall) and self.inlinable(node.token.literal):
+            return self.inline(node, None) or node
+        if (isinstance(node, AssignNode) and isinstance(node.variable, IdentifierNode)
+                and isinstance(node.expression, FunctionCall) and self.inlinable(node.expression.token.literal)):
+            return self.inline(node.expression, node.variable.token) or node
+        if isinstance(node, VariableDeclarationAndAssignNode):
+            assign_node = self.statement(node.assign_node)
+            if assign_node is node.assign_node:
+                return node
+            return BlockNode(node.token, [VariableDeclarationNode(node.token, node.identifier), assign_node])
+        if (isinstance(node, (PutcNode, ReturnNode)) and isinstance(node.expression, FunctionCall)
+                and self.inlinable(node.expression.token.literal)):
+            result = Token(f"@inline{self.temporaries}", TokenType.IDENTIFIER, node.token.location)
+            inlined = self.inline(node.expression, result)
+            if inlined is None:
+                return node
+            return BlockNode(node.token, [VariableDeclarationNode(node.token, result), inlined,
+                                          type(node)(node.token, IdentifierNode(result))])
+        return node
+
+    def inline(self, call: FunctionCall, result: Token | None) -> AST | None:
+        function = self.functions[call.token.literal]
+        if len(call.arguments) != len(function.arguments):
+            return None
+        prefix = f"@inline{self.temporaries}."
+        self.temporaries += 1
+        self.inlined += 1
+        body = self.body(function)
+        local_names = ({arg.literal for arg in function.arguments} | assigned_variables(body) | local_tables(body)
+                       | {node.identifier.literal for node in walk(body) if isinstance(node, ConstDeclarationNode)})
+        names = {name: prefix + name for name in local_names}
+        statements: List[AST] = list()
+        for arg, argument in zip(function.arguments, call.arguments):
+            token = Token(names[arg.literal], TokenType.IDENTIFIER, arg.location)
+            statements.append(VariableDeclarationAndAssignNode(
+                call.token, token, AssignNode(call.token, IdentifierNode(token), argument)))
+        if result is not None and not any(isinstance(node, ReturnNode) for node in walk(body)):
+            # without return the value is the one left in rax by the last call (`read` returns its syscall)
+            if (isinstance(body, BlockNode) and len(body.statements) > 0
+                    and isinstance(body.statements[-1], (FunctionCall, SystemCall))):
+                last = body.statements[-1]
+                body = BlockNode(body.token, body.statements[:-1] + [ReturnNode(last.token, last)])
+            else:
+                statements.append(AssignNode(call.token, IdentifierNode(result),
+                                             IntNode(Token('0', TokenType.INT, call.token.location))))
+        statements.append(rename(body, names, result))
+        return InlineNode(call.token, BlockNode(call.token, statements))
+
+
+def local_tables(node: AST) -> set[str]:
+    return {child.variable.literal for child in walk(node)
+            if isinstance(child, (TableDeclarationNode, DirectTableDeclarationNode))}
+
+
+def rename(node: AST, names: Dict[str, str], result: Token | None) -> AST:
+    # a copy of an inlined body with its variables renamed and its returns assigning result
+    def token(token: Token) -> Token:
+        if token.literal in names:
+            return Token(names[token.literal], token.type, token.location)
+        return token
+
+    if isinstance(node, IdentifierNode):
+        return IdentifierNode(token(node.token))
+    if isinstance(node, BinaryOperator):
+        return BinaryOperator(node.token, rename(node.left, names, result), rename(node.right, names, result))
+    if isinstance(node, TableAccessNode):
+        return TableAccessNode(token(node.token), rename(node.index, names, result))
+    if isinstance(node, TableDeclarationNode):
+        return TableDeclarationNode(node.token, token(node.variable), token(node.length))
+    if isinstance(node, DirectTableDeclarationNode):
+        return DirectTableDeclarationNode(node.token, token(node.variable), node.array_node)
+    if isinstance(node, FunctionCall):
+        return FunctionCall(node.token, [rename(argument, names, result) for argument in node.arguments])
+    if isinstance(node, SystemCall):
+        return SystemCall(node.token, [rename(argument, names, result) for argument in node.arguments])
+    if isinstance(node, BlockNode):
+        return BlockNode(node.token, [rename(statement, names, result) for statement in node.statements])
+    if isinstance(node, IfNode):
+        return IfNode(node.token, rename(node.condition, names, result), rename(node.body, names, result))
+    if isinstance(node, WhileNode):
+        return WhileNode(node.token, rename(node.condition, names, result), rename(node.body, names, result))
+    if isinstance(node, InlineNode):
+        return InlineNode(node.token, rename(node.body, names, result))
+    if isinstance(node, AssignNode):
+        return AssignNode(node.token, rename(node.variable, names, result), rename(node.expression, names, result))
+    if isinstance(node, VariableDeclarationAndAssignNode):
+        return VariableDeclarationAndAssignNode(node.token, token(node.identifier),
+                                                rename(node.assign_node, names, result))
+    if isinstance(node, VariableDeclarationNode):
+        return VariableDeclarationNode(node.token, token(node.variable))
+    if isinstance(node, ConstDeclarationNode):
+        return ConstDeclarationNode(node.token, token(node.identifier), node.value)
+    if isinstance(node, PutcNode):
+        return PutcNode(node.token, rename(node.expression, names, result))
+    if isinstance(node, ReturnNode):
+        expression = rename(node.expression, names, result)
+        if result is not None:
+            statement = AssignNode(node.token, IdentifierNode(result), expression)
+        elif expression.clobbers_registers():
+            statement = expression  # only evaluated for its side effects
+        else:
+            statement = BlockNode(node.token, [])
+        return BlockNode(node.token, [statement, InlineReturnNode(node.token)])
+    return node
+
+
+def references(node: AST) -> set[str]:
+    # the functions and the tables named in node, the bodies of the functions defined in node excluded
+    names = set()
+    pending = [node]
+    while len(pending) > 0:
+        node = pending.pop()
+        if isinstance(node, FunctionNode):
+            continue
+        if isinstance(node, (FunctionCall, TableAccessNode, IdentifierNode)):
+            names.add(node.token.literal)
+        pending += children(node)
+    return names
+
+
+class TreeShaker:
+    """
+    Removes the functions that cannot be called from main or from the top level code, and the tables that are
+    not named in the code left. The string literals go with the functions that use them.
+    """
+    def __init__(self, statements: List[AST]):
+        functions: Dict[str, List[FunctionNode]] = dict()
+        for statement in statements:
+            for node in walk(statement):
+                if isinstance(node, FunctionNode):
+                    functions.setdefault(node.name.literal, list()).append(node)
+        self.referenced = {'main'}
+        for statement in statements:
+            self.referenced |= references(statement)
+        pending = list(self.referenced)
+        while len(pending) > 0:
+            for function in functions.get(pending.pop(), []):
+                for name in references(function.body) - self.referenced:
+                    self.referenced.add(name)
+                    pending.append(name)
+        self.functions: List[str] = list()
+        self.tables: List[str] = list()
+        self.strings = 0
+
+    def statements(self, statements: List[AST]) -> List[AST]:
+        result = list()
+        for statement in statements:
+            statement = self.statement(statement)
+            if statement is not None:
+                result.append(statement)
+        return result
+
+    def statement(self, node: AST) -> AST | None:
+        if isinstance(node, FunctionNode):
+            if node.name.literal not in self.referenced:
+                self.functions.append(node.name.literal)
+                self.tables += sorted(local_tables(node.body))
+                self.strings += sum(1 for child in walk(node.body)
+                                    if isinstance(child, ArrayNode) and child.token.type == TokenType.STRING)
+                return None
+            return FunctionNode(node.token, node.arguments, self.statement(node.body), node.name)
+        if isinstance(node, (TableDeclarationNode, DirectTableDeclarationNode)):
+            if node.variable.literal not in self.referenced:
+                self.tables.append(node.variable.literal)
+                return None
+            return node
+        if isinstance(node, BlockNode):
+            return BlockNode(node.token, self.statements(node.statements))
+        if isinstance(node, ImportNode):
+            # imported modules are shared between importers, the kept statements are a copy
+            return ImportNode(node.token, node.file, self.statements(node.statements), node.path)
+        if isinstance(node, IfNode):
+            return IfNode(node.token, node.condition, self.statement(node.body))
+        if isinstance(node, WhileNode):
+            return WhileNode(node.token, node.condition, self.statement(node.body))
+        if isinstance(node, InlineNode):
+            return InlineNode(node.token, self.statement(node.body))
+        return node
+
+
+def optimize(statements: List[AST]) -> List[AST]:
+    if optimization_level >= 1:
+        statements = fold_statements(statements)
+    if optimization_level >= 2 and inline:
+        inliner = Inliner(statements)
+        statements = inliner.statements(statements)
+        print_info(f"inlining: {inliner.inlined} calls inlined")
+        statements = fold_statements(statements)
+    if optimization_level >= 2:
+        loops = LoopOptimizer(statements)
+        statements = loops.statements(statements)
+        print_info(f"loops: {loops.hoisted} invariant expressions hoisted, {loops.unrolled} loops unrolled")
+    if optimization_level >= 1:
+        shaker = TreeShaker(statements)
+        statements = shaker.statements(statements)
+        functions = list(dict.fromkeys(shaker.functions))  # a module imported twice is only generated once
+        tables = list(dict.fromkeys(shaker.tables))
+        print_info(f"tree shaking: removed {len(functions)} functions {functions}, "
+                   f"{len(tables)} tables {tables}, {shaker.strings} strings")
+    return statements
+
+
+class LiveRanges:
+    """
+    The live range of each variable of a function, as the first and the last position where it occurs
+    in the statements, extended over the loops whose back edge it is live around.
+    A variable that may be read before being assigned keeps its value from a previous call: it is persistent.
+    """
+    def __init__(self, function: FunctionNode):
+        self.position = 0
+        self.ranges: Dict[str, List[int]] = dict()
+        self.loops: List[Tuple[int, int, set[str]]] = list()
+        self.persistent: set[str] = set()
+        self.loop_stack: List[Tuple[int, int, set[str]]] = list()
+        self.exits: List[List[List[set[str]]]] = list()
+        self.variables = assigned_variables(function.body) | {arg.literal for arg in function.arguments}
+        assigned = [set()]
+        for arg in function.arguments:
+            self.write(arg.literal, assigned)
+        self.statement(function.body, assigned)
+        changed = True
+        while changed:
+            changed = False
+            for start, end, exposed in self.loops:
+                for name, (first, last) in self.ranges.items():
+                    if (name in exposed or first < start <= last) and (first > start or last < end):
+                        self.ranges[name] = [min(first, start), max(last, end)]
+                        changed = True
+
+    def occur(self, name: str):
+        self.position += 1
+        if name in self.ranges:
+            self.ranges[name][1] = self.position
+        else:
+            self.ranges[name] = [self.position, self.position]
+
+    def write(self, name: str, assigned: List[set[str]]):
+        self.occur(name)
+        for names in assigned:
+            names.add(name)
+
+    def read(self, expression: AST, assigned: List[set[str]]):
+        # assigned holds the variables definitely assigned in the function, then in each enclosing loop iteration
+        for node in walk(expression):
+            if isinstance(node, IdentifierNode) and node.token.literal in self.variables:
+                name = node.token.literal
+                self.occur(name)
+                if name not in assigned[0]:
+                    self.persistent.add(name)
+                for names, (_, _, exposed) in zip(assigned[1:], self.loop_stack):
+                    if name not in names:
+                        exposed.add(name)
+
+    def statement(self, node: AST, assigned: List[set[str]]):
+        if isinstance(node, BlockNode):
+            for statement in node.statements:
+                self.statement(statement, assigned)
+        elif isinstance(node, AssignNode):
+            if isinstance(node.variable, TableAccessNode):
+                self.read(node.variable.index, assigned)
+            self.read(node.expression, assigned)
+            if isinstance(node.variable, IdentifierNode) and node.variable.token.literal in self.variables:
+                self.write(node.variable.token.literal, assigned)
+        elif isinstance(node, VariableDeclarationAndAssignNode):
+            self.statement(node.assign_node, assigned)
+        elif isinstance(node, IfNode):
+            self.read(node.condition, assigned)
+            self.statement(node.body, [set(names) for names in assigned])
+        elif isinstance(node, WhileNode):
+            loop = (self.position + 1, 0, set())
+            self.loop_stack.append(loop)
+            self.read(node.condition, assigned)
+            self.statement(node.body, [set(names) for names in assigned] + [set()])
+            self.loop_stack.pop()
+            self.loops.append((loop[0], self.position, loop[2]))
+        elif isinstance(node, InlineNode):
+            # the variables assigned after the body are the ones assigned at each of its exits
+            self.exits.append(list())
+            inner = [set(names) for names in assigned]
+            self.statement(node.body, inner)
+            exits = self.exits.pop() + [inner]
+            for idx, names in enumerate(assigned):
+                names |= set.intersection(*[exit_[idx] for exit_ in exits])
+        elif isinstance(node, InlineReturnNode):
+            self.exits[-1].append([set(names) for names in assigned])
+            for names in assigned:
+                names |= self.variables  # the statements after a return are not run
+        elif isinstance(node, (ReturnNode, PutcNode, FunctionCall, SystemCall)):
+            self.read(node, assigned)
+
+    def pack(self) -> Tuple[Dict[str, int], int]:
+        # linear scan: a variable takes the slot of a variable whose range ended before its own starts
+        offsets: Dict[str, int] = dict()
+        free: List[int] = list()
+        active: List[Tuple[int, str]] = list()
+        size = 0
+        packed = sorted((first, last, name) for name, (first, last) in self.ranges.items()
+                        if name in self.variables and name not in self.persistent)
+        for first, last, name in packed:
+            for end, other in list(active):
+                if end < first:
+                    active.remove((end, other))
+                    free.append(offsets[other])
+            if len(free) > 0:
+                offsets[name] = min(free)
+                free.remove(offsets[name])
+            else:
+                offsets[name] = size
+                size += 8
+            active.append((last, name))
+        return offsets, size
+
+
+class Frame:
+    """The slots of the variables of a function. The frame of main is in `mem`, the others are on the stack."""
+    def __init__(self, slots: Dict[str, str], size: int, on_stack: bool):
+        self.slots = slots
+        self.size = size
+        self.on_stack = on_stack
+
+
+def persistent_variables(function: FunctionNode) -> set[str]:
+    ranges = LiveRanges(function)
+    return ranges.persistent & ranges.variables
+
+
+def allocate_frames(statements: List[AST]) -> Tuple[Dict[str, Frame], int]:
+    """
+    Gives to each function a frame where the variables with disjoint live ranges share their slots.
+    The frames of the functions are allocated under rbp at each call, the frame of main is at the start of
+    `mem`. A variable that may be read before being assigned keeps its value between calls in `mem`.
+    Returns the frame of each function and the size of the memory taken in `mem`.
+    """
+    frames: Dict[str, Frame] = dict()
+    persistent: List[Tuple[str, str]] = list()
+    depth = 0
+    for statement in statements:
+        for node in walk(statement):
+            if not isinstance(node, FunctionNode):
+                continue
+            name = node.name.literal
+            ranges = LiveRanges(node)
+            offsets, size = ranges.pack()
+            if name == 'main':
+                frames[name] = Frame({variable: f"[mem+{depth + offset}]" for variable, offset in offsets.items()},
+                                     size, False)
+                depth += size
+            else:
+                frames[name] = Frame({variable: f"[rbp-{offset + 8}]" for variable, offset in offsets.items()},
+                                     size, True)
+            persistent += [(name, variable) for variable in sorted(ranges.persistent & ranges.variables)]
+    frames_size = depth
+    for name, variable in persistent:
+        frames[name].slots[variable] = f"[mem+{depth}]"
+        depth += 8
+    print_info(f"memory: {frames_size} bytes for main, {depth - frames_size} bytes of persistent variables")
+    return frames, depth
+
+
+def variable_slot(generator, identifier: str) -> str:
+    # the slot given by allocate_frames, or a new one after every other slot
+    frame = generator.frame
+    if frame is not None and identifier in frame.slots:
+        return frame.slots[identifier]
+    if frame is not None and frame.on_stack:
+        frame.size += 8
+        return f"[rbp-{frame.size}]"
+    slot = f"[mem+{generator.memory_depth}]"
+    generator.memory_depth += 8
+    return slot
+
+
+class Value:
+    """A virtual register of the IR, defined by exactly one instruction in SSA form."""
+    __slots__ = ('id',)
+
+    def __init__(self, id_: int):
+        self.id = id_
+
+    def __str__(self):
+        return f"%{self.id}"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+# opcode: (defines a value, operands) with v a value, i an integer, n a name, b a block,
+# * any number of values, s any number of names and p the (block, value) pairs of a phi
+IR_OPCODES = {
+    'const': (True, 'i'),
+    'param': (True, 'i'),
+    'load': (True, 'n'),
+    'store': (False, 'nv'),
+    'address': (True, 'n'),
+    'element': (True, 'nv'),
+    'set_element': (False, 'nvv'),
+    'array': (True, 's'),
+    'string': (True, 'i'),
+    'call': (True, 'n*'),
+    'syscall': (True, '*'),
+    'putc': (False, 'v'),
+    'flush': (False, ''),
+    'phi': (True, 'p'),
+    # terminators
+    'jump': (False, 'b'),
+    'branch': (False, 'vbb'),
+    'branch_eq': (False, 'vvbb'),
+    'branch_ne': (False, 'vvbb'),
+    'return': (False, '*'),
+    'exit': (False, ''),
+}
+
+IR_OPERATORS = {
+    TokenType.ADD: 'add',
+    TokenType.MINUS: 'sub',
+    TokenType.MULT: 'mul',
+    TokenType.DIV: 'div',
+    TokenType.MOD: 'mod',
+    TokenType.LEFT_SHIFT: 'shl',
+    TokenType.RIGHT_SHIFT: 'shr',
+    TokenType.BIT_AND: 'and',
+    TokenType.BIT_OR: 'or',
+    TokenType.EQ: 'eq',
+    TokenType.NEQ: 'ne',
+}
+IR_OPERATOR_TYPES = {name: type_ for type_, name in IR_OPERATORS.items()}
+for name in IR_OPERATOR_TYPES:
+    IR_OPCODES[name] = (True, 'vv')
+
+IR_TERMINATORS = {'jump', 'branch', 'branch_eq', 'branch_ne', 'return', 'exit'}
+# the instructions that call code clobbering the registers
+IR_CALLS = {'call', 'syscall', 'putc', 'flush'}
+# the instructions without side effects, removed when their value is not used
+IR_PURE = {'const', 'param', 'load', 'address', 'element', 'string', 'phi'} | set(IR_OPERATOR_TYPES)
+
+
+class IRInstruction:
+    __slots__ = ('opcode', 'dest', 'args')
+
+    def __init__(self, opcode: str, dest: Value | None, args: List):
+        self.opcode = opcode
+        self.dest = dest
+        self.args = args
+
+    def values(self) -> List[Value]:
+        return [arg for arg in self.args if isinstance(arg, Value)]
+
+    def targets(self) -> List['IRBlock']:
+        if self.opcode == 'phi':
+            return []
+        return [arg for arg in self.args if isinstance(arg, IRBlock)]
+
+    def replace(self, mapping: Dict[Value, Value]):
+        self.args = [mapping.get(arg, arg) if isinstance(arg, Value) else arg for arg in self.args]
+
+    def __str__(self):
+        if self.opcode == 'phi':
+            operands = ", ".join(f"[{self.args[i].name}: {self.args[i + 1]}]" for i in range(0, len(self.args), 2))
+        else:
+            operands = ", ".join(arg.name if isinstance(arg, IRBlock) else str(arg) for arg in self.args)
+        text = f"{self.opcode} {operands}".rstrip()
+        if self.dest is not None:
+            return f"{self.dest} = {text}"
+        return text
+
+
+class IRBlock:
+    def __init__(self, name: str):
+        self.name = name
+        self.instructions: List[IRInstruction] = list()
+
+    def terminator(self) -> IRInstruction | None:
+        if len(self.instructions) > 0 and self.instructions[-1].opcode in IR_TERMINATORS:
+            return self.instructions[-1]
+        return None
+
+    def successors(self) -> List['IRBlock']:
+        terminator = self.terminator()
+        return [] if terminator is None else terminator.targets()
+
+    def phis(self) -> List[IRInstruction]:
+        return [instruction for instruction in self.instructions if instruction.opcode == 'phi']
+
+
+class IRFunction:
+    def __init__(self, name: str, label: str, arguments: List[str]):
+        self.name = name
+        self.label = label
+        self.arguments = arguments
+        self.blocks: List[IRBlock] = list()
+        self.value_count = 0
+        self.ssa = False
+
+    def new_value(self) -> Value:
+        value = Value(self.value_count)
+        self.value_count += 1
+        return value
+
+    def predecessors(self) -> Dict[IRBlock, List[IRBlock]]:
+        predecessors = {block: list() for block in self.blocks}
+        for block in self.blocks:
+            for successor in block.successors():
+                if block not in predecessors[successor]:
+                    predecessors[successor].append(block)
+        return predecessors
+
+    def calls(self) -> set[str]:
+        return {instruction.args[0] for block in self.blocks for instruction in block.instructions
+                if instruction.opcode == 'call'}
+
+    def remove_unreachable_blocks(self):
+        reachable = set()
+        pending = [self.blocks[0]]
+        while len(pending) > 0:
+            block = pending.pop()
+            if block not in reachable:
+                reachable.add(block)
+                pending += block.successors()
+        self.blocks = [block for block in self.blocks if block in reachable]
+
+    def dump(self) -> str:
+        lines = [f"function {self.name}({', '.join(self.arguments)}){' ssa' if self.ssa else ''}:"]
+        for block in self.blocks:
+            lines.append(f"{block.name}:")
+            lines += [f"    {instruction}" for instruction in block.instructions]
+        return "\n".join(lines)
+
+
+class IRModule:
+    def __init__(self):
+        self.functions: List[IRFunction] = list()
+        self.table_list: Dict[str, str] = dict()
+        self.table_length: Dict[str, TableElement] = dict()
+
+    def dump(self) -> str:
+        tables = [f"table {name} {self.table_list[name]} {self.table_length[name].data_length} "
+                  f"{self.table_length[name].length}" for name in self.table_list]
+        return "\n\n".join(["\n".join(tables)] + [function.dump() for function in self.functions]) + "\n"
+
+
+class IRScope:
+    """The constants and variables visible in a function, like the ones of a generator."""
+    def __init__(self):
+        self.constants: Dict[str, str] = dict()
+        self.variables: Dict[str, bool | None] = dict()  # None when declared but never assigned
+
+
+class IRBuilder:
+    """
+    Lowers the AST into IR functions made of basic blocks. The variables stay in memory (load/store),
+    build_ssa promotes them to values. The semantic errors are the ones of the generators.
+    """
+    def __init__(self, entry: str):
+        self.module = IRModule()
+        self.entry = entry  # the label of main, the entry symbol of the dialect
+        self.functions: Dict[str, str] = dict()
+        self.imports: set[str] = set()
+        self.label_count = 0
+        self.function: IRFunction | None = None
+        self.block: IRBlock | None = None
+        self.scope = IRScope()
+        self.inline_exits: List[IRBlock] = list()
+
+    def program(self, statements: List[AST]) -> IRModule:
+        # the top level code is never executed, it only declares the names shared with main
+        self.function = IRFunction("@top", "@top", [])
+        self.start(self.new_block())
+        self.top_scope = self.scope
+        for statement in statements:
+            self.statement(statement)
+        for function in self.module.functions:
+            function.remove_unreachable_blocks()
+        return self.module
+
+    def new_block(self) -> IRBlock:
+        block = IRBlock(f".L{self.label_count}")
+        self.label_count += 1
+        return block
+
+    def start(self, block: IRBlock):
+        self.function.blocks.append(block)
+        self.block = block
+
+    def emit(self, opcode: str, *args) -> Value | None:
+        if self.block.terminator() is not None:
+            # code after a return is unreachable, it still gets a block
+            self.start(self.new_block())
+        dest = self.function.new_value() if IR_OPCODES[opcode][0] else None
+        self.block.instructions.append(IRInstruction(opcode, dest, list(args)))
+        return dest
+
+    def terminate(self, opcode: str, *args):
+        if self.block.terminator() is None:
+            self.emit(opcode, *args)
+
+    def statement(self, node: AST):
+        if isinstance(node, FunctionNode):
+            self.function_node(node)
+        elif isinstance(node, BlockNode):
+            for statement in node.statements:
+                self.statement(statement)
+        elif isinstance(node, ImportNode):
+            # a module imported several times is only generated once
+            if node.path not in self.imports:
+                self.imports.add(node.path)
+                for statement in node.statements:
+                    self.statement(statement)
+        elif isinstance(node, AssignNode):
+            self.assign(node)
+        elif isinstance(node, VariableDeclarationAndAssignNode):
+            self.scope.variables[node.identifier.literal] = True
+            self.statement(node.assign_node)
+        elif isinstance(node, VariableDeclarationNode):
+            self.scope.variables[node.variable.literal] = None
+        elif isinstance(node, ConstDeclarationNode):
+            if node.value.type != TokenType.INT:
+                print(f"{node.value.location}: ERROR: the only constant value supported yet are integers.")
+                exit(1)
+            self.scope.constants[node.identifier.literal] = node.value.literal
+        elif isinstance(node, TableDeclarationNode):
+            length = node.length.literal
+            if node.length.type != TokenType.INT and length not in self.scope.constants:
+                print(f"{node.length.location}: ERROR: The length of the table is not a integer.")
+                exit(1)
+            length = self.scope.constants.get(length, length)
+            self.declare_table(node.variable.literal, TableElement(length, "dq", 8, None))
+        elif isinstance(node, DirectTableDeclarationNode):
+            array = node.array_node
+            if array.token.type != TokenType.STRING:
+                element = TableElement(len(array.array), "dq", 8, [ide.literal for ide in array.array])
+            else:
+                element = TableElement(len(array.array), "db", 1, [char.literal for char in array.array])
+            self.declare_table(node.variable.literal, element)
+        elif isinstance(node, IfNode):
+            body = self.new_block()
+            end = self.new_block()
+            self.branch(node.condition, body, end)
+            self.start(body)
+            self.statement(node.body)
+            self.terminate('jump', end)
+            self.start(end)
+        elif isinstance(node, WhileNode):
+            header = self.new_block()
+            body = self.new_block()
+            end = self.new_block()
+            self.terminate('jump', header)
+            self.start(header)
+            self.branch(node.condition, body, end)
+            self.start(body)
+            self.statement(node.body)
+            self.terminate('jump', header)
+            self.start(end)
+        elif isinstance(node, ReturnNode):
+            self.terminate('return', self.expression(node.expression))
+        elif isinstance(node, InlineNode):
+            end = self.new_block()
+            self.inline_exits.append(end)
+            self.statement(node.body)
+            self.inline_exits.pop()
+            self.terminate('jump', end)
+            self.start(end)
+        elif isinstance(node, InlineReturnNode):
+            self.terminate('jump', self.inline_exits[-1])
+        elif isinstance(node, PutcNode):
+            self.emit('putc', self.expression(node.expression))
+        elif isinstance(node, FlushNode):
+            self.emit('flush')
+        else:
+            self.expression(node)
+
+    def function_node(self, node: FunctionNode):
+        function_name = node.name.literal
+        if function_name in self.functions:
+            print(f"{node.token.location}: ERROR: function name already exists")
+        if function_name in self.scope.variables:
+            print(f"{node.token.location}: ERROR: this token already exists. This is a variable.")
+        label = f"FUNC_{function_name}"
+        if function_name == 'main':
+            label = self.entry
+        self.functions[function_name] = label
+
+        saved = (self.function, self.block, self.scope)
+        self.function = IRFunction(function_name, label, [arg.literal for arg in node.arguments])
+        self.scope = self.top_scope if function_name == 'main' else IRScope()
+        self.module.functions.append(self.function)
+        self.start(self.new_block())
+        for idx, arg in enumerate(node.arguments):
+            self.scope.variables[arg.literal] = True
+            self.emit('store', arg.literal, self.emit('param', idx))
+        self.statement(node.body)
+        self.terminate('exit' if function_name == 'main' else 'return')
+        (self.function, self.block, self.scope) = saved
+
+    def declare_table(self, name: str, element: TableElement):
+        self.module.table_list[name] = f"[table_{len(self.module.table_list)}]"
+        self.module.table_length[name] = element
+
+    def assign(self, node: AssignNode):
+        identifier = node.variable.token.literal
+        value = self.expression(node.expression)
+        if identifier in self.functions:
+            print(f"{node.token.location}: ERROR: cannot assign to a function.")
+            exit(1)
+        if isinstance(node.variable, TableAccessNode):
+            index = self.element_index(node.variable)
+            self.emit('set_element', identifier, index, value)
+        elif identifier in self.scope.variables:
+            self.scope.variables[identifier] = True
+            self.emit('store', identifier, value)
+        else:
+            print(f"{node.token.location}: ERROR: unknown word `{identifier}`.")
+            exit(1)
+
+    def element_index(self, node: TableAccessNode) -> Value:
+        if node.token.literal not in self.module.table_list:
+            print(f"{node.token.location}: ERROR: the identifier is not initialized")
+            exit(1)
+        return self.expression(node.index)
+
+    def expression(self, node: AST) -> Value:
+        global string_length
+        if isinstance(node, IntNode):
+            return self.emit('const', int_value(node.token.literal))
+        if isinstance(node, IdentifierNode):
+            identifier = node.token.literal
+            if identifier in self.scope.constants:
+                return self.emit('const', int_value(self.scope.constants[identifier]))
+            if identifier not in self.scope.variables:
+                if identifier in self.module.table_list:
+                    return self.emit('address', identifier)
+                print(f"{node.token.location}: ERROR: identifier `{identifier}` is not declared")
+                exit(1)
+            if self.scope.variables[identifier] is None:
+                print(f"{node.token.location}: ERROR: identifier `{identifier}` is not assigned")
+                exit(1)
+            return self.emit('load', identifier)
+        if isinstance(node, BinaryOperator):
+            left = self.expression(node.left)
+            right = self.expression(node.right)
+            return self.emit(IR_OPERATORS[node.token.type], left, right)
+        if isinstance(node, TableAccessNode):
+            return self.emit('element', node.token.literal, self.element_index(node))
+        if isinstance(node, FunctionCall):
+            if node.token.literal not in self.functions:
+                print(f"{node.token.location}: ERROR: no function named `{node.token.literal}`")
+                exit(1)
+            arguments = [self.expression(argument) for argument in node.arguments]
+            return self.emit('call', node.token.literal, *arguments)
+        if isinstance(node, SystemCall):
+            arguments = [self.expression(argument) for argument in node.arguments]
+            if len(arguments) < 1:
+                print(f"{node.token.location}: ERROR: Not enought arguments for syscall")
+            if len(arguments) > len(SYSCALL_REGISTERS):
+                print(f"{node.token.location}: ERROR: Too many arguments for syscall", file=sys.stderr)
+                exit(1)
+            return self.emit('syscall', *arguments)
+        if isinstance(node, ArrayNode):
+            if node.token.type == TokenType.STRING:
+                strings.append([ord_ for ord_ in node.array])
+                string_length += 1
+                return self.emit('string', string_length - 1)
+            return self.emit('array', *[str(element.literal) for element in node.array])
+        print(f"{node.token.location}: ERROR: `{node.token.literal}` is not an expression")
+        exit(1)
+
+    def branch(self, node: AST, true_block: IRBlock, false_block: IRBlock):
+        # same short-circuit rules as AST.branch
+        if isinstance(node, BinaryOperator) and node.token.type in CONDITION_JUMPS:
+            left = self.expression(node.left)
+            right = self.expression(node.right)
+            self.terminate(f"branch_{IR_OPERATORS[node.token.type]}", left, right, true_block, false_block)
+            return
+        if (isinstance(node, BinaryOperator) and not node.right.clobbers_registers()
+                and (node.token.type == TokenType.BIT_OR
+                     or (node.token.type == TokenType.BIT_AND and node.is_boolean()))):
+            middle = self.new_block()
+            if node.token.type == TokenType.BIT_OR:
+                self.branch(node.left, true_block, middle)
+            else:
+                self.branch(node.left, middle, false_block)
+            self.start(middle)
+            self.branch(node.right, true_block, false_block)
+            return
+        self.terminate('branch', self.expression(node), true_block, false_block)
+
+
+def ir_operands_match(kinds: str, args: List) -> bool:
+    if kinds == '*':
+        return all(isinstance(arg, Value) for arg in args)
+    if kinds == 's':
+        return all(isinstance(arg, str) for arg in args)
+    if kinds == 'p':
+        return (len(args) % 2 == 0 and all(isinstance(arg, IRBlock) for arg in args[0::2])
+                and all(isinstance(arg, Value) for arg in args[1::2]))
+    if kinds.endswith('*'):
+        return ir_operands_match(kinds[:-1], args[:len(kinds) - 1]) and ir_operands_match('*', args[len(kinds) - 1:])
+    if len(kinds) != len(args):
+        return False
+    types = {'v': Value, 'i': int, 'n': str, 'b': IRBlock}
+    return all(isinstance(arg, types[kind]) for kind, arg in zip(kinds, args))
+
+
+def dominators(function: IRFunction) -> Dict[IRBlock, set[IRBlock]]:
+    predecessors = function.predecessors()
+    entry = function.blocks[0]
+    dominator_sets = {block: set(function.blocks) for block in function.blocks}
+    dominator_sets[entry] = {entry}
+    changed = True
+    while changed:
+        changed = False
+        for block in function.blocks[1:]:
+            sets = [dominator_sets[predecessor] for predecessor in predecessors[block]]
+            new = {block} | (set.intersection(*sets) if len(sets) > 0 else set())
+            if new != dominator_sets[block]:
+                dominator_sets[block] = new
+                changed = True
+    return dominator_sets
+
+
+def immediate_dominators(dominator_sets: Dict[IRBlock, set[IRBlock]]) -> Dict[IRBlock, IRBlock | None]:
+    # the strict dominator that is dominated by all the others
+    idom = dict()
+    for block, dominating in dominator_sets.items():
+        strict = [dominator for dominator in dominating if dominator is not block]
+        idom[block] = max(strict, key=lambda dominator: len(dominator_sets[dominator]), default=None)
+    return idom
+
+
+def verify_function(function: IRFunction) -> List[str]:
+    problems = list()
+
+    def problem(block: IRBlock, message: str):
+        problems.append(f"{function.name}: {block.name}: {message}")
+
+    if len(function.blocks) == 0:
+        return [f"{function.name}: the function has no block"]
+    blocks = set(function.blocks)
+    definitions: Dict[Value, Tuple[IRBlock, int]] = dict()
+    for block in function.blocks:
+        if block.terminator() is None:
+            problem(block, "the block does not end with a terminator")
+        for index, instruction in enumerate(block.instructions):
+            if instruction.opcode not in IR_OPCODES:
+                problem(block, f"unknown opcode `{instruction.opcode}`")
+                continue
+            (has_dest, kinds) = IR_OPCODES[instruction.opcode]
+            if (instruction.dest is not None) != has_dest:
+                problem(block, f"`{instruction}` {'must' if has_dest else 'cannot'} define a value")
+            if not ir_operands_match(kinds, instruction.args) or (instruction.opcode == 'return' and len(instruction.args) > 1):
+                problem(block, f"invalid operands in `{instruction}`")
+            if instruction.opcode in IR_TERMINATORS and index != len(block.instructions) - 1:
+                problem(block, f"the terminator `{instruction}` is not at the end of the block")
+            if instruction.opcode == 'phi' and any(previous.opcode != 'phi' for previous in block.instructions[:index]):
+                problem(block, f"the phi `{instruction}` is after other instructions")
+            for target in instruction.targets():
+                if target not in blocks:
+                    problem(block, f"`{instruction}` jumps to a block of another function")
+            if instruction.dest is not None:
+                if instruction.dest in definitions:
+                    problem(block, f"{instruction.dest} is defined twice")
+                definitions[instruction.dest] = (block, index)
+    if len(problems) > 0:
+        return problems
+
+    dominator_sets = dominators(function)
+    predecessors = function.predecessors()
+
+    def available(value: Value, block: IRBlock, index: int) -> bool:
+        # whether value is defined before the instruction index of block
+        if value not in definitions:
+            return False
+        (definition_block, definition_index) = definitions[value]
+        if definition_block is block:
+            return definition_index < index
+        return function.ssa and definition_block in dominator_sets[block]
+
+    for block in function.blocks:
+        for index, instruction in enumerate(block.instructions):
+            if instruction.opcode == 'phi':
+                if not function.ssa:
+                    problem(block, f"phi `{instruction}` outside of the SSA form")
+                incoming = instruction.args[0::2]
+                if set(incoming) != set(predecessors[block]) or len(incoming) != len(predecessors[block]):
+                    problem(block, f"the blocks of `{instruction}` are not the predecessors of the block")
+                for (predecessor, value) in zip(incoming, instruction.args[1::2]):
+                    if predecessor in blocks and not available(value, predecessor, len(predecessor.instructions)):
+                        problem(block, f"{value} is not defined at the end of {predecessor.name}")
+                continue
+            for value in instruction.values():
+                if not available(value, block, index):
+                    problem(block, f"{value} is used by `{instruction}` before its definition")
+    return problems
+
+
+def verify_ir(module: IRModule) -> List[str]:
+    problems = list()
+    for function in module.functions:
+        problems += verify_function(function)
+    return problems
+
+
+def may_recurse(name: str, calls: Dict[str, set[str]]) -> bool:
+    pending = list(calls.get(name, set()))
+    seen = set()
+    while len(pending) > 0:
+        function = pending.pop()
+        if function == name:
+            return True
+        if function not in seen:
+            seen.add(function)
+            pending += calls.get(function, set())
+    return False
+
+
+def build_ssa(function: IRFunction):
+    """
+    Promotes the variables to values with phi instructions (dominance frontiers, then renaming along the
+    dominator tree). Variables can keep their value between calls (see LiveRanges): they are loaded at the
+    entry of the function and stored back before each return.
+    The caller makes sure the function cannot be called while it runs (recursion).
+    """
+    variables = sorted({instruction.args[0] for block in function.blocks for instruction in block.instructions
+                        if instruction.opcode in ('load', 'store')})
+    entry = function.blocks[0]
+    dominator_sets = dominators(function)
+    idom = immediate_dominators(dominator_sets)
+    predecessors = function.predecessors()
+    frontiers: Dict[IRBlock, set[IRBlock]] = {block: set() for block in function.blocks}
+    for block in function.blocks:
+        if len(predecessors[block]) < 2:
+            continue
+        for predecessor in predecessors[block]:
+            runner = predecessor
+            while runner is not None and runner is not idom[block]:
+                frontiers[runner].add(block)
+                runner = idom[runner]
+
+    phis: Dict[IRInstruction, str] = dict()
+    for variable in variables:
+        defining = {block for block in function.blocks for instruction in block.instructions
+                    if instruction.opcode == 'store' and instruction.args[0] == variable}
+        defining.add(entry)
+        pending = list(defining)
+        placed = set()
+        while len(pending) > 0:
+            for frontier in frontiers[pending.pop()]:
+                if frontier in placed:
+                    continue
+                placed.add(frontier)
+                phi = IRInstruction('phi', function.new_value(), [])
+                frontier.instructions.insert(0, phi)
+                phis[phi] = variable
+                if frontier not in defining:
+                    defining.add(frontier)
+                    pending.append(frontier)
+
+    initial = [IRInstruction('load', function.new_value(), [variable]) for variable in variables]
+    entry.instructions[0:0] = initial
+    initial_loads = set(initial)
+    stacks = {variable: [load.dest] for variable, load in zip(variables, initial)}
+    mapping: Dict[Value, Value] = dict()
+    children = {block: [child for child in function.blocks if idom[child] is block] for block in function.blocks}
+
+    # depth first walk of the dominator tree, without recursion as the tree can be deep
+    pending = [(entry, None)]
+    while len(pending) > 0:
+        (block, pushed) = pending.pop()
+        if pushed is not None:
+            for variable in pushed:
+                stacks[variable].pop()
+            continue
+        pushed = list()
+        instructions = list()
+        for instruction in block.instructions:
+            if instruction.opcode == 'phi' and instruction in phis:
+                stacks[phis[instruction]].append(instruction.dest)
+                pushed.append(phis[instruction])
+            elif instruction.opcode == 'load' and instruction not in initial_loads:
+                mapping[instruction.dest] = stacks[instruction.args[0]][-1]
+                continue
+            elif instruction.opcode == 'store':
+                stacks[instruction.args[0]].append(mapping.get(instruction.args[1], instruction.args[1]))
+                pushed.append(instruction.args[0])
+                continue
+            else:
+                instruction.replace(mapping)
+                if instruction.opcode == 'return':
+                    instructions += [IRInstruction('store', None, [variable, stacks[variable][-1]])
+                                     for variable in variables]
+            instructions.append(instruction)
+        block.instructions = instructions
+        for successor in block.successors():
+            for phi in successor.phis():
+                if phi in phis and block not in phi.args[0::2]:
+                    phi.args += [block, stacks[phis[phi]][-1]]
+        pending.append((block, pushed))
+        pending += [(child, None) for child in reversed(children[block])]
+    function.ssa = True
+    simplify_phis(function)
+    remove_dead_values(function)
+
+
+def replace_values(function: IRFunction, mapping: Dict[Value, Value]):
+    for block in function.blocks:
+        for instruction in block.instructions:
+            instruction.replace(mapping)
+
+
+def simplify_phis(function: IRFunction):
+    # a phi whose operands are all the same value (or the phi itself) is that value
+    changed = True
+    while changed:
+        changed = False
+        for block in function.blocks:
+            for phi in block.phis():
+                values = {value for value in phi.args[1::2] if value is not phi.dest}
+                if len(values) == 1:
+                    block.instructions.remove(phi)
+                    replace_values(function, {phi.dest: values.pop()})
+                    changed = True
+
+
+def remove_dead_values(function: IRFunction):
+    # the values used by the instructions with side effects are live, and the values they are computed from
+    definitions = {instruction.dest: instruction for block in function.blocks for instruction in block.instructions
+                   if instruction.dest is not None}
+    pending = [value for block in function.blocks for instruction in block.instructions
+               if instruction.opcode not in IR_PURE for value in instruction.values()]
+    live = set()
+    while len(pending) > 0:
+        value = pending.pop()
+        if value not in live:
+            live.add(value)
+            pending += definitions[value].values()
+    for block in function.blocks:
+        block.instructions = [instruction for instruction in block.instructions
+                              if instruction.opcode not in IR_PURE or instruction.dest in live]
+
+
+def lower_program(statements: List[AST], entry: str) -> IRModule:
+    module = IRBuilder(entry).program(statements)
+    check_ir(module)
+    if ir_ssa:
+        calls = {function.name: function.calls() for function in module.functions}
+        for function in module.functions:
+            if not may_recurse(function.name, calls):
+                build_ssa(function)
+        check_ir(module)
+    return module
+
+
+def check_ir(module: IRModule):
+    problems = verify_ir(module)
+    for problem in problems:
+        print(f"ERROR: invalid IR: {problem}", file=sys.stderr)
+    if len(problems) > 0:
+        exit(1)
+
+
+class IRBackend:
+    """
+    Generates the text segment of an IR module for both generators. In a block the values are kept in the
+    registers of EXPRESSION_REGISTERS, the values used by other blocks and the phis have a home in the frame
+    of the function (in `mem` for main), the values in CALLEE_SAVED_REGISTERS stay there across the calls.
+    """
+    def __init__(self, generator, out_file, persistent: Dict[str, set[str]]):
+        self.generator = generator
+        self.out_file = out_file
+        self.persistent = persistent
+        self.labels: Dict[str, str] = dict()
+
+    def emit(self, line: str):
+        self.out_file.emit(line)
+
+    def static_slot(self) -> str:
+        slot = f"[mem+{self.generator.memory_depth}]"
+        self.generator.memory_depth += 8
+        return slot
+
+    def slot(self) -> str:
+        if not self.on_stack:
+            return self.static_slot()
+        self.frame_size += 8
+        return f"[rbp-{self.frame_size}]"
+
+    def module(self, module: IRModule):
+        self.tables = module.table_list
+        self.table_length = module.table_length
+        for function in module.functions:
+            self.labels[function.name] = function.label
+            self.function(function)
+
+    def function(self, function: IRFunction):
+        self.on_stack = function.name != 'main'
+        self.frame_size = 0
+        self.return_label = f".{function.label}_return"
+        self.arguments = [self.slot() if idx < len(ARGUMENT_REGISTERS) else stack_argument(idx, len(function.arguments))
+                          for idx in range(len(function.arguments))] if self.on_stack else []
+        self.persistent_variables = self.persistent.get(function.name, set())
+        self.variables: Dict[str, str] = dict()
+        self.constants: Dict[Value, int] = dict()
+        self.homes: Dict[Value, str] = dict()
+        self.phi_slots: Dict[Value, str] = dict()
+        definition_block = dict()
+        for block in function.blocks:
+            for instruction in block.instructions:
+                if instruction.dest is not None:
+                    definition_block[instruction.dest] = block
+                if instruction.opcode == 'const':
+                    self.constants[instruction.dest] = instruction.args[0]
+                if instruction.opcode == 'phi':
+                    self.phi_slots[instruction.dest] = self.slot()
+        for block in function.blocks:
+            for instruction in block.instructions:
+                if instruction.opcode == 'phi':
+                    uses = zip(instruction.args[0::2], instruction.args[1::2])
+                else:
+                    uses = [(block, value) for value in instruction.values()]
+                for (user, value) in uses:
+                    if definition_block[value] is not user and value not in self.constants and value not in self.homes:
+                        self.homes[value] = self.slot()
+
+        if not self.on_stack:
+            self.emit(f"{function.label}:")
+            self.blocks(function)
+            return
+        # the body is generated first: the prologue saves the callee saved registers it uses
+        out_file = self.out_file
+        self.out_file = out_file.buffer()
+        for idx, register in enumerate(ARGUMENT_REGISTERS[:len(function.arguments)]):
+            self.emit(f"mov qword {self.arguments[idx]}, {register}")
+        self.blocks(function)
+        (body, self.out_file) = (self.out_file, out_file)
+        words = body.words()
+        saved = [register for register in CALLEE_SAVED_REGISTERS if not words.isdisjoint(REGISTER_FAMILIES[register])]
+        self.emit(f"{function.label}:")
+        self.emit("push rbp")
+        self.emit("mov rbp, rsp")
+        if self.frame_size > 0:
+            self.emit(f"sub rsp, {self.frame_size}")
+        for register in saved:
+            self.emit(f"push {register}")
+        self.out_file.extend(body)
+        self.emit(f"{self.return_label}:")
+        for register in reversed(saved):
+            self.emit(f"pop {register}")
+        self.emit("leave")
+        self.emit("ret")
+
+    def blocks(self, function: IRFunction):
+        for index, block in enumerate(function.blocks):
+            next_block = function.blocks[index + 1] if index + 1 < len(function.blocks) else None
+            self.block(block, next_block)
+
+    def block(self, block: IRBlock, next_block: IRBlock | None):
+        self.emit(f"{block.name}:")
+        self.registers = Registers()
+        self.location: Dict[Value, str] = dict()
+        self.last_use: Dict[Value, int] = dict()
+        for index, instruction in enumerate(block.instructions):
+            for value in instruction.values():
+                self.last_use[value] = index
+        for successor in block.successors():
+            for phi in successor.phis():
+                self.last_use[self.incoming(phi, block)] = len(block.instructions) - 1
+        for index, instruction in enumerate(block.instructions):
+            self.index = index
+            self.pinned = set(instruction.values())
+            self.instruction(instruction, block, next_block)
+
+    @staticmethod
+    def incoming(phi: IRInstruction, block: IRBlock) -> Value:
+        return phi.args[phi.args.index(block) + 1]
+
+    def variable(self, name: str) -> str:
+        if name not in self.variables:
+            self.variables[name] = self.static_slot() if name in self.persistent_variables else self.slot()
+        return self.variables[name]
+
+    def allocate(self) -> str:
+        register = self.registers.allocate()
+        if register is not None:
+            return register
+        # out of registers: the value used last goes to memory
+        candidates = [value for value in self.location if value not in self.pinned]
+        victim = max(candidates, key=lambda value: self.last_use.get(value, -1))
+        register = self.location.pop(victim)
+        if victim not in self.homes:
+            self.homes[victim] = self.slot()
+            self.emit(f"mov qword {self.homes[victim]}, {register}")
+        return register
+
+    def operand(self, value: Value) -> str:
+        # a register, an immediate or a memory operand
+        if value in self.location:
+            return self.location[value]
+        if value in self.constants:
+            if is_imm32(self.constants[value]):
+                return str(self.constants[value])
+            register = self.allocate()
+            self.emit(f"mov {register}, {self.constants[value]}")
+            self.location[value] = register
+            return register
+        return f"qword {self.homes[value]}"
+
+    def register(self, value: Value) -> str:
+        operand = self.operand(value)
+        if value in self.location:
+            return operand
+        register = self.allocate()
+        self.emit(f"mov {register}, {operand}")
+        self.location[value] = register
+        return register
+
+    def release(self, values: List[Value]):
+        # frees the registers of the values that are not used after the current instruction
+        for value in set(values):
+            if self.last_use.get(value) == self.index and value in self.location:
+                self.registers.release(self.location.pop(value))
+
+    def define(self, value: Value, register: str):
+        self.location[value] = register
+        if value in self.homes:
+            self.emit(f"mov qword {self.homes[value]}, {register}")
+        if value not in self.last_use:
+            self.registers.release(self.location.pop(value))
+
+    def save_registers(self):
+        # before a call, the values still used go to memory, except in the callee saved registers
+        for value in list(self.location):
+            if self.location[value] in CALLEE_SAVED_REGISTERS:
+                continue
+            if value not in self.homes:
+                self.homes[value] = self.slot()
+                self.emit(f"mov qword {self.homes[value]}, {self.location[value]}")
+            self.registers.release(self.location.pop(value))
+
+    def push_arguments(self, arguments: List[Value]):
+        for argument in arguments:
+            self.emit(f"push {self.operand(argument)}")
+
+    def load_arguments(self, count: int, registers: List[str]) -> int:
+        # the arguments were pushed in order, returns the size left on the stack
+        if count > len(registers):
+            for idx, register in enumerate(registers):
+                self.emit(f"mov {register}, qword [rsp+{8 * (count - 1 - idx)}]")
+            return 8 * count
+        for register in reversed(registers[:count]):
+            self.emit(f"pop {register}")
+        return 0
+
+    def element(self, name: str, index: Value) -> Tuple[str, int]:
+        var = self.tables[name].removeprefix('[').removesuffix(']')
+        sizeof_var = self.table_length[name].data_length_int
+        if index in self.constants:
+            return (f"[{var}+{self.constants[index] * sizeof_var}]", sizeof_var)
+        register = self.register(index)
+        if sizeof_var == 1:
+            return (f"[{var}+{register}]", sizeof_var)
+        return (f"[{var}+{register}*{sizeof_var}]", sizeof_var)
+
+    def instruction(self, instruction: IRInstruction, block: IRBlock, next_block: IRBlock | None):
+        opcode = instruction.opcode
+        args = instruction.args
+        if opcode == 'const':
+            return
+        if opcode in IR_OPERATOR_TYPES:
+            (left, right) = args
+            operand = self.operand(right)
+            if left in self.location and self.last_use[left] == self.index and left is not right:
+                target = self.location.pop(left)
+            else:
+                target = self.allocate()
+                self.emit(f"mov {target}, {self.operand(left)}")
+            apply_operator(self.out_file, IR_OPERATOR_TYPES[opcode], target, operand, self.registers)
+            self.release(args)
+            self.define(instruction.dest, target)
+        elif opcode == 'param':
+            register = self.allocate()
+            if self.on_stack:
+                self.emit(f"mov {register}, qword {self.arguments[args[0]]}")
+            else:
+                self.emit(f"mov {register}, 0")  # main is not called
+            self.define(instruction.dest, register)
+        elif opcode == 'load':
+            register = self.allocate()
+            self.emit(f"mov {register}, qword {self.variable(args[0])}")
+            self.define(instruction.dest, register)
+        elif opcode == 'store':
+            operand = self.operand(args[1])
+            if operand.startswith('qword'):
+                operand = self.register(args[1])
+            self.emit(f"mov qword {self.variable(args[0])}, {operand}")
+            self.release(args)
+        elif opcode == 'address':
+            register = self.allocate()
+            self.emit(f"mov {register}, qword {self.tables[args[0]].removeprefix('[').removesuffix(']')}")
+            self.define(instruction.dest, register)
+        elif opcode == 'element':
+            (element, sizeof_var) = self.element(args[0], args[1])
+            self.release(args)
+            register = self.allocate()
+            if sizeof_var == 1:
+                self.emit(f"movzx {register}, byte {element}")
+            else:
+                self.emit(f"mov {register}, qword {element}")
+            self.define(instruction.dest, register)
+        elif opcode == 'set_element':
+            (element, sizeof_var) = self.element(args[0], args[1])
+            if args[2] in self.constants and is_imm32(self.constants[args[2]]):
+                value = self.constants[args[2]]
+                operand = str(value & 0xff if sizeof_var == 1 else value)
+            else:
+                operand = self.register(args[2])
+                if sizeof_var == 1:
+                    operand = BYTE_REGISTERS[operand]
+            self.emit(f"mov {'byte' if sizeof_var == 1 else 'qword'} {element}, {operand}")
+            self.release(args)
+        elif opcode == 'array':
+            first_raw = self.generator.memory_depth
+            for literal in args:
+                self.emit(f"mov qword [mem+{self.generator.memory_depth}], {literal}")
+                self.generator.memory_depth += 8
+            register = self.allocate()
+            self.emit(f"lea {register}, qword [mem+{first_raw}]")
+            self.define(instruction.dest, register)
+        elif opcode == 'string':
+            register = self.allocate()
+            self.emit(f"lea {register}, [string_{args[0]}]")
+            self.define(instruction.dest, register)
+        elif opcode == 'phi':
+            register = self.allocate()
+            self.emit(f"mov {register}, qword {self.phi_slots[instruction.dest]}")
+            self.define(instruction.dest, register)
+        elif opcode == 'call':
+            self.push_arguments(args[1:])
+            self.release(args[1:])
+            self.save_registers()
+            stack = self.load_arguments(len(args) - 1, ARGUMENT_REGISTERS)
+            self.emit(f"call {self.labels[args[0]]}")
+            if stack > 0:
+                self.emit(f"add rsp, {stack}")
+            register = self.allocate()
+            self.emit(f"mov {register}, rax")
+            self.define(instruction.dest, register)
+        elif opcode == 'syscall':
+            self.push_arguments(args)
+            self.release(args)
+            self.save_registers()
+            self.emit(f"call RUNTIME_flush")  # keep putc output ordered with the syscall
+            stack = self.load_arguments(len(args), SYSCALL_REGISTERS)
+            self.emit("syscall")
+            if stack > 0:
+                self.emit(f"add rsp, {stack}")
+            register = self.allocate()
+            self.emit(f"mov {register}, rax")
+            self.define(instruction.dest, register)
+        elif opcode == 'putc':
+            self.emit(f"mov rax, {self.operand(args[0])}")
+            self.release(args)
+            self.save_registers()
+            self.emit("; PUTC")
+            self.emit("call RUNTIME_putc")
+        elif opcode == 'flush':
+            self.save_registers()
+            self.emit("call RUNTIME_flush")
+        else:
+            self.terminator(instruction, block, next_block)
+
+    def terminator(self, instruction: IRInstruction, block: IRBlock, next_block: IRBlock | None):
+        opcode = instruction.opcode
+        args = instruction.args
+        # the phis of the successors are set before the jump
+        for successor in dict.fromkeys(block.successors()):
+            for phi in successor.phis():
+                operand = self.operand(self.incoming(phi, block))
+                if operand.startswith('qword'):
+                    self.emit(f"mov r10, {operand}")
+                    operand = 'r10'
+                self.emit(f"mov qword {self.phi_slots[phi.dest]}, {operand}")
+        if opcode == 'jump':
+            if args[0] is not next_block:
+                self.emit(f"jmp {args[0].name}")
+        elif opcode in ('branch', 'branch_eq', 'branch_ne'):
+            if opcode == 'branch':
+                (left, right, true_block, false_block) = (args[0], None, args[1], args[2])
+                (jump_if_true, jump_if_false) = ('jne', 'je')
+            else:
+                (left, right, true_block, false_block) = args
+                (jump_if_true, jump_if_false) = CONDITION_JUMPS[IR_OPERATOR_TYPES[opcode.removeprefix('branch_')]]
+            operand = '0' if right is None else self.operand(right)
+            compared = self.operand(left)
+            if left in self.constants or (compared.startswith('qword') and operand.startswith('qword')):
+                compared = self.register(left)
+            self.emit(f"cmp {compared}, {operand}")
+            if true_block is next_block:
+                self.emit(f"{jump_if_false} {false_block.name}")
+            else:
+                self.emit(f"{jump_if_true} {true_block.name}")
+                if false_block is not next_block:
+                    self.emit(f"jmp {false_block.name}")
+        elif opcode == 'return':
+            if len(args) > 0:
+                self.emit(f"mov rax, {self.operand(args[0])}")
+            if self.on_stack:
+                self.emit(f"jmp {self.return_label}")
+            else:
+                self.emit("ret")
+        elif opcode == 'exit':
+            self.emit("; STOP")
+            self.emit("call RUNTIME_flush")
+            self.emit("mov rax, 60")
+            self.emit("xor rdi, rdi")
+            self.emit("syscall")
+
+
+def generate_ir_program(generator, out_file):
+    begin = time.time()
+    module = lower_program(generator.statements, out_file.entry)
+    if emit_ir:
+        with open(generator.out_file_name.removesuffix('.asm') + '.ir', "w") as ir_file:
+            ir_file.write(module.dump())
+    end = time.time()
+    print_info(f"lowering to IR took {end - begin} seconds")
+    generator.table_list = module.table_list
+    generator.table_length = module.table_length
+    persistent = {node.name.literal: persistent_variables(node) for statement in generator.statements
+                  for node in walk(statement) if isinstance(node, FunctionNode)}
+    IRBackend(generator, out_file, persistent).module(module)
+
+
+ELF_BASE = 0x400000
+ELF_PAGE_SIZE = 0x1000
+ELF_HEADER_SIZE = 64
+ELF_PROGRAM_HEADER_SIZE = 56
+MAP_FIXED = 0x10  # flags of <sys/mman.h> missing from the mmap module
+MAP_32BIT = 0x40
+MAP_NORESERVE = 0x4000
+RUN_ADDRESS_SPACE = 1 << 28
+RUN_STACK_SIZE = 8 * 1024 * 1024
+
+ASM_REGISTERS: Dict[str, Tuple[int, int]] = dict()  # name -> (number, size in bytes)
+for number, names in enumerate(zip(['rax', 'rcx', 'rdx', 'rbx', 'rsp', 'rbp', 'rsi', 'rdi'] + [f'r{i}' for i in range(8, 16)],
+                                   ['eax', 'ecx', 'edx', 'ebx', 'esp', 'ebp', 'esi', 'edi'] + [f'r{i}d' for i in range(8, 16)],
+                                   ['al', 'cl', 'dl', 'bl', 'spl', 'bpl', 'sil', 'dil'] + [f'r{i}b' for i in range(8, 16)])):
+    for name, size in zip(names, (8, 4, 1)):
+        ASM_REGISTERS[name] = (number, size)
+ASM_REX_BYTE_REGISTERS = {'spl', 'bpl', 'sil', 'dil'}  # only reachable with a REX prefix
+ASM_SIZES = {'byte': 1, 'dword': 4, 'qword': 8}
+ASM_DATA_SIZES = {'db': 1, 'dd': 4, 'dq': 8}
+ASM_RESERVE_SIZES = {'rb': 1, 'rd': 4, 'rq': 8}
+ASM_CONDITIONS = {
+    'o': 0, 'no': 1, 'b': 2, 'c': 2, 'nae': 2, 'ae': 3, 'nb': 3, 'nc': 3, 'e': 4, 'z': 4, 'ne': 5, 'nz': 5,
+    'be': 6, 'na': 6, 'a': 7, 'nbe': 7, 's': 8, 'ns': 9, 'p': 10, 'pe': 10, 'np': 11, 'po': 11,
+    'l': 12, 'nge': 12, 'ge': 13, 'nl': 13, 'le': 14, 'ng': 14, 'g': 15, 'nle': 15,
+}
+ASM_ARITHMETIC = {'add': 0, 'or': 1, 'adc': 2, 'sbb': 3, 'and': 4, 'sub': 5, 'xor': 6, 'cmp': 7}
+ASM_SHIFTS = {'rol': 0, 'ror': 1, 'shl': 4, 'sal': 4, 'shr': 5, 'sar': 7}
+ASM_UNARY = {'not': 2, 'neg': 3, 'mul': 4, 'div': 6, 'idiv': 7}
+ASM_FIXED = {'ret': b'\xc3', 'leave': b'\xc9', 'syscall': b'\x0f\x05', 'nop': b'\x90', 'cqo': b'\x48\x99',
+             'rdtsc': b'\x0f\x31'}
+
+
+def asm_number(text: str) -> int | None:
+    if text.isdigit():
+        return int(text, 10)
+    if text.startswith('0x'):
+        try:
+            return int(text, 16)
+        except ValueError:
+            return None
+    if len(text) == 3 and text[0] == text[2] == "'":
+        return ord(text[1])
+    return None
+
+
+def fits(value: int, bits: int) -> bool:
+    return -(1 << (bits - 1)) <= value < (1 << (bits - 1))
+
+
+def signed(value: int) -> int:
+    # the literals above 2^63 are the unsigned spelling of negative words
+    return value - (1 << 64) if (1 << 63) <= value < (1 << 64) else value
+
+
+class AsmOperand:
+    """
+    A register, a memory reference `[base+index*scale+displacement]` (the displacement may add a symbol)
+    or an immediate `displacement` (plus a symbol). `size` is in bytes, None when the operand does not tell.
+    """
+    __slots__ = ('kind', 'size', 'register', 'base', 'index', 'scale', 'displacement', 'symbol')
+
+    def __init__(self, kind: str, size: int | None = None, register: str | None = None):
+        self.kind = kind
+        self.size = size
+        self.register = register
+        self.base: str | None = None
+        self.index: str | None = None
+        self.scale = 1
+        self.displacement = 0
+        self.symbol: str | None = None
+
+
+class AsmLine:
+    # an instruction of the text segment, `size` bytes at `address`
+    __slots__ = ('number', 'text', 'mnemonic', 'operands', 'address', 'size', 'code', 'jump')
+
+    def __init__(self, number: int, text: str, mnemonic: str, operands: List[AsmOperand]):
+        self.number = number
+        self.text = text
+        self.mnemonic = mnemonic
+        self.operands = operands
+        self.address = 0
+        self.size = 0
+        self.code: bytes | None = None  # kept from the first pass when it does not depend on the layout
+        self.jump: bytes | None = None  # opcode of the short form of a relative jump, None once it is near
+
+
+class Assembler:
+    """
+    Encodes the subset of x86-64 and of the fasm syntax the generators emit, and writes it as a static
+    ELF64 executable without running fasm. The text segment is laid out in passes: the relative jumps
+    start short and become near when their target is out of range, until no jump changes. The other
+    instructions have the same size whatever the symbols resolve to, so they are encoded once for their
+    size, and again at the end only when they refer to a symbol.
+    """
+    def __init__(self, file_name: str, base: int = ELF_BASE):
+        self.file_name = file_name  # for the error messages
+        self.base = base  # address of the first segment
+        self.symbols: Dict[str, int] = dict()
+        self.scope = ""  # the last global label, prefix of the local labels `.name`
+        self.entry = "start"
+        self.text: List[AsmLine] = list()
+        self.data: List[Tuple[int, str | None, int, List[str] | None, int]] = list()  # line, name, size, values, count
+        self.line: AsmLine | None = None
+        self.final = False
+        self.operands: Dict[str, AsmOperand] = dict()  # the parsed operands, but the local labels
+        self.segments: List[Tuple[int, int, int, int, int]] = list()  # flags, offset, address, file size, memory size
+        self.encodings: Dict[str, bytes] = dict()  # the instructions without symbols
+
+    def error(self, number: int, text: str, message: str):
+        print(f"{self.file_name}:{number}: ERROR: {message}: `{text.strip()}`", file=sys.stderr)
+        exit(1)
+
+    def fail(self, message: str):
+        self.error(self.line.number, self.line.text, message)
+
+    def label(self, name: str) -> str:
+        return self.scope + name if name.startswith('.') else name
+
+    def value(self, symbol: str | None) -> int:
+        if symbol is None:
+            return 0
+        if symbol in self.symbols:
+            return self.symbols[symbol]
+        if self.final:
+            self.fail(f"undefined symbol `{symbol}`")
+        return 0
+
+    # parsing
+
+    def parse(self, source: List[str]):
+        segment = None
+        for number, line in enumerate(source, 1):
+            text = line.split(';', 1)[0].strip()
+            if text == '':
+                continue
+            (mnemonic, _, operands) = text.partition(' ')
+            self.line = AsmLine(number, line, mnemonic, [])
+            if text.endswith(':'):
+                name = text[:-1]
+                if not name.startswith('.'):
+                    self.scope = name
+                self.line.mnemonic = ':'
+                self.line.operands = [AsmOperand('label', register=self.label(name))]
+                self.text.append(self.line)
+            elif mnemonic == 'format':
+                if operands.split() != ['ELF64', 'executable']:
+                    self.fail("only `format ELF64 executable` is supported")
+            elif mnemonic == 'segment':
+                segment = 'data' if 'writable' in operands.split() else 'text'
+            elif mnemonic == 'entry':
+                self.entry = operands.strip()
+            elif segment == 'data':
+                self.parse_data(number, text)
+            elif segment == 'text':
+                if operands.strip() != '':
+                    self.line.operands = [self.operand(operand.strip()) for operand in operands.split(',')]
+                self.text.append(self.line)
+            else:
+                self.fail("instruction outside of a segment")
+
+    def parse_data(self, number: int, text: str):
+        # [name] db|dd|dq values | [name] db|dd|dq count dup(value) | [name] rb|rd|rq count
+        words = text.split(None, 1)
+        name = None
+        if words[0] not in ASM_DATA_SIZES and words[0] not in ASM_RESERVE_SIZES:
+            name = words[0]
+            words = words[1].split(None, 1) if len(words) == 2 else []
+        if len(words) != 2:
+            self.error(number, text, "unknown data directive")
+        (directive, values) = words
+        if directive in ASM_RESERVE_SIZES:
+            self.data.append((number, name, ASM_RESERVE_SIZES[directive], None, self.expression(number, text, values)))
+        elif directive not in ASM_DATA_SIZES:
+            self.error(number, text, f"unknown data directive `{directive}`")
+        elif 'dup' in values:
+            (count, _, value) = values.partition('dup')
+            value = value.strip().removeprefix('(').removesuffix(')')
+            self.data.append((number, name, ASM_DATA_SIZES[directive], [value.strip()], self.expression(number, text, count)))
+        else:
+            self.data.append((number, name, ASM_DATA_SIZES[directive], [value.strip() for value in values.split(',')], 1))
+
+    def expression(self, number: int, text: str, expression: str) -> int:
+        # sums of products of numbers, the counts of the data directives
+        total = 0
+        for term in expression.split('+'):
+            product = 1
+            for factor in term.split('*'):
+                value = asm_number(factor.strip())
+                if value is None:
+                    self.error(number, text, f"`{factor.strip()}` is not a number")
+                product *= value
+            total += product
+        return total
+
+    def operand(self, text: str) -> AsmOperand:
+        if text in self.operands:
+            return self.operands[text]
+        operand = self.parse_operand(text)
+        if '.' not in text:
+            self.operands[text] = operand
+        return operand
+
+    def parse_operand(self, text: str) -> AsmOperand:
+        size = None
+        words = text.split(None, 1)
+        if len(words) == 2 and words[0] in ASM_SIZES:
+            size = ASM_SIZES[words[0]]
+            text = words[1].strip()
+        if text in ASM_REGISTERS:
+            return AsmOperand('register', ASM_REGISTERS[text][1], text)
+        operand = AsmOperand('immediate', size)
+        if text.startswith('[') and text.endswith(']'):
+            operand.kind = 'memory'
+            text = text[1:-1]
+        for (sign, term) in re.findall(r'([+-]?)\s*([^+-]+)', text):
+            term = term.strip()
+            if '*' in term and operand.kind == 'memory':
+                (register, _, scale) = term.partition('*')
+                if asm_number(register.strip()) is not None:
+                    (register, scale) = (scale, register)
+                (register, scale) = (register.strip(), asm_number(scale.strip()))
+                if register not in ASM_REGISTERS or scale not in (1, 2, 4, 8) or operand.index is not None or sign == '-':
+                    self.fail(f"invalid index `{term}`")
+                operand.index = register
+                operand.scale = scale
+            elif term in ASM_REGISTERS and operand.kind == 'memory' and sign != '-':
+                if operand.base is None:
+                    operand.base = term
+                elif operand.index is None:
+                    operand.index = term
+                else:
+                    self.fail(f"too many registers in `[{text}]`")
+            elif asm_number(term) is not None:
+                operand.displacement += -asm_number(term) if sign == '-' else asm_number(term)
+            elif re.fullmatch(r'[A-Za-z_.][\w.]*', term) and operand.symbol is None and sign != '-':
+                operand.symbol = self.label(term)
+            else:
+                self.fail(f"invalid operand `{text}`")
+        for register in (operand.base, operand.index):
+            if register is not None and ASM_REGISTERS[register][1] != 8:
+                self.fail("the addresses are 64 bits")
+        if operand.index is not None and ASM_REGISTERS[operand.index][0] == 4:
+            self.fail("rsp can not be an index")
+        return operand
+
+    # encoding
+
+    def address(self, reg: int, operand: AsmOperand) -> Tuple[int, bytes, bool]:
+        # REX.X and REX.B bits, ModRM/SIB/displacement bytes, and whether the displacement is relative to rip
+        displacement = operand.displacement + self.value(operand.symbol)
+        if operand.base is None and operand.index is None and operand.symbol is not None:
+            return 0, bytes([(reg & 7) << 3 | 5]) + b'\0\0\0\0', True
+        if not fits(displacement, 32):
+            self.fail("the address does not fit in 32 bits")
+        rex = 0
+        scale = {1: 0, 2: 1, 4: 2, 8: 3}[operand.scale]
+        index = 4
+        if operand.index is not None:
+            index = ASM_REGISTERS[operand.index][0]
+            rex |= (index >> 3) << 1
+        if operand.base is None:
+            sib = bytes([scale << 6 | (index & 7) << 3 | 5])
+            return rex, bytes([(reg & 7) << 3 | 4]) + sib + displacement.to_bytes(4, 'little', signed=True), False
+        base = ASM_REGISTERS[operand.base][0]
+        rex |= base >> 3
+        if operand.symbol is None and displacement == 0 and base & 7 != 5:
+            (mode, tail) = (0, b'')
+        elif operand.symbol is None and fits(displacement, 8):
+            (mode, tail) = (1, displacement.to_bytes(1, 'little', signed=True))
+        else:
+            (mode, tail) = (2, displacement.to_bytes(4, 'little', signed=True))
+        if operand.index is None and base & 7 != 4:
+            return rex, bytes([mode << 6 | (reg & 7) << 3 | base & 7]) + tail, False
+        sib = bytes([scale << 6 | (index & 7) << 3 | base & 7])
+        return rex, bytes([mode << 6 | (reg & 7) << 3 | 4]) + sib + tail, False
+
+    def modrm(self, opcode: bytes, reg: int, rm: AsmOperand, size: int, tail: bytes = b'', *registers: AsmOperand) -> bytes:
+        # opcode with a ModRM byte: `reg` is a register number or an opcode extension, `rm` a register or memory
+        rex = (reg >> 3) << 2
+        if size == 8:
+            rex |= 8
+        if rm.kind == 'register':
+            number = ASM_REGISTERS[rm.register][0]
+            (rex, body, relative) = (rex | number >> 3, bytes([0xc0 | (reg & 7) << 3 | number & 7]), False)
+        else:
+            (bits, body, relative) = self.address(reg, rm)
+            rex |= bits
+        if any(operand.register in ASM_REX_BYTE_REGISTERS for operand in (rm, *registers)):
+            rex |= 0x40
+        code = (bytes([0x40 | rex]) if rex else b'') + opcode + body + tail
+        if relative:
+            target = rm.displacement + self.value(rm.symbol) - (self.line.address + len(code))
+            position = len(code) - len(tail) - 4
+            code = code[:position] + target.to_bytes(4, 'little', signed=True) + code[position + 4:]
+        return code
+
+    def size(self, *operands: AsmOperand) -> int:
+        sizes = {operand.size for operand in operands if operand.size is not None}
+        if len(sizes) != 1:
+            self.fail("operand size not specified" if len(sizes) == 0 else "operand sizes do not match")
+        return sizes.pop()
+
+    def immediate(self, operand: AsmOperand, bits: int, unsigned: bool = False) -> bytes:
+        # the immediates are sign extended to the operand size, except the bytes and the data
+        value = signed(operand.displacement + self.value(operand.symbol))
+        if not fits(value, bits) and not ((unsigned or bits == 8) and 0 <= value < 1 << bits):
+            self.fail(f"the immediate does not fit in {bits} bits")
+        return (value & ((1 << bits) - 1)).to_bytes(bits // 8, 'little')
+
+    def small(self, operand: AsmOperand, bits: int = 8) -> bool:
+        # the short immediate form; never with a symbol, so the size of the instruction does not depend on it
+        return operand.symbol is None and fits(signed(operand.displacement), bits)
+
+    def encode(self, line: AsmLine) -> bytes:
+        self.line = line
+        mnemonic = line.mnemonic
+        operands = line.operands
+        kinds = tuple(operand.kind for operand in operands)
+        if mnemonic in ASM_FIXED and kinds == ():
+            return ASM_FIXED[mnemonic]
+        if mnemonic == 'mov':
+            if kinds == ('register', 'immediate') and operands[0].size == 8 and not self.small(operands[1], 32):
+                number = ASM_REGISTERS[operands[0].register][0]
+                return bytes([0x48 | number >> 3, 0xb8 | number & 7]) + self.immediate(operands[1], 64)
+            if kinds[1] == 'immediate':
+                size = self.size(operands[0])
+                if size == 1:
+                    return self.modrm(b'\xc6', 0, operands[0], size, self.immediate(operands[1], 8))
+                return self.modrm(b'\xc7', 0, operands[0], size, self.immediate(operands[1], 32))
+            return self.register_memory(0x88, 0x8a, operands)
+        if mnemonic in ASM_ARITHMETIC or mnemonic == 'test':
+            extension = ASM_ARITHMETIC.get(mnemonic, 0)
+            if len(operands) == 2 and kinds[1] == 'immediate':
+                size = self.size(operands[0])
+                if mnemonic == 'test':
+                    return self.modrm(b'\xf6' if size == 1 else b'\xf7', 0, operands[0], size,
+                                      self.immediate(operands[1], 8 if size == 1 else 32))
+                if size == 1:
+                    return self.modrm(b'\x80', extension, operands[0], size, self.immediate(operands[1], 8))
+                if self.small(operands[1]):
+                    return self.modrm(b'\x83', extension, operands[0], size, self.immediate(operands[1], 8))
+                return self.modrm(b'\x81', extension, operands[0], size, self.immediate(operands[1], 32))
+            if mnemonic == 'test':
+                return self.register_memory(0x84, None, operands)
+            return self.register_memory(extension * 8, extension * 8 + 2, operands)
+        if mnemonic in ASM_SHIFTS and len(operands) == 2:
+            size = self.size(operands[0])
+            opcode = 0xc0 if size == 1 else 0xc1
+            if operands[1].register == 'cl':
+                return self.modrm(bytes([opcode + 0x12]), ASM_SHIFTS[mnemonic], operands[0], size)
+            if kinds[1] == 'immediate' and operands[1].symbol is None and operands[1].displacement == 1:
+                return self.modrm(bytes([opcode + 0x10]), ASM_SHIFTS[mnemonic], operands[0], size)
+            if kinds[1] == 'immediate':
+                return self.modrm(bytes([opcode]), ASM_SHIFTS[mnemonic], operands[0], size, self.immediate(operands[1], 8))
+        if (mnemonic in ASM_UNARY or mnemonic == 'imul') and kinds in (('register',), ('memory',)):
+            size = self.size(operands[0])
+            return self.modrm(b'\xf6' if size == 1 else b'\xf7', ASM_UNARY.get(mnemonic, 5), operands[0], size)
+        if mnemonic == 'imul' and kinds[0] == 'register' and len(operands) in (2, 3):
+            if kinds[-1] == 'immediate':
+                source = operands[1] if len(operands) == 3 else operands[0]
+                size = self.size(operands[0], source)
+                if self.small(operands[-1]):
+                    return self.modrm(b'\x6b', self.register(operands[0]), source, size, self.immediate(operands[-1], 8))
+                return self.modrm(b'\x69', self.register(operands[0]), source, size, self.immediate(operands[-1], 32))
+            if len(operands) == 2:
+                return self.modrm(b'\x0f\xaf', self.register(operands[0]), operands[1], self.size(*operands))
+        if mnemonic in ('movzx', 'movsx') and kinds[0] == 'register' and operands[1].kind != 'immediate':
+            if operands[1].size not in (None, 1) or operands[0].size == 1:
+                self.fail("only the byte sources are supported")
+            opcode = b'\x0f\xb6' if mnemonic == 'movzx' else b'\x0f\xbe'
+            return self.modrm(opcode, self.register(operands[0]), operands[1], operands[0].size, b'', operands[0])
+        if mnemonic == 'lea' and kinds == ('register', 'memory'):
+            return self.modrm(b'\x8d', self.register(operands[0]), operands[1], self.size(operands[0]))
+        if mnemonic in ('push', 'pop') and len(operands) == 1:
+            operand = operands[0]
+            if operand.kind == 'register':
+                number = ASM_REGISTERS[operand.register][0]
+                if operand.size != 8:
+                    self.fail("only the 64 bits registers can be pushed")
+                opcode = bytes([(0x50 if mnemonic == 'push' else 0x58) | number & 7])
+                return (b'\x41' if number >= 8 else b'') + opcode
+            if operand.kind == 'memory':
+                if mnemonic == 'push':
+                    return self.modrm(b'\xff', 6, operand, 4)
+                return self.modrm(b'\x8f', 0, operand, 4)
+            if mnemonic == 'push':
+                if self.small(operand):
+                    return b'\x6a' + self.immediate(operand, 8)
+                return b'\x68' + self.immediate(operand, 32)
+        if mnemonic.startswith('set') and mnemonic[3:] in ASM_CONDITIONS and len(operands) == 1:
+            if self.size(operands[0]) != 1:
+                self.fail("setcc needs a byte operand")
+            return self.modrm(bytes([0x0f, 0x90 | ASM_CONDITIONS[mnemonic[3:]]]), 0, operands[0], 1)
+        if mnemonic.startswith('cmov') and mnemonic[4:] in ASM_CONDITIONS and kinds[0] == 'register' and len(operands) == 2:
+            opcode = bytes([0x0f, 0x40 | ASM_CONDITIONS[mnemonic[4:]]])
+            return self.modrm(opcode, self.register(operands[0]), operands[1], self.size(*operands))
+        if mnemonic in ('jmp', 'call') and kinds in (('register',), ('memory',)):
+            return self.modrm(b'\xff', 4 if mnemonic == 'jmp' else 2, operands[0], 4)
+        if mnemonic in ('jmp', 'call') or (mnemonic.startswith('j') and mnemonic[1:] in ASM_CONDITIONS):
+            if kinds != ('immediate',):
+                self.fail("invalid jump target")
+            target = operands[0].displacement + self.value(operands[0].symbol)
+            if line.jump is not None:
+                # out of range until the layout is done, the jump is then made near
+                offset = target - line.address - 2 if fits(target - line.address - 2, 8) else 0
+                return line.jump + offset.to_bytes(1, 'little', signed=True)
+            if mnemonic == 'jmp':
+                opcode = b'\xe9'
+            elif mnemonic == 'call':
+                opcode = b'\xe8'
+            else:
+                opcode = bytes([0x0f, 0x80 | ASM_CONDITIONS[mnemonic[1:]]])
+            return opcode + (target - line.address - len(opcode) - 4).to_bytes(4, 'little', signed=True)
+        self.fail("unsupported instruction")
+
+    def register(self, operand: AsmOperand) -> int:
+        return ASM_REGISTERS[operand.register][0]
+
+    def register_memory(self, opcode: int, reverse: int | None, operands: List[AsmOperand]) -> bytes:
+        # `op r/m, reg` is opcode+1 (opcode for bytes), `op reg, r/m` is reverse+1 (reverse for bytes)
+        if len(operands) != 2 or operands[1].kind == 'memory' and (operands[0].kind != 'register' or reverse is None):
+            self.fail("invalid operands")
+        size = self.size(*operands)
+        if operands[1].kind == 'register':
+            (rm, reg) = operands
+        else:
+            (reg, rm) = operands
+            opcode = reverse
+        return self.modrm(bytes([opcode if size == 1 else opcode + 1]), self.register(reg), rm, size, b'', reg)
+
+    # layout
+
+    def layout(self, address: int) -> int:
+        for line in self.text:
+            line.address = address
+            if line.mnemonic == ':':
+                self.symbols[line.operands[0].register] = address
+            address += line.size
+        return address
+
+    def assemble(self, source: List[str]) -> bytes:
+        self.parse(source)
+        for line in self.text:
+            if line.mnemonic == ':':
+                if line.operands[0].register in self.symbols:
+                    self.error(line.number, line.text, "the label is already defined")
+                self.symbols[line.operands[0].register] = 0
+        for number, name, _, _, _ in self.data:
+            if name is not None:
+                self.symbols[name] = 0
+
+        for line in self.text:
+            if line.mnemonic == ':':
+                continue
+            relative = line.mnemonic == 'call' and line.operands[0].kind == 'immediate'
+            if line.mnemonic == 'jmp' and line.operands[0].kind == 'immediate':
+                line.jump = b'\xeb'
+            elif line.mnemonic.startswith('j') and line.mnemonic[1:] in ASM_CONDITIONS:
+                line.jump = bytes([0x70 | ASM_CONDITIONS[line.mnemonic[1:]]])
+            if line.jump is None and not relative and all(operand.symbol is None for operand in line.operands):
+                key = line.text.split(';', 1)[0].strip()
+                if key not in self.encodings:
+                    self.encodings[key] = self.encode(line)
+                line.code = self.encodings[key]
+                line.size = len(line.code)
+            else:
+                line.size = len(self.encode(line))
+        headers = ELF_HEADER_SIZE + 2 * ELF_PROGRAM_HEADER_SIZE
+        changed = True
+        while changed:
+            changed = False
+            self.layout(self.base + headers)
+            for line in self.text:
+                if line.jump is not None:
+                    target = self.value(line.operands[0].symbol) + line.operands[0].displacement
+                    if not fits(target - line.address - 2, 8):
+                        line.jump = None
+                        line.size = 6 if line.mnemonic != 'jmp' else 5
+                        changed = True
+        text_end = self.layout(self.base + headers) - self.base
+
+        data_address = (self.base + text_end + ELF_PAGE_SIZE - 1) // ELF_PAGE_SIZE * ELF_PAGE_SIZE + text_end % ELF_PAGE_SIZE
+        address = data_address
+        for number, name, size, values, count in self.data:
+            if name is not None:
+                self.symbols[name] = address
+            address += size * count * (1 if values is None else len(values))
+        data_size = address - data_address
+
+        self.final = True
+        text = bytearray()
+        for line in self.text:
+            if line.mnemonic != ':':
+                text += line.code if line.code is not None else self.encode(line)
+        data = bytearray()
+        initialized = 0
+        for number, name, size, values, count in self.data:
+            if values is None:
+                data += bytes(size * count)
+                continue
+            self.line = AsmLine(number, source[number - 1], "", [])
+            elements = bytearray()
+            for value in values:
+                operand = self.operand(value)
+                if operand.kind != 'immediate':
+                    self.fail(f"invalid data `{value}`")
+                elements += self.immediate(operand, size * 8, True)
+            data += elements * count
+            initialized = len(data)
+
+        if self.entry not in self.symbols:
+            self.error(0, self.entry, "undefined entry point")
+        self.segments = [(5, 0, self.base, text_end, text_end), (6, text_end, data_address, initialized, data_size)]
+        header = elf_header(self.symbols[self.entry], len(self.segments))
+        for segment in self.segments:
+            header += elf_program_header(*segment)
+        return bytes(header + text + data[:initialized])
+
+    def write_executable(self, output_file: str, source: List[str]):
+        image = self.assemble(source)
+        with open(output_file, "wb") as executable:
+            executable.write(image)
+        os.chmod(output_file, 0o755)
+
+
+class Loader:
+    """
+    Runs an executable of the Assembler without writing it. The Loader reserves addresses below 2 GB (the generated
+    code addresses its data with 32 bits) where the program is assembled, from `base`. `execute` forks a child that
+    maps the segments there, switches to a stack of its own and jumps to the entry point. The output of the program
+    comes back through a pipe.
+    """
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.libc.mmap.restype = ctypes.c_void_p
+        self.libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+        self.libc.mprotect.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+        self.base = self.map(None, RUN_ADDRESS_SPACE, 0, MAP_32BIT | MAP_NORESERVE)
+
+    def map(self, address: int | None, size: int, protection: int, flags: int = 0) -> int:
+        start = self.libc.mmap(address, size, protection, mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS | flags, -1, 0)
+        if start is None or start == (1 << 64) - 1:  # MAP_FAILED
+            raise OSError(ctypes.get_errno(), f"cannot map {size} bytes")
+        return start
+
+    def load(self, address: int | None, size: int, flags: int, contents: bytes = b'') -> int:
+        # flags of the ELF segments: 1 executable, 2 writable, 4 readable
+        start = self.map(address, size, mmap.PROT_READ | mmap.PROT_WRITE, 0 if address is None else MAP_FIXED)
+        ctypes.memmove(start, contents, len(contents))
+        protection = (mmap.PROT_READ if flags & 4 else 0) | (mmap.PROT_WRITE if flags & 2 else 0) | (mmap.PROT_EXEC if flags & 1 else 0)
+        if self.libc.mprotect(start, size, protection) != 0:
+            raise OSError(ctypes.get_errno(), "cannot protect memory")
+        return start
+
+    def jump(self, image: bytes, segments: List[Tuple[int, int, int, int, int]], entry: int):
+        for flags, offset, address, file_size, memory_size in segments:
+            start = address // ELF_PAGE_SIZE * ELF_PAGE_SIZE
+            end = (address + memory_size + ELF_PAGE_SIZE - 1) // ELF_PAGE_SIZE * ELF_PAGE_SIZE
+            if end > self.base + RUN_ADDRESS_SPACE:
+                raise OSError(0, f"the program does not fit in {RUN_ADDRESS_SPACE} bytes")
+            self.load(start, end - start, flags, bytes(address - start) + image[offset:offset + file_size])
+        stack = self.load(None, RUN_STACK_SIZE, 6)
+        # mov rsp, stack + RUN_STACK_SIZE / mov rax, entry / jmp rax
+        trampoline = b'\x48\xbc' + struct.pack('<Q', stack + RUN_STACK_SIZE) + b'\x48\xb8' + struct.pack('<Q', entry) + b'\xff\xe0'
+        ctypes.CFUNCTYPE(None)(self.load(None, ELF_PAGE_SIZE, 5, trampoline))()
+
+    def execute(self, image: bytes, segments: List[Tuple[int, int, int, int, int]], entry: int) -> int:
+        # the exit status of the program, minus the signal number when it was killed
+        (read_end, write_end) = os.pipe()
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            os.dup2(write_end, 1)
+            os.close(write_end)
+            for signal_number in (signal.SIGINT, signal.SIGPIPE):
+                signal.signal(signal_number, signal.SIG_DFL)
+            try:
+                self.jump(image, segments, entry)
+            except OSError as error:
+                print(f"ERROR: cannot load the program: {error}", file=sys.stderr)
+            os._exit(1)
+        os.close(write_end)
+        while chunk := os.read(read_end, 1 << 16):
+            sys.stdout.buffer.write(chunk)
+        os.close(read_end)
+        sys.stdout.buffer.flush()
+        (_, status) = os.waitpid(pid, 0)
+        return os.waitstatus_to_exitcode(status)
+
+
+def elf_header(entry: int, program_headers: int) -> bytes:
+    identification = b'\x7fELF' + bytes([2, 1, 1, 0]) + bytes(8)  # 64 bits, little endian, System V
+    return identification + struct.pack('<HHIQQQIHHHHHH', 2, 0x3e, 1, entry, ELF_HEADER_SIZE, 0, 0, ELF_HEADER_SIZE,
+                                        ELF_PROGRAM_HEADER_SIZE, program_headers, 0, 0, 0)
+
+
+def elf_program_header(flags: int, offset: int, address: int, file_size: int, memory_size: int) -> bytes:
+    # a loadable segment, flags: 1 executable, 2 writable, 4 readable
+    return struct.pack('<IIQQQQQQ', 1, flags, offset, address, address, file_size, memory_size, ELF_PAGE_SIZE)
+
+
 def run_info(command: List[str]) -> None:
     if info_cmd:
         print(f"[INFO] {' '.join(command)}")
@@ -1459,18 +4921,501 @@ def print_info(string: str):
         print(f"[INFO] {string}")
 
 
+phase_times: Dict[str, float] = dict()  # seconds taken by the phases of the last compilation
+
+
+def end_phase(name: str, begin: float) -> None:
+    phase_times[name] = time.time() - begin
+    print_info(f"{name} took {phase_times[name]} seconds")
+
+
+
+def build_key(program_string: str, modules: ModuleRegistry) -> str:
+    # everything that changes the executable: the sources, the backend and the compiler itself
+    key = hashlib.sha256()
+    key.update(compiler_version())
+    key.update(f"{debug} {unbuffered} {fasm_loc} {builtin_assembler} {PUTC_BUFFER_SIZE}".encode())
+    key.update(f"-O{optimization_level} --unroll={loop_unroll_factor} {inline} {sorted(no_inline)} {use_ir} {ir_ssa} {profile}".encode())
+    key.update(hashlib.sha256(program_string.encode()).digest())
+    for digest in sorted(modules.digests.values()):
+        key.update(digest)
+    return key.hexdigest()
+
+
+def restore_build(key: str, output_file: str) -> bool:
+    executable = memory_builds.get(key) if memory_builds is not None else None
+    if executable is not None:
+        with open(output_file, "wb") as f:
+            f.write(executable)
+        os.chmod(output_file, 0o755)
+        return True
+    cached_file = os.path.join(build_cache_dir, key)
+    try:
+        shutil.copyfile(cached_file, output_file)
+        os.utime(cached_file)  # the cache is evicted in least recently used order
+    except OSError:
+        return False
+    os.chmod(output_file, 0o755)
+    remember_build(key, output_file)
+    return True
+
+
+def remember_build(key: str, output_file: str):
+    if memory_builds is not None:
+        with open(output_file, "rb") as f:
+            memory_builds.put(key, f.read())
+
+
+def store_build(key: str, output_file: str):
+    remember_build(key, output_file)
+    cached_file = os.path.join(build_cache_dir, key)
+    tmp_file = f"{cached_file}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(build_cache_dir, exist_ok=True)
+        shutil.copyfile(output_file, tmp_file)
+        os.replace(tmp_file, cached_file)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        return
+    evict_builds()
+
+
+def evict_builds():
+    entries = list()
+    for entry in os.scandir(build_cache_dir):
+        if entry.is_file() and not entry.name.endswith(".tmp"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= BUILD_CACHE_SIZE:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_size -= size
+
+
+def server_address() -> str:
+    return os.environ.get('AW_SERVER', os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), f"assemblyWrapper-{os.getuid()}.sock"))
+
+
+class LRUCache:
+    """Bytes evicted in least recently used order beyond `capacity` bytes."""
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries: OrderedDict = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> bytes | None:
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value: bytes):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.capacity:
+            (_, evicted) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return dict(entries=len(self.entries), size=self.size, hits=self.hits, misses=self.misses,
+                    hit_rate=self.hits / lookups if lookups else 0.0)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    # nearest rank
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    rank = math.ceil(fraction * len(ordered))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+class CompileServer:
+    """
+    `./main.py --serve [socket]` compiles the programs sent by `./client.py` on a Unix socket, one JSON line per
+    request: {"arguments": [...], "directory": ..., "environment": {...}} is answered with
+    {"status": ..., "stdout": ..., "stderr": ...}, and {"stats": true} with the hit rates of the caches and the
+    latency percentiles. The parsed modules and the executables are kept in memory between the requests.
+    The requests are served one at a time: the options of the compiler are globals. The server does not change
+    its directory, the files of a request are relative to its "directory".
+    """
+    def __init__(self, address: str):
+        global memory_builds
+        global memory_modules
+        memory_builds = LRUCache(SERVER_BUILDS_SIZE)
+        memory_modules = LRUCache(SERVER_MODULES_SIZE)
+        self.address = address
+        self.requests = 0
+        self.failures = 0
+        self.latencies: deque = deque(maxlen=SERVER_LATENCIES)  # seconds, of the last compilations
+        self.environment = dict(os.environ)
+
+    def serve(self):
+        if os.path.exists(self.address):
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                    probe.connect(self.address)
+                print(f"ERROR: a server already listens on {self.address}", file=sys.stderr)
+                exit(1)
+            except ConnectionRefusedError:
+                os.remove(self.address)  # left by a server that did not stop cleanly
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.address)
+        listener.listen()
+        print_info(f"listening on {self.address}")
+        try:
+            while True:
+                (connection, _) = listener.accept()
+                self.handle(connection)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+            os.remove(self.address)
+
+    def handle(self, connection: socket.socket):
+        with connection, connection.makefile("rwb") as stream:
+            try:
+                request = json.loads(stream.readline())
+                response = self.stats() if request.get('stats') else self.compile(request)
+            except Exception as error:
+                response = dict(status=1, stdout="", stderr=f"ERROR: invalid request: {error}\n")
+            stream.write(json.dumps(response).encode() + b"\n")
+
+    def compile(self, request: Dict) -> Dict:
+        global build_cache_dir
+        begin = time.time()
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        status = 0
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            configure(request.get('environment', self.environment))
+            try:
+                directory = request['directory']
+                build_cache_dir = os.path.join(directory, build_cache_dir)
+                (input_file, output_file) = parse_arguments("main.py", request['arguments'])
+                if run_in_memory:
+                    print("ERROR: the compile server cannot run the programs, --run is not supported", file=sys.stderr)
+                    exit(1)
+                input_file = os.path.join(directory, input_file)
+                compile_file(input_file, os.path.join(directory, output_file), ModuleRegistry(input_file, directory))
+            except SystemExit as exit_:
+                status = exit_status(exit_)
+            except Exception:
+                traceback.print_exc()
+                status = 1
+        self.requests += 1
+        self.failures += status != 0
+        self.latencies.append(time.time() - begin)
+        return dict(status=status, stdout=stdout.getvalue(), stderr=stderr.getvalue())
+
+    def stats(self) -> Dict:
+        stats = dict(requests=self.requests, failures=self.failures)
+        stats['builds'] = memory_builds.stats()
+        stats['modules'] = memory_modules.stats()
+        stats['latency_ms'] = {name: percentile(list(self.latencies), fraction) * 1000
+                               for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))}
+        return stats
+
+
+IN_NONBLOCK = 0o4000  # flags of <sys/inotify.h>
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class Watcher:
+    """
+    `--watch` compiles the program again every time its source or one of the modules it imports (transitively)
+    changes. The parsed modules are kept in memory, so only the modules that changed are parsed again, the others
+    are unpickled. The directories of the sources are watched with inotify (editors often replace a file instead
+    of writing it), a change is a new modification time or size of one of the sources. Without inotify, the
+    sources are polled.
+    """
+    def __init__(self, program_name: str, args: List[str]):
+        global memory_modules
+        memory_modules = LRUCache(SERVER_MODULES_SIZE)
+        self.program_name = program_name
+        self.args = args
+        self.files: set[str] = set()
+        self.directories: set[str] = set()
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.inotify = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC) if hasattr(self.libc, 'inotify_init1') else -1
+
+    def watch(self):
+        try:
+            while True:
+                self.build()
+                snapshot = self.snapshot()
+                while self.snapshot() == snapshot:
+                    self.wait()
+                time.sleep(WATCH_SETTLE_TIME)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.inotify >= 0:
+                os.close(self.inotify)
+
+    def build(self):
+        # the options are parsed again: they are reset with the strings of the previous compilation
+        configure(os.environ)
+        (input_file, output_file) = parse_arguments(self.program_name, self.args)
+        begin = time.time()
+        modules = ModuleRegistry(input_file)
+        failed = False
+        try:
+            compile_file(input_file, output_file, modules)
+        except SystemExit:
+            failed = True
+        except OSError as error:
+            # a source removed while an editor writes it again: the next change starts another build
+            print(f"ERROR: {error}", file=sys.stderr)
+            failed = True
+        except Exception:
+            traceback.print_exc()
+            failed = True
+        total = time.time() - begin
+        # the modules read before an error are watched too, the error may be in one of them
+        self.files = {os.path.realpath(input_file)} | set(modules.digests)
+        phases = ', '.join(f"{name} {seconds:.3f}s" for name, seconds in phase_times.items())
+        if failed:
+            print(f"[WATCH] build failed after {total:.3f}s ({phases})")
+        else:
+            if 'generation' not in phase_times:
+                phases += ", restored from the build cache"
+            print(f"[WATCH] {output_file} built in {total:.3f}s ({phases}), "
+                  f"{len(modules.parsed)} of {len(modules.modules)} imported modules parsed")
+        for directory in {os.path.dirname(file) for file in self.files} - self.directories:
+            self.directories.add(directory)
+            if self.inotify >= 0 and self.libc.inotify_add_watch(self.inotify, directory.encode(), WATCH_EVENTS) < 0:
+                os.close(self.inotify)
+                self.inotify = -1
+        print(f"[WATCH] watching {len(self.files)} files{'' if self.inotify >= 0 else ' (polling)'}", flush=True)
+
+    def snapshot(self) -> Dict[str, Tuple[int, int] | None]:
+        stats = dict()
+        for file in self.files:
+            try:
+                stat = os.stat(file)
+                stats[file] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                stats[file] = None
+        return stats
+
+    def wait(self):
+        if self.inotify < 0:
+            time.sleep(WATCH_POLL_INTERVAL)
+            return
+        select.select([self.inotify], [], [])
+        try:
+            while os.read(self.inotify, 1 << 16):
+                pass
+        except BlockingIOError:
+            pass
 
-def main() -> None:
-    args = sys.argv
-    (program_name, args) = shift_args(args)
-    if len(args) != 2:
+
+def exit_status(exit_: SystemExit) -> int:
+    return exit_.code if isinstance(exit_.code, int) else 0 if exit_.code is None else 1
+
+
+def batch_compile(job: Tuple[str, List[str], str, str]) -> Dict:
+    # compiles one program of a batch, in a worker of the pool
+    (program_name, options, input_file, output_file) = job
+    begin = time.time()
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    status = 0
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        configure(os.environ)
+        try:
+            parse_arguments(program_name, options + [input_file, output_file])
+            compile_file(input_file, output_file)
+        except SystemExit as exit_:
+            status = exit_status(exit_)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+    size = os.path.getsize(output_file) if status == 0 and os.path.exists(output_file) else None
+    return dict(input=input_file, output=output_file, success=status == 0, status=status,
+                seconds=time.time() - begin, phases=dict(phase_times), size=size,
+                stdout=stdout.getvalue(), stderr=stderr.getvalue())
+
+
+class BatchCompiler:
+    """
+    `--batch` compiles several programs in one invocation: the pairs of input and output files of the command line,
+    or the ones of a manifest (one `<input file> <output file>` per line, relative to the manifest, `#` starts a
+    comment). The modules imported by the programs are parsed once, before the workers of the process pool are
+    forked, and the workers compile and assemble the programs in parallel. The summary is written on stdout in JSON:
+    the status, the time and the size of the executable of every program, with the output of the compiler.
+    """
+    def __init__(self, program_name: str, args: List[str]):
+        self.program_name = program_name
+        self.options = [arg for arg in args if arg.startswith('-') and arg != '--batch']
+        files = [arg for arg in args if not arg.startswith('-')]
+        if len(files) == 1:
+            self.jobs = self.read_manifest(files[0])
+        elif len(files) > 0 and len(files) % 2 == 0:
+            self.jobs = list(zip(files[0::2], files[1::2]))
+        else:
+            print("ERROR: --batch takes a manifest or pairs of input and output files", file=sys.stderr)
+            usage(program_name)
+            exit(1)
+        if len(self.jobs) == 0:
+            print(f"ERROR: the manifest `{files[0]}` is empty", file=sys.stderr)
+            exit(1)
+        # the options are checked once, not by every worker
+        parse_arguments(program_name, self.options + list(self.jobs[0]))
+        if run_in_memory or watch:
+            print("ERROR: --batch cannot be used with --run or --watch", file=sys.stderr)
+            usage(program_name)
+            exit(1)
+
+    def read_manifest(self, manifest: str) -> List[Tuple[str, str]]:
+        try:
+            with open(manifest, "r") as f:
+                lines = f.read().splitlines()
+        except OSError as error:
+            print(f"ERROR: cannot read the manifest `{manifest}`: {error.strerror}", file=sys.stderr)
+            exit(1)
+        directory = os.path.dirname(manifest)
+        jobs = list()
+        for number, line in enumerate(lines, 1):
+            if line.strip() == '' or line.lstrip().startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                print(f"{manifest}:{number}: ERROR: expected `<input file> <output file>` but got `{line.strip()}`", file=sys.stderr)
+                exit(1)
+            jobs.append((os.path.join(directory, fields[0]), os.path.join(directory, fields[1])))
+        return jobs
+
+    def share_imports(self):
+        # the pickled modules are inherited by the forked workers, which only unpickle them
+        global memory_modules
+        memory_modules = LRUCache(SERVER_MODULES_SIZE)
+        for input_file in sorted({os.path.abspath(input_file) for input_file, _ in self.jobs}):
+            # an error is reported by the worker that compiles the program
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                try:
+                    with open(input_file, "r") as f:
+                        tokens = Lexer(input_file, f.read()).tokenize()
+                    modules = ModuleRegistry(input_file)
+                    for index in range(len(tokens) - 1):
+                        if tokens.type(index) == TokenType.IMPORT and tokens.type(index + 1) == TokenType.STRING:
+                            modules.import_module(tokens[index], tokens[index + 1], input_file)
+                except (OSError, SystemExit):
+                    pass
+
+    def run(self):
+        begin = time.time()
+        self.share_imports()
+        jobs = [(self.program_name, self.options, input_file, output_file) for input_file, output_file in self.jobs]
+        with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, len(jobs))) as pool:
+            results = list(pool.map(batch_compile, jobs))
+        failed = sum(1 for result in results if not result['success'])
+        summary = dict(programs=results, succeeded=len(results) - failed, failed=failed, seconds=time.time() - begin)
+        print(json.dumps(summary, indent=2))
+        if failed > 0:
+            exit(1)
+
+
+def parse_arguments(program_name: str, args: List[str]) -> Tuple[str, str]:
+    # sets the options of the flags, returns the input and the output files
+    global build_cache
+    global optimization_level
+    global loop_unroll_factor
+    global inline
+    global use_ir
+    global ir_ssa
+    global emit_ir
+    global builtin_assembler
+    global run_in_memory
+    global watch
+    global profile
+    files = list()
+    while len(args) > 0:
+        (arg, args) = shift_args(args)
+        if arg == '--no-cache':
+            build_cache = False
+        elif arg == '-O':
+            optimization_level = 1
+        elif arg.startswith('-O') and arg[2:].isdigit():
+            optimization_level = int(arg[2:])
+        elif arg == '--ir':
+            use_ir = True
+        elif arg == '--ssa':
+            use_ir = True
+            ir_ssa = True
+        elif arg == '--emit-ir':
+            use_ir = True
+            emit_ir = True
+            build_cache = False
+        elif arg.startswith('--unroll=') and arg.removeprefix('--unroll=').isdigit():
+            loop_unroll_factor = int(arg.removeprefix('--unroll='))
+        elif arg == '--no-inline':
+            inline = False
+        elif arg.startswith('--no-inline='):
+            no_inline.update(arg.removeprefix('--no-inline=').split(','))
+        elif arg == '--builtin-assembler':
+            builtin_assembler = True
+        elif arg == '--profile':
+            profile = True
+        elif arg == '--run':
+            run_in_memory = True
+        elif arg == '--watch':
+            watch = True
+        elif arg.startswith('--'):
+            print(f"ERROR: unknown flag `{arg}`", file=sys.stderr)
+            usage(program_name)
+            exit(1)
+        else:
+            files.append(arg)
+    if builtin_assembler and debug:
+        print("ERROR: --builtin-assembler cannot be used with DEBUG, which assembles with yasm and ld", file=sys.stderr)
+        usage(program_name)
+        exit(1)
+    if profile and use_ir:
+        print("ERROR: --profile cannot be used with --ir", file=sys.stderr)
+        usage(program_name)
+        exit(1)
+    if watch and run_in_memory:
+        print("ERROR: --watch cannot be used with --run", file=sys.stderr)
+        usage(program_name)
+        exit(1)
+    if len(files) != (1 if run_in_memory else 2):
         print("ERROR: ", file=sys.stderr)
         usage(program_name)
         exit(1)
-    (input_file, args) = shift_args(args)
-    (output_file, args) = shift_args(args)
+    (input_file, files) = shift_args(files)
+    output_file = os.path.splitext(input_file)[0]
+    if not run_in_memory:
+        (output_file, files) = shift_args(files)
+    return input_file, output_file
+
 
+def compile_file(input_file: str, output_file: str, modules: ModuleRegistry | None = None) -> ModuleRegistry:
+    # returns the modules imported by the program
     input_file = os.path.abspath(input_file)
+    phase_times.clear()
 
     f = open(input_file, "r")
     program_string = f.read()
@@ -1479,38 +5424,85 @@ def main() -> None:
     lexer = Lexer(input_file, program_string)
 
     begin = time.time()
-    tokens = list()
-    for token in lexer:
-        tokens.append(token)
-    end = time.time()
-    print_info(f"tokenizing took {end - begin} seconds")
+    tokens = lexer.tokenize()
+    end_phase("tokenizing", begin)
 
     begin = time.time()
-    parser = Parser(tokens)
+    parser = Parser(tokens, modules)
     statements = parser.parse()
-    end = time.time()
-    print_info(f"parsing took {end - begin} seconds")
+    end_phase("parsing", begin)
 
     #  print(statements)
 
+    begin = time.time()
+    statements = optimize(statements)
+    end_phase("optimization", begin)
+
+    key = None
+    if build_cache and not run_in_memory:
+        key = build_key(program_string, parser.modules)
+        if restore_build(key, output_file):
+            print_info(f"build cache hit, {output_file} restored")
+            return parser.modules
+
     begin = time.time()
     asm_file = output_file + ".asm"
-    if debug:
-        generator = Generator_NASM(statements, asm_file)
-    else:
-        generator = Generator_FASM(statements, asm_file)
+    generator = Generator(statements, asm_file, NasmEmitter if debug and not run_in_memory else FasmEmitter)
     generator.generate()
-    end = time.time()
-    print_info(f"generation took {end - begin} seconds")
-
-    if debug:
+    end_phase("generation", begin)
+
+    if run_in_memory:
+        begin = time.time()
+        loader = Loader()
+        assembler = Assembler(asm_file, loader.base)
+        image = assembler.assemble(generator.code.splitlines() + generator.data)
+        end_phase("assembling", begin)
+        status = loader.execute(image, assembler.segments, assembler.symbols[assembler.entry])
+        if status < 0:  # killed by a signal, so is the compiler
+            signal.signal(-status, signal.SIG_DFL)
+            os.kill(os.getpid(), -status)
+        exit(status)
+    elif builtin_assembler:
+        begin = time.time()
+        Assembler(asm_file).write_executable(output_file, generator.code.splitlines() + generator.data)
+        end_phase("assembling", begin)
+    elif debug:
+        generator.write()
         subprocess.run(["yasm", "-felf64", "-gdwarf2", asm_file, "-o", output_file+".o"])
-        subprocess.run(["ld", output_file+".o", "-o", output_file])
+        ld_run = subprocess.run(["ld", output_file+".o", "-o", output_file])
+        if ld_run.returncode > 0:
+            exit(1)
     else:
-        fasm_run = subprocess.run([fasm_loc, asm_file])
+        begin = time.time()
+        generator.write()
+        # through print, so that the compile server sends it to its client
+        fasm_run = subprocess.run([fasm_loc, asm_file], capture_output=True, text=True)
+        print(fasm_run.stdout, end='')
+        print(fasm_run.stderr, end='', file=sys.stderr)
         if fasm_run.returncode > 0:
             exit(1)
         run_info(["chmod", "+x", output_file])
+        end_phase("assembling", begin)
+
+    if key is not None:
+        store_build(key, output_file)
+    return parser.modules
+
+
+def main() -> None:
+    args = sys.argv
+    (program_name, args) = shift_args(args)
+    if len(args) > 0 and args[0] == '--serve':
+        CompileServer(args[1] if len(args) > 1 else server_address()).serve()
+        return
+    if '--batch' in args:
+        BatchCompiler(program_name, args).run()
+        return
+    (input_file, output_file) = parse_arguments(program_name, args)
+    if watch:
+        Watcher(program_name, args).watch()
+        return
+    compile_file(input_file, output_file)
 
 
 if __name__ == '__main__':
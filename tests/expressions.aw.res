@@ -0,0 +1,3 @@
+
+----------
+0
\ No newline at end of file
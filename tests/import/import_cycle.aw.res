@@ -0,0 +1,5 @@
+
+/home/pierrem/PycharmProjects/assemblyWrapper/tests/import/import_cycle.aw:1:8: ERROR: import cycle /home/pierrem/PycharmProjects/assemblyWrapper/tests/import/import_cycle.aw -> /home/pierrem/PycharmProjects/assemblyWrapper/tests/import/import_cycle.aw
+
+----------
+1
\ No newline at end of file
@@ -0,0 +1,5 @@
+
+/home/pierrem/PycharmProjects/assemblyWrapper/tests/lexer/add_assign.aw:3:5: ERROR: unexpected token `a`
+
+----------
+1
\ No newline at end of file
@@ -0,0 +1,3 @@
+a	b\
+----------
+0
\ No newline at end of file
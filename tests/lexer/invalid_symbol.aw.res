@@ -0,0 +1,5 @@
+
+/home/pierrem/PycharmProjects/assemblyWrapper/tests/lexer/invalid_symbol.aw:2:15:ERROR: `@` is not a valid symbol
+
+----------
+1
\ No newline at end of file
@@ -2,104 +2,156 @@
 import sys
 import subprocess
 import os
-import io
-from contextlib import redirect_stdout
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+TEST_TIMEOUT = 10  # seconds, for the compilation and for the execution of a test
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main.py")
 
 test_failed = 0
+compiler_flags = list()  # forwarded to main.py, to run the suite at every optimization level
+
+
+class TestResult:
+    def __init__(self, file: str, output: str, compile_time: float, run_time: float, timed_out: bool,
+                 in_memory: bool = False):
+        self.file = file
+        self.output = output
+        self.compile_time = compile_time
+        self.run_time = run_time
+        self.timed_out = timed_out
+        self.in_memory = in_memory  # with --run, compile_time is the time of the compilation and of the execution
 
-def run_info(command: str, capture_output=False) -> None:
-    print(f"[INFO] {' '.join(command)}")
-    return subprocess.run(command, capture_output)
-
-def compile_file_and_get_stdout_from_execution(file: str) -> str:
-    test_file_name = f"{file}.test"
-    test_file_asm_name = f"{file}.test.asm"
-    result_cmp = subprocess.run(["../main.py", file, test_file_name], capture_output=True, env={'NOINFO':'1', 'FASM_LOC':'/opt/fasm-1.73.30/fasm/fasm'})
-    if result_cmp.returncode > 0:
-        string = result_cmp.stderr.decode() + '\n' + result_cmp.stdout.decode()
-        string += "\n----------\n"
-        string += f"{result_cmp.returncode}"
+    def timings(self) -> str:
+        if self.in_memory:
+            return f"total {self.compile_time:.3f}s"
+        return f"compile {self.compile_time:.3f}s, run {self.run_time:.3f}s"
+
+
+def run_file_in_memory(file: str) -> TestResult:
+    # with --run the compiler executes the program itself: a failure is reported as a compilation failure,
+    # so the programs of the tests exit with 0
+    begin = time.time()
+    try:
+        result = subprocess.run([MAIN, *compiler_flags, file], capture_output=True, timeout=TEST_TIMEOUT,
+                                env={'NOINFO': '1'})
+    except subprocess.TimeoutExpired:
+        return TestResult(file, f"execution timed out after {TEST_TIMEOUT} seconds", time.time() - begin, 0.0, True, True)
+    if result.returncode > 0:
+        string = result.stderr.decode() + '\n' + result.stdout.decode()
     else:
-        result = subprocess.run([f"./{test_file_name}"], capture_output=True)
-        string = result.stdout.decode() + "\n----------\n"
-        string += f"{result.returncode}"
-    if os.path.exists(test_file_name):
-        run_info(["rm", f"./{test_file_name}"])
-    if os.path.exists(test_file_asm_name):
-        run_info(["rm", f"./{test_file_asm_name}"])
-    return string
-    
-
-
-def run_test_for_file(file:str):
+        string = result.stdout.decode()
+    string += "\n----------\n"
+    string += f"{result.returncode}"
+    return TestResult(file, string, time.time() - begin, 0.0, False, True)
+
+
+def compile_file_and_get_stdout_from_execution(file: str) -> TestResult:
+    if '--run' in compiler_flags:
+        return run_file_in_memory(file)
+    # every test is built in its own directory so that several runs can share the tree
+    with tempfile.TemporaryDirectory(prefix="aw-test-") as build_dir:
+        test_file_name = os.path.join(build_dir, os.path.basename(file) + ".test")
+        compile_time = 0.0
+        run_time = 0.0
+        begin = time.time()
+        try:
+            result_cmp = subprocess.run([MAIN, *compiler_flags, file, test_file_name], capture_output=True, timeout=TEST_TIMEOUT,
+                                        env={'NOINFO':'1', 'FASM_LOC':'/opt/fasm-1.73.30/fasm/fasm'})
+        except subprocess.TimeoutExpired:
+            return TestResult(file, f"compilation timed out after {TEST_TIMEOUT} seconds", time.time() - begin, run_time, True)
+        compile_time = time.time() - begin
+        if result_cmp.returncode > 0:
+            string = result_cmp.stderr.decode() + '\n' + result_cmp.stdout.decode()
+            string += "\n----------\n"
+            string += f"{result_cmp.returncode}"
+        else:
+            begin = time.time()
+            try:
+                result = subprocess.run([test_file_name], capture_output=True, timeout=TEST_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                return TestResult(file, f"execution timed out after {TEST_TIMEOUT} seconds", compile_time, time.time() - begin, True)
+            run_time = time.time() - begin
+            string = result.stdout.decode() + "\n----------\n"
+            string += f"{result.returncode}"
+    return TestResult(file, string, compile_time, run_time, False)
+
+
+def collect_tests(file: str) -> list:
+    if os.path.isdir(file):
+        tests = list()
+        for sub_file in sorted(os.listdir(file)):
+            sub_file = f"{file}/{sub_file}"
+            if os.path.isdir(sub_file) or sub_file.endswith('.aw'):
+                tests += collect_tests(sub_file)
+        return tests
+    if file.endswith('.aw'):
+        return [file]
+    return list()
+
+
+def run_test_for_file(result: TestResult):
     global test_failed
+    file = result.file
     res_file = f"{file}.res"
     if not os.path.exists(res_file):
         print(f"[ERROR]: {res_file} does not exists, skipping test for {file}.", file=sys.stderr)
         return
     r = open(res_file, "r")
     res_as_string = r.read()
-    r.close() 
-    
-    file_as_string = compile_file_and_get_stdout_from_execution(file)
+    r.close()
 
-    if file_as_string != res_as_string:
+    if result.timed_out:
+        print(f"[ERROR]: the test for {file} failed: {result.output}.", file=sys.stderr)
+        test_failed += 1
+    elif result.output != res_as_string:
         print(f"[ERROR]: the test for {file} failed.", file=sys.stderr)
         test_failed += 1
+    else:
+        print(f"[OK] {file} ({result.timings()})")
 
-def record_test_for_file(file:str):
+
+def record_test_for_file(result: TestResult):
+    file = result.file
+    if result.timed_out:
+        print(f"[ERROR]: cannot record {file}: {result.output}.", file=sys.stderr)
+        return
     res_file = f"{file}.res"
-    file_as_string = compile_file_and_get_stdout_from_execution(file)
     r = open(res_file, "w")
-    r.write(file_as_string)
-    r.close() 
-
+    r.write(result.output)
+    r.close()
+    print(f"[RECORDED] {file} ({result.timings()})")
 
-def run_test_on_dir(dir: str) -> None:
-    for file in os.listdir(dir):
-        file = f"{dir}/{file}"
-        if os.path.isdir(file):
-            run_test_on_dir(file)
-        if file.endswith('.aw'):
-            run_test_for_file(file)
 
-def run_test_on(file: str) -> None:
-    if os.path.isdir(file):
-        run_test_on_dir(file)
-    elif file.endswith('.aw'):
-        run_test_for_file(file)
-    else:
+def run_tests(file: str, report) -> None:
+    tests = collect_tests(file)
+    if len(tests) == 0:
         print("[ERROR]: nothing to run. Exiting", file=sys.stdout)
         exit(1)
+    begin = time.time()
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=set_compiler_flags, initargs=(compiler_flags,)) as pool:
+        for result in pool.map(compile_file_and_get_stdout_from_execution, tests):
+            report(result)
+    print(f"{len(tests)} tests in {time.time() - begin:.3f} seconds")
 
-def record_test_on_dir(dir: str) -> None:
-    for file in os.listdir(dir):
-        file = f"{dir}/{file}"
-        if os.path.isdir(file):
-            record_test_on_dir(file)
-        if file.endswith('.aw'):
-            record_test_for_file(file)
 
-def record_test_on(file: str) -> None:
-    if os.path.isdir(file):
-        record_test_on_dir(file)
-    elif file.endswith('.aw'):
-        record_test_for_file(file)
-    else:
-        print("[ERROR]: nothing to record. Exiting", file=sys.stdout)
-        exit(1)
+def set_compiler_flags(flags: list):
+    global compiler_flags
+    compiler_flags = flags
 
 
 def main():
-    if len(sys.argv) != 3:
+    if len(sys.argv) < 3:
         print("ERROR: not enought arguments", file=sys.stderr)
-        print("    usage: ./test.py -rec <file or dir>",file=sys.stderr)
-        print("    usage: ./test.py -run <file or dir>",file=sys.stderr)
+        print("    usage: ./test.py -rec <file or dir> [compiler flags]",file=sys.stderr)
+        print("    usage: ./test.py -run <file or dir> [compiler flags]",file=sys.stderr)
         exit(1)
+    set_compiler_flags(sys.argv[3:])
     if sys.argv[1] == "-rec":
-        record_test_on(sys.argv[2])
+        run_tests(sys.argv[2], record_test_for_file)
     if sys.argv[1] == "-run":
-        run_test_on(sys.argv[2])
+        run_tests(sys.argv[2], run_test_for_file)
         print(f"Test failed: {test_failed}")
 
 if __name__ == '__main__':